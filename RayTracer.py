@@ -1,4 +1,6 @@
 import argparse
+import json
+from dataclasses import asdict
 import numpy as np
 
 
@@ -6,9 +8,16 @@ BLACK = np.array([0.0, 0.0, 0.0])
 
 from time import time
 
-from parser import parse
-from utils import write_img, is_close, get_reflected_vector
-from classes import Ray
+from scene_file import load_scene
+from utils import write_img, is_close, get_reflected_vector, get_viewing_window_vectors, atol
+from classes import Ray, RenderOptions
+from scene import NO_SHAPE
+from shadows import OccluderCache, find_shadow_occlusions, probe_shadows, PROBE_OFFSETS
+from sampling import get_shadow_sample_offsets, SAMPLING_METHODS
+from stats import RenderStats, timed, get_heatmap_colors, get_peak_rss_mb
+from lights import select_lights
+from kernels import BACKENDS, get_backend
+from output import save_image, get_stream_writer
 
 
 
@@ -19,29 +28,173 @@ def main():
     parser.add_argument('output',  metavar='output',  help='The output image path',           type=str)
     parser.add_argument('width',   metavar='width',   help='The output image path width',     type=int, nargs='?', default=500)
     parser.add_argument('height',  metavar='height',  help='The output image path height',    type=int, nargs='?', default=500)
+    parser.add_argument('--engine', help='scalar (the default) traces one ray at a time, batch traces a tile of rays at a time', choices=['scalar', 'batch'], default=None)
+    parser.add_argument('--tile-size', help='The side of the square tiles the image is rendered in', type=int, default=64)
+    parser.add_argument('--workers', help='The number of processes rendering tiles in parallel', type=int, default=1)
+    parser.add_argument('--shadow-sampling', help='How the soft shadow rays sample the light', choices=SAMPLING_METHODS, default='jitter')
+    parser.add_argument('--seed', help='The seed of the soft shadows, the image depends only on it and the tile size', type=int, default=None)
+    parser.add_argument('--light-threshold', help='Lights adding less than this to a hit\'s brightest channel are skipped', type=float, default=0.0)
+    parser.add_argument('--light-samples', help='Shade each hit by this many lights drawn in proportion to their contribution, 0 for all the lights', type=int, default=0)
+    parser.add_argument('--adaptive-shadow-rays', help='Scale each light\'s soft shadow rays with its contribution', action='store_true')
+    parser.add_argument('--shadow-cache', help='Test the shadow rays first against the shapes which blocked each light\'s latest rays', action='store_true')
+    parser.add_argument('--shadow-early-out', help='Skip the soft shadow rays of hits whose light corners are all lit or all blocked', action='store_true')
+    parser.add_argument('--min-throughput', help='The batch engine does not trace secondary rays weighing less than this in their pixel', type=float, default=0.0)
+    parser.add_argument('--progressive', help='Render a coarse preview first, then refine the tiles until their soft shadows converge', action='store_true')
+    parser.add_argument('--max-passes', help='The most passes a tile is refined in, in progressive mode', type=int, default=8)
+    parser.add_argument('--tolerance', help='The standard error of the pixels below which a tile is converged, in progressive mode', type=float, default=0.01)
+    parser.add_argument('--time-budget', help='Seconds after which the progressive mode stops refining', type=float, default=None)
+    parser.add_argument('--preview-interval', help='Seconds between the progressive mode\'s intermediate writes of the output', type=float, default=5.)
+    parser.add_argument('--antialias', help='Supersample the pixels on edges, with the batch engine', action='store_true')
+    parser.add_argument('--aa-samples', help='The most samples of an edge pixel', type=int, default=10)
+    parser.add_argument('--aa-threshold', help='The color difference between neighbouring pixels which makes an edge', type=float, default=0.1)
+    parser.add_argument('--checkpoint', help='A directory for a memory-mapped framebuffer, an interrupted render resumes from its finished tiles', type=str, default=None)
+    parser.add_argument('--gbuffer-cache', help='A directory of G-buffers, a scene differing from a cached one only in its materials and lights\' colors is reshaded without tracing rays', type=str, default=None)
+    parser.add_argument('--gbuffer-cache-mb', help='The size beyond which the least recently used G-buffers are evicted', type=int, default=1024)
+    parser.add_argument('--stats', help='Print a JSON report of the rays traced, the intersection tests and the time per phase', action='store_true')
+    parser.add_argument('--heatmap', help='The path of an image of the rays traced per pixel', type=str, default=None)
+    parser.add_argument('--backend', help='numba runs compiled loops over the scene arrays, numpy is used when numba is not installed', choices=BACKENDS, default='numpy')
+    parser.add_argument('--packets', help='Trace the primary and shadow rays in packets of this many rays, culling the shapes outside each packet\'s frustum, 0 for single rays', type=int, default=0)
+    parser.add_argument('--stream', help='Write the output (.png or .pfm) row of tiles by row of tiles as they are rendered, without keeping the whole image in memory', action='store_true')
+    parser.add_argument('--hdr', help='Keep the colors above 1 for tone mapping, a .pfm output stores them, the other formats are clipped', action='store_true')
+    parser.add_argument('--float32', help='Shade in float32 rather than float64, with the batch engine', action='store_true')
+    parser.add_argument('--accel', help='The acceleration structure for the ray-scene intersections', choices=['none', 'bvh', 'grid'], default='none')
     args = parser.parse_args()
+    if args.aa_samples < 1:
+        parser.error('--aa-samples must be at least 1')
+    if args.progressive:
+        reject_flags(parser, '--progressive', {'--workers': args.workers > 1, '--checkpoint': args.checkpoint is not None, '--stream': args.stream,
+                                               '--antialias': args.antialias, '--gbuffer-cache': args.gbuffer_cache is not None})
+    if args.checkpoint is not None:
+        # only the tiles rendered straight into the framebuffer are resumable
+        reject_flags(parser, '--checkpoint', {'--progressive': args.progressive, '--antialias': args.antialias,
+                                              '--gbuffer-cache': args.gbuffer_cache is not None, '--stream': args.stream})
+    if args.antialias:
+        # the edges are supersampled by the batch engine in this process
+        reject_flags(parser, '--antialias', {'--engine scalar': args.engine == 'scalar', '--workers': args.workers > 1, '--stream': args.stream,
+                                             '--gbuffer-cache': args.gbuffer_cache is not None})
+    if args.gbuffer_cache is not None:
+        # the G-buffers are the batch engine's generations, traced in this process
+        reject_flags(parser, '--gbuffer-cache', {'--engine scalar': args.engine == 'scalar', '--workers': args.workers > 1, '--stream': args.stream})
+    if args.engine is None:
+        args.engine = 'scalar'
 
     print(args)
-    camera, set_params, materials, lights, shapes = parse(args.scene,args.width,args.height)
+    scene = load_scene(args.scene, args.width, args.height)
+    scene.options = RenderOptions(shadow_sampling=args.shadow_sampling, min_throughput=args.min_throughput,
+                                  light_threshold=args.light_threshold, light_samples=args.light_samples, adaptive_shadow_rays=args.adaptive_shadow_rays,
+                                  shadow_early_out=args.shadow_early_out, hdr=args.hdr, float32=args.float32)
+    scene.backend = get_backend(args.backend)
+    if args.shadow_cache:
+        scene.shadow_cache = OccluderCache(scene.num_lights)
+
+    if args.accel == 'bvh':
+        from bvh import BVH
+        scene.accel = BVH(scene)
+        print(f'building the BVH took {scene.accel.build_time:.2f} seconds, {scene.accel.num_nodes} nodes')
+    elif args.accel == 'grid':
+        from grid import Grid
+        scene.accel = Grid(scene)
+        print(f'building the grid took {scene.accel.build_time:.2f} seconds, {scene.accel.resolution.tolist()} cells')
+
+    if args.packets > 0:
+        from packets import PacketTracer
+        scene.packets = PacketTracer(scene, args.packets)
+
+    if args.stats or args.heatmap:
+        scene.stats = RenderStats()
 
     start = time()
-    img = ray_cast(args.height, args.width, camera, set_params, materials, lights, shapes)
+    if args.progressive:
+        from progressive import render_progressive
+        img = render_progressive(args.height, args.width, scene, args.engine, args.tile_size, args.seed, max_passes=args.max_passes, tolerance=args.tolerance,
+                                 time_budget=args.time_budget, preview_path=args.output, preview_interval=args.preview_interval)
+    elif args.antialias:
+        from antialias import render_antialiased
+        img = render_antialiased(args.height, args.width, scene, args.tile_size, args.seed, args.aa_samples, args.aa_threshold)
+    elif args.gbuffer_cache:
+        from gbuffer import GBufferCache, render_with_gbuffer
+        img, reshaded = render_with_gbuffer(args.height, args.width, scene, GBufferCache(args.gbuffer_cache, args.gbuffer_cache_mb * 2 ** 20), args.tile_size, args.seed)
+        print('reshaded the cached G-buffer' if reshaded else 'traced the scene, its G-buffer is cached')
+    elif args.stream:
+        from parallel import render_tile_rows
+        writer_class = get_stream_writer(args.output)
+        img = None
+        with writer_class(args.output, args.height, args.width) as writer:
+            for rows in render_tile_rows(args.height, args.width, scene, args.engine, args.tile_size, args.workers, args.seed, writer_class.bottom_up):
+                writer.write_rows(rows)
+    else:
+        from parallel import render_tiles
+        img, done = None, None
+        if args.checkpoint:
+            from checkpoint import open_checkpoint, get_file_hash
+            settings = {'scene': get_file_hash(args.scene), 'engine': args.engine, **asdict(scene.options)}
+            img, done, args.seed = open_checkpoint(args.checkpoint, args.height, args.width, args.tile_size, args.seed, settings)
+            print(f'{done.sum()} of {len(done)} tiles are already rendered')
+        img = render_tiles(args.height, args.width, scene, args.engine, args.tile_size, args.workers, args.seed, img, done)
     print(f'rendering scene took {time() - start:.2f} seconds')
+    peak_rss_mb = get_peak_rss_mb()
+    if peak_rss_mb is not None:
+        print(f'peak memory {peak_rss_mb:.1f} MB')
+    if scene.accel is not None:
+        print(scene.accel.report())
+    if scene.packets is not None:
+        print(scene.packets.report())
+    if args.stats:
+        print(json.dumps(scene.stats.report(), indent=2))
+    if args.heatmap:
+        write_img(get_heatmap_colors(scene.stats.get_heatmap(args.height, args.width)), args.heatmap)
+
+    if img is not None:
+        save_image(img, args.output)
+
+
+def reject_flags(parser, mode, flags):
+    """
+    exit with a usage error if any of the flags a render mode doesn't support is given, rather than ignoring them
+
+    :param flags: a dict of the flags the mode doesn't support -> whether they're given
+    """
+    given = [flag for flag, is_given in flags.items() if is_given]
+    if given:
+        parser.error(f'{mode} does not support {", ".join(given)}')
+
+
+def ray_cast(height, width, scene, rng=np.random):
+    img = np.zeros([height, width, 3], dtype=np.float32)  # converted to uint8 before saving
+    img[:] = render_tile(0, width, 0, height, height, width, scene, rng)
 
-    write_img(img, args.output)
+    return img
 
 
-def ray_cast(height, width, camera, set_params, materials, lights, shapes):
-    img = np.zeros([height, width, 3], dtype=np.float32)  # converted to uint8 before saving
-    towards, up_perp, width_direction = get_viewing_window_vectors(camera)
-    for i in range(width):
-        print(i)
-        for j in range(height):
-            ray = construct_ray_through_pixel(camera, towards, up_perp, width_direction, (i/width-0.5)*camera.screen_width, (j/height-0.5)*camera.screen_height)
-            intersection_point, intersected_shape, intersected_shape_index = find_closest_intersection(ray, shapes)
-            img[height-1-j][i], _ = get_color(intersection_point, intersected_shape, intersected_shape_index, ray, set_params, materials, lights, shapes, set_params.max_recursions)
+def render_tile(x_start, x_end, y_start, y_end, height, width, scene, rng=np.random):
+    """
+    render the pixels i in [x_start, x_end), j in [y_start, y_end)
 
-    return img
+    :param scene: a compiled `scene.Scene`
+    :param rng: the source of the soft shadows' randomness, a np.random.Generator or the np.random module
+    :return: a [y_end - y_start, x_end - x_start, 3] float32 image of the tile, top row first
+    """
+    camera = scene.camera
+    tile = np.zeros([y_end - y_start, x_end - x_start, 3], dtype=np.float32)
+    towards, up_perp, width_direction = get_viewing_window_vectors(camera)
+    stats = scene.stats
+    costs = np.zeros(tile.shape[:2], dtype=int)
+    for i in range(x_start, x_end):
+        for j in range(y_start, y_end):
+            rays_before = 0 if stats is None else stats.total_rays
+            with timed(stats, 'primary'):
+                ray = construct_ray_through_pixel(camera, towards, up_perp, width_direction, (i/width-0.5)*camera.screen_width, (j/height-0.5)*camera.screen_height)
+                if stats is not None:
+                    stats.count_rays('primary', 1)
+                intersection_point, intersected_shape_index = find_closest_intersection(ray, scene)
+            with timed(stats, 'shading'):
+                tile[y_end-1-j][i-x_start], _ = get_color(intersection_point, intersected_shape_index, ray, scene, scene.set_params.max_recursions, rng=rng)
+            if stats is not None:
+                costs[y_end-1-j][i-x_start] = stats.total_rays - rays_before
+
+    if stats is not None:
+        stats.add_tile_costs(x_start, y_start, costs)
+    return tile
 
 
 def construct_ray_through_pixel(camera, towards, up_perp, width_direction, w, h):
@@ -52,117 +205,104 @@ def construct_ray_through_pixel(camera, towards, up_perp, width_direction, w, h)
                direction=ray_direction)
 
 
-def get_viewing_window_vectors(camera):
-    towards = camera.look_at - camera.position
-    towards = towards / np.linalg.norm(towards)
-    up_perp = camera.up - np.dot(camera.up, towards) / np.dot(towards, towards) * towards
-    up_perp = up_perp / np.linalg.norm(up_perp)
-    width_direction = np.cross(up_perp, towards)
-    width_direction = width_direction / np.linalg.norm(width_direction)
-    return towards, up_perp, width_direction
-
-
-def find_closest_intersection(ray, shapes):
-    best_intersection = None
-    best_shape = None
-    best_index = None
-    index = 0
-    for shape in shapes:
-        current_intersection = shape.find_intersection(ray)
-        if current_intersection is not False:
-            if np.dot(current_intersection-ray.origin, ray.direction) < 0:
-                # point is behind the ray
-                continue
-            if best_intersection is None:
-                best_intersection = current_intersection
-                best_shape = shape
-                best_index = index
-            else:
-                if np.linalg.norm(ray.origin-best_intersection) > np.linalg.norm(ray.origin-current_intersection):
-                    best_intersection = current_intersection
-                    best_shape = shape
-                    best_index = index
-        index += 1
-    return best_intersection, best_shape, best_index
-
-
-def get_color(intersection_point, intersected_shape, intersected_shape_index, ray, set_params, materials, lights, shapes, recursions_left):
+def find_closest_intersection(ray, scene, excluded=()):
+    """
+    :return: the closest intersection point and the index of its shape, or (None, None) if the ray hits nothing
+    """
+    distances, indices = scene.closest_hit(ray.origin[None], ray.direction[None], np.array(excluded, dtype=int).reshape(1, -1))
+    if indices[0] == NO_SHAPE:
+        return None, None
+    return ray.get_point(distances[0]), indices[0]
+
+
+def get_color(intersection_point, intersected_shape_index, ray, scene, recursions_left, excluded=(), rng=np.random):
+    """
+    :param excluded: indices of shapes which are ignored by all the rays cast from this call (see transparency)
+    :return: the color of the ray, and whether it hit the background
+    """
+    set_params = scene.set_params
     if recursions_left == 0:
         return set_params.background_rgb, True
 
     if intersection_point is None:
         return set_params.background_rgb, True
 
-    current_material = materials[intersected_shape.material-1]
+    if scene.stats is not None:
+        scene.stats.count_depths([set_params.max_recursions - recursions_left])
+
+    current_material = scene.shape_materials[intersected_shape_index]
+    transp = scene.material_transp[current_material]
 
     color_out = BLACK.copy()
-    shapes_without_current_object = None
+    excluded_with_current_object = excluded + (intersected_shape_index,)
+    shape_index = np.array([intersected_shape_index])
 
-    for light in lights:
-        light_direction = intersection_point - light.position
-        light_direction = light_direction/np.linalg.norm(light_direction)
-        light_ray = Ray(origin=light.position, direction=light_direction)
-        light_intersection_point, light_intersected_shape, light_intersected_shape_index = find_closest_intersection(light_ray, shapes)
-        light_hit_different_object = False
+    surface_normal = scene.get_normals(shape_index, intersection_point[None])[0]
 
-        if light_intersection_point is None:
-            # skip if the light does not reach any object
+    light_weights, shadow_roots = select_lights(scene, intersection_point[None], surface_normal[None], np.array([current_material]), rng)
+    for light in range(scene.num_lights):
+        if light_weights[light, 0] == 0:
+            continue
+        light_position = scene.light_positions[light]
+        light_direction = intersection_point - light_position
+        light_distance = np.linalg.norm(light_direction)
+        light_direction = light_direction/light_distance
+        light_ray = Ray(origin=light_position, direction=light_direction)
+
+        if scene.get_distances(shape_index, light_position[None], light_ray.direction[None])[0] < light_distance - atol:
+            # skip if the light hit the other side of the shape, occlusion by other shapes is handled by the soft shadows
             continue
-
-        if not np.all(is_close(light_intersection_point, intersection_point)):
-            if light_intersected_shape_index == intersected_shape_index:
-                # skip if the light hit the other side of the shape
-                continue
-            light_hit_different_object = True
 
         # diffuse coloring
-        surface_normal = intersected_shape.normal_at_point(light_intersection_point)
-        diffuse_color = current_material.diffuse_rgb * np.abs(np.dot(surface_normal, -light_direction))
+        diffuse_color = scene.material_diffuse[current_material] * np.abs(np.dot(surface_normal, -light_direction))
 
         # specular coloring
         reflect_direction = get_reflected_vector(light_direction, surface_normal)
-        specular_color = current_material.specular_rgb * np.power(np.abs(np.dot(reflect_direction, -ray.direction)), current_material.phong) * light.specular_intens
+        specular_color = scene.material_specular[current_material] * np.power(np.abs(np.dot(reflect_direction, -ray.direction)), scene.material_phong[current_material]) * scene.light_specular_intens[light]
 
         # soft shadows
-        perc_rays_hit = get_soft_shadow_perc_rays_hit(light_ray, set_params.root_shadow_rays, light.radius, intersection_point, shapes)
-        light_intensity = (1-light.shadow_intens)*1 + light.shadow_intens*perc_rays_hit
+        with timed(scene.stats, 'shadow'):
+            perc_rays_hit = get_soft_shadow_perc_rays_hit(light_ray, shadow_roots[light, 0], scene.light_radius[light], intersection_point, scene, excluded, rng, scene.options.shadow_sampling, light)
+        light_intensity = ((1-scene.light_shadow_intens[light])*1 + scene.light_shadow_intens[light]*perc_rays_hit) * light_weights[light, 0]
 
         # transparency
-        if current_material.transp > 0:
-            if shapes_without_current_object is None:
-                if len(shapes) == 0:
-                    shapes_without_current_object = shapes
-                else:
-                    shapes_without_current_object = shapes.copy()
-                    del shapes_without_current_object[light_intersected_shape_index]
-
-            inner_intersection_point, inner_intersected_shape, inner_intersected_shape_index = find_closest_intersection(ray, shapes_without_current_object)
-            back_color, hit_background = get_color(inner_intersection_point, inner_intersected_shape, inner_intersected_shape_index, ray, set_params, materials, lights, shapes_without_current_object, recursions_left)
+        if transp > 0:
+            if scene.stats is not None:
+                scene.stats.count_rays('transmission', 1)
+            with timed(scene.stats, 'transmission'):
+                inner_intersection_point, inner_intersected_shape_index = find_closest_intersection(ray, scene, excluded_with_current_object)
+            back_color, hit_background = get_color(inner_intersection_point, inner_intersected_shape_index, ray, scene, recursions_left, excluded_with_current_object, rng)
             if not hit_background:
-                back_color = back_color * light.rgb
+                back_color = back_color * scene.light_rgb[light]
         else:
             back_color = BLACK.copy()
 
-        cur_light_color_out = light.rgb * (diffuse_color + specular_color) * (1 - current_material.transp) + current_material.transp * back_color
+        cur_light_color_out = scene.light_rgb[light] * (diffuse_color + specular_color) * (1 - transp) + transp * back_color
         color_out += cur_light_color_out * light_intensity
 
 
     # reflectance coloring
     # cast a new ray in the reflected direction
-    reflected_direction = get_reflected_vector(ray.direction, intersected_shape.normal_at_point(intersection_point))
+    reflected_direction = get_reflected_vector(ray.direction, surface_normal)
     reflected_ray = Ray(intersection_point, reflected_direction)
-    shapes_without_current_object = shapes[:intersected_shape_index] + shapes[intersected_shape_index + 1:]
-    ref_intersection_point, ref_intersected_shape, ref_intersected_shape_index = find_closest_intersection(reflected_ray, shapes_without_current_object)
+    if scene.stats is not None:
+        scene.stats.count_rays('reflection', 1)
+    with timed(scene.stats, 'reflection'):
+        ref_intersection_point, ref_intersected_shape_index = find_closest_intersection(reflected_ray, scene, excluded_with_current_object)
     # if ref_intersection_point is not None:
-    reflected_color, _ = get_color(ref_intersection_point, ref_intersected_shape, ref_intersected_shape_index, reflected_ray, set_params, materials, lights, shapes, recursions_left - 1)
-    color_out += np.multiply(current_material.reflect_rgb, reflected_color)
+    reflected_color, _ = get_color(ref_intersection_point, ref_intersected_shape_index, reflected_ray, scene, recursions_left - 1, excluded, rng)
+    color_out += np.multiply(scene.material_reflect[current_material], reflected_color)
 
-    color_out[color_out > 1] = 1
+    if not scene.options.hdr:
+        color_out[color_out > 1] = 1
 
     return color_out, False
 
 
-def get_soft_shadow_perc_rays_hit(light_ray, num_shadow_rays, radius, intersection_point, shapes):
+def get_soft_shadow_perc_rays_hit(light_ray, num_shadow_rays, radius, intersection_point, scene, excluded=(), rng=np.random, sampling='jitter', light=0):
+    """
+    :param light: the index of the light, for the scene's occluder cache
+    """
     # Find a plane which is perpendicular to the ray
     axis_one = np.array([0,0,1])
     if np.all(is_close(axis_one, light_ray.direction)):
@@ -173,33 +313,27 @@ def get_soft_shadow_perc_rays_hit(light_ray, num_shadow_rays, radius, intersecti
     axis_two = np.cross(axis_one, light_ray.direction)
     axis_two = axis_two / np.linalg.norm(axis_two)
 
-    light_hit_counter = 0
-
-    # Define a rectangle & divide the rectangle into a grid of N x N cells
-    rand_width = radius / num_shadow_rays
-    for i in np.linspace(-radius/2+rand_width/2,radius/2-rand_width/2,num_shadow_rays):
-        for j in np.linspace(-radius/2+rand_width/2,radius/2-rand_width/2,num_shadow_rays):
-            #  we select a random point in each cell (by uniformly sampling x value and y value)
-            i_perturbation = i + np.random.uniform() * rand_width - rand_width / 2
-            j_perturbation = j + np.random.uniform() * rand_width - rand_width / 2
-
-            # perturbation cell center calculation
-            current_cell_center = light_ray.origin + axis_one * i_perturbation + axis_two * j_perturbation
-
-            light_direction = intersection_point - current_cell_center
-            light_direction = light_direction / np.linalg.norm(light_direction)
-            new_light_ray = Ray(origin=current_cell_center, direction=light_direction)
-            light_intersection_point, light_intersected_shape, _ = find_closest_intersection(new_light_ray, shapes)
-
-            # skip if the light does not reach the intersection point
-            if light_intersection_point is None:
-                continue
-            if not np.all(is_close(light_intersection_point, intersection_point)):
-                continue
-
-            light_hit_counter += 1
-
-    return light_hit_counter/(num_shadow_rays*num_shadow_rays)
+    # sample all the N x N points on the light at once, and trace them as one batch
+    offsets = get_shadow_sample_offsets(num_shadow_rays, radius, rng, sampling)
+    excluded = np.array(excluded, dtype=int)
+    if scene.options.shadow_early_out and len(offsets) > len(PROBE_OFFSETS) and radius > 0:
+        # out of the penumbra when the light's corners agree
+        perc_probes_hit, unresolved = probe_shadows(light, light_ray.origin, axis_one[None], axis_two[None], radius, intersection_point[None], scene, excluded[None])
+        if len(unresolved) == 0:
+            return perc_probes_hit[0]
+    sample_points = light_ray.origin + axis_one * offsets[:, 0:1] + axis_two * offsets[:, 1:2]
+
+    light_directions = intersection_point - sample_points
+    light_distances = np.linalg.norm(light_directions, axis=1)
+    light_directions = light_directions / light_distances[:, None]
+
+    # count only the rays which nothing blocks before the intersection point
+    excluded = np.broadcast_to(excluded, (len(sample_points), len(excluded)))
+    if scene.stats is not None:
+        scene.stats.count_rays('shadow', len(sample_points))
+    occluded = find_shadow_occlusions(light, sample_points, light_directions, light_distances - atol, scene, excluded)
+
+    return np.sum(~occluded)/(num_shadow_rays*num_shadow_rays)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,148 @@
+import argparse
+from dataclasses import replace
+from multiprocessing import Pool
+from time import time
+
+import numpy as np
+
+from parallel import render_tiles
+from scene_file import load_scene
+from utils import write_img
+
+_worker_render = None  # set once per worker process by `_init_worker`
+
+
+def parse_camera_path(path):
+    """
+    read a camera path, one keyframe per line: frame px py pz lx ly lz [ux uy uz]
+
+    :return: a list of (frame, position, look_at, up) keyframes sorted by frame, up is None when the line omits it
+    """
+    keyframes = []
+    with open(path, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+
+            values = [float(v) for v in line.split()]
+            up = np.array(values[7:10]) if len(values) >= 10 else None
+            keyframes.append((int(values[0]), np.array(values[1:4]), np.array(values[4:7]), up))
+
+    return sorted(keyframes, key=lambda keyframe: keyframe[0])
+
+
+def interpolate_cameras(camera, keyframes):
+    """
+    the camera of every frame from the first keyframe to the last, positions, look_at and up are interpolated linearly
+
+    :param camera: the scene's camera, its screen and its up (for keyframes without one) are kept
+    :return: a list of cameras, one per frame
+    """
+    frames = np.array([keyframe[0] for keyframe in keyframes])
+    positions = np.array([keyframe[1] for keyframe in keyframes])
+    look_ats = np.array([keyframe[2] for keyframe in keyframes])
+    ups = np.array([camera.up if keyframe[3] is None else keyframe[3] for keyframe in keyframes])
+
+    cameras = []
+    for frame in range(frames[0], frames[-1] + 1):
+        position, look_at, up = (np.array([np.interp(frame, frames, values[:, axis]) for axis in range(3)])
+                                 for values in (positions, look_ats, ups))
+        cameras.append(replace(camera, position=position, look_at=look_at, up=up))
+
+    return cameras
+
+
+def get_frame_seed(seed, frame):
+    return int(np.random.SeedSequence([seed, frame]).generate_state(1)[0])
+
+
+def render_animation(height, width, scene, cameras, output_pattern, engine='batch', tile_size=64, workers=1, seed=None, reproject=False, first_frame=0):
+    """
+    render a frame per camera, reusing the compiled scene and its acceleration structure.
+    with more than one worker, the frames are spread over a pool of processes, each renders and writes whole frames
+
+    :param output_pattern: the frames' paths, formatted with the frame's number e.g. 'frame_%04d.png'
+    :param seed: the seed of the soft shadows' randomness, each frame gets its own seed derived from it
+    :param reproject: render the frames in order with the batch engine in this process, each reusing the soft shadows
+                      of the hits the previous frame saw (see `reprojection.render_reprojected`)
+    :param first_frame: the number of the first camera's frame in the camera path, the next cameras' frames follow it
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    if reproject:
+        from reprojection import ReprojectionCache, render_reprojected
+        cache = ReprojectionCache()
+        for frame, camera in enumerate(cameras, first_frame):
+            start = time()
+            reprojected_hits, primary_hits = cache.reprojected_hits, cache.primary_hits
+            scene.camera = camera
+            write_img(render_reprojected(height, width, scene, cache, tile_size, get_frame_seed(seed, frame)), output_pattern % frame)
+            reused = (cache.reprojected_hits - reprojected_hits) / max(cache.primary_hits - primary_hits, 1)
+            print(f'frame {frame} took {time() - start:.2f} seconds, {reused:.0%} of its hits reprojected')
+        return
+
+    frames = list(enumerate(cameras, first_frame))
+    worker_args = (height, width, scene, output_pattern, engine, tile_size, seed)
+    if workers <= 1:
+        _init_worker(*worker_args)
+        for frame, render_time in map(_render_frame_task, frames):
+            print(f'frame {frame} took {render_time:.2f} seconds')
+        return
+
+    with Pool(workers, initializer=_init_worker, initargs=worker_args) as pool:
+        for frame, render_time in pool.imap_unordered(_render_frame_task, frames, chunksize=1):
+            print(f'frame {frame} took {render_time:.2f} seconds')
+
+
+def _init_worker(height, width, scene, output_pattern, engine, tile_size, seed):
+    global _worker_render
+    _worker_render = (height, width, scene, output_pattern, engine, tile_size, seed)
+
+
+def _render_frame_task(indexed_camera):
+    frame, camera = indexed_camera
+    height, width, scene, output_pattern, engine, tile_size, seed = _worker_render
+    start = time()
+    scene.camera = camera
+    img = render_tiles(height, width, scene, engine, tile_size, seed=get_frame_seed(seed, frame))
+    write_img(img, output_pattern % frame)
+
+    return frame, time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='render a camera path through a 3D scene to a sequence of images')
+    parser.add_argument('scene',  help='The input scene definition path', type=str)
+    parser.add_argument('path',   help='The camera path, one keyframe per line: frame px py pz lx ly lz [ux uy uz]', type=str)
+    parser.add_argument('output', help='The frames\' paths pattern, e.g. frame_%%04d.png', type=str)
+    parser.add_argument('width',  help='The output images\' width',  type=int, nargs='?', default=500)
+    parser.add_argument('height', help='The output images\' height', type=int, nargs='?', default=500)
+    parser.add_argument('--engine', help='scalar traces one ray at a time, batch traces a tile of rays at a time', choices=['scalar', 'batch'], default='batch')
+    parser.add_argument('--tile-size', help='The side of the square tiles the frames are rendered in', type=int, default=64)
+    parser.add_argument('--workers', help='The number of processes rendering frames in parallel', type=int, default=1)
+    parser.add_argument('--seed', help='The seed of the soft shadows, each frame\'s seed is derived from it and the frame\'s number', type=int, default=None)
+    parser.add_argument('--accel', help='The acceleration structure for the ray-scene intersections, built once for all the frames', choices=['none', 'bvh', 'grid'], default='none')
+    parser.add_argument('--reproject', help='Reuse the soft shadows of the hits the previous frame saw, the frames are rendered in order by one process', action='store_true')
+    args = parser.parse_args()
+
+    start = time()
+    scene = load_scene(args.scene, args.width, args.height)
+    if args.accel == 'bvh':
+        from bvh import BVH
+        scene.accel = BVH(scene)
+    elif args.accel == 'grid':
+        from grid import Grid
+        scene.accel = Grid(scene)
+    keyframes = parse_camera_path(args.path)
+    cameras = interpolate_cameras(scene.camera, keyframes)
+    print(f'setting up the scene took {time() - start:.2f} seconds, rendering {len(cameras)} frames')
+
+    start = time()
+    render_animation(args.height, args.width, scene, cameras, args.output, args.engine, args.tile_size, args.workers, args.seed, args.reproject, keyframes[0][0])
+    print(f'rendering the animation took {time() - start:.2f} seconds')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+from math import isqrt
+
+import numpy as np
+
+from batch import trace_pixels
+from parallel import split_tiles
+
+MAX_SAMPLES_PER_BATCH = 2 ** 14  # bounds the memory of the supersampling batches
+
+
+def render_antialiased(height, width, scene, tile_size=64, seed=None, max_samples=10, contrast_threshold=0.1):
+    """
+    render the image with adaptive supersampling, using the batch engine
+
+    every pixel is first traced with one sample. the pixels on edges, whose color differs from a neighbour's by more than
+    `contrast_threshold` in some channel or whose primary ray hit another shape than a neighbour's, are then traced again
+    with a jittered k x k grid of subpixel samples, k = isqrt(max_samples - 1), and get the mean of all their samples
+
+    :param seed: the seed of the soft shadows' and the jitter's randomness, None for a random seed
+    :param max_samples: the most samples per pixel
+    :return: a [height, width, 3] float32 image
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    stats = scene.stats
+
+    img = np.zeros([height, width, 3], dtype=np.float32)
+    shape_ids = np.zeros([height, width], dtype=int)
+    for tile_index, (x_start, x_end, y_start, y_end) in enumerate(split_tiles(height, width, tile_size)):
+        j, i = np.mgrid[y_end - 1:y_start - 1:-1, x_start:x_end]
+        colors, indices = trace_pixels(i.ravel(), j.ravel(), height, width, scene, np.random.default_rng([seed, 0, tile_index]))
+        img[height - y_end:height - y_start, x_start:x_end] = colors.reshape(i.shape + (3,))
+        shape_ids[height - y_end:height - y_start, x_start:x_end] = indices.reshape(i.shape)
+        if stats is not None:
+            stats.add_tile_costs(x_start, y_start, stats.pixel_costs.reshape(i.shape))
+
+    grid_size = isqrt(max_samples - 1)
+    rows, columns = np.nonzero(find_edges(img, shape_ids, contrast_threshold))
+    if grid_size == 0 or len(rows) == 0:
+        return img
+
+    # the jittered grid's cells, centered on the pixel's first sample
+    cells = (np.stack(np.meshgrid(np.arange(grid_size), np.arange(grid_size), indexing='ij'), axis=-1).reshape(-1, 2) + 0.5) / grid_size - 0.5
+    edge_costs = np.zeros([height, width], dtype=int)
+    chunk_size = max(1, MAX_SAMPLES_PER_BATCH // len(cells))
+    for chunk_index, start in enumerate(range(0, len(rows), chunk_size)):
+        chunk_rows, chunk_columns = rows[start:start + chunk_size], columns[start:start + chunk_size]
+        rng = np.random.default_rng([seed, 1, chunk_index])
+        offsets = cells + (rng.uniform(size=(len(chunk_rows), len(cells), 2)) - 0.5) / grid_size
+        i = chunk_columns[:, None] + offsets[..., 0]
+        j = height - 1 - chunk_rows[:, None] + offsets[..., 1]
+        colors, _ = trace_pixels(i.ravel(), j.ravel(), height, width, scene, rng)
+
+        sample_sums = img[chunk_rows, chunk_columns] + colors.reshape(len(chunk_rows), len(cells), 3).sum(axis=1)
+        img[chunk_rows, chunk_columns] = sample_sums / (len(cells) + 1)
+        if stats is not None:
+            edge_costs[chunk_rows, chunk_columns] = stats.pixel_costs.reshape(len(chunk_rows), len(cells)).sum(axis=1)
+
+    if stats is not None:
+        stats.add_tile_costs(0, 0, edge_costs)
+    return img
+
+
+def find_edges(img, shape_ids, contrast_threshold):
+    """
+    :param img: a [height, width, 3] image
+    :param shape_ids: [height, width] the shapes the pixels' primary rays hit
+    :return: [height, width] whether each pixel differs from one of its 4 neighbours, both pixels of a differing pair are marked
+    """
+    edges = np.zeros(shape_ids.shape, dtype=bool)
+    for axis in (0, 1):
+        differ = np.any(np.abs(np.diff(img, axis=axis)) > contrast_threshold, axis=-1) | (np.diff(shape_ids, axis=axis) != 0)
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (0, 1)
+        edges |= np.pad(differ, pad)
+        pad[axis] = (1, 0)
+        edges |= np.pad(differ, pad)
+
+    return edges
@@ -0,0 +1,438 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from lights import select_lights
+from shadows import find_shadow_occlusions, probe_shadows, PROBE_OFFSETS
+from sampling import get_shadow_sample_offsets
+from scene import NO_SHAPE
+from stats import timed
+from utils import atol, get_reflected_vectors, get_viewing_window_vectors, normalize_rows
+
+MAX_SHADOW_RAYS_PER_BATCH = 2 ** 16  # bounds the memory of the soft shadows' batches
+
+# the kinds of rays spawned by a hit
+TRANSMISSION = 0
+REFLECTION   = 1
+
+
+def ray_cast_batch(height, width, scene, tile_size=64, rng=np.random):
+    """
+    render the scene like `RayTracer.ray_cast`, tracing a whole tile of rays at a time
+
+    :param scene: a compiled `scene.Scene`
+    :param tile_size: the side of the square tiles the frame is split to, None renders the frame in a single batch
+    :param rng: the source of the soft shadows' randomness, a np.random.Generator or the np.random module
+    :return: a [height, width, 3] float32 image
+    """
+    img = np.zeros([height, width, 3], dtype=np.float32)  # converted to uint8 before saving
+    tile_size = tile_size or max(height, width)
+    for x_start in range(0, width, tile_size):
+        for y_start in range(0, height, tile_size):
+            x_end = min(x_start + tile_size, width)
+            y_end = min(y_start + tile_size, height)
+            colors = render_tile_batch(x_start, x_end, y_start, y_end, height, width, scene, rng)
+            img[height - y_end:height - y_start, x_start:x_end] = colors
+
+    return img
+
+
+def render_tile_batch(x_start, x_end, y_start, y_end, height, width, scene, rng=np.random):
+    """
+    render the pixels i in [x_start, x_end), j in [y_start, y_end) (in `ray_cast`'s notation)
+
+    :return: a [y_end - y_start, x_end - x_start, 3] float32 image of the tile, top row first
+    """
+    j, i = np.mgrid[y_end - 1:y_start - 1:-1, x_start:x_end]
+    colors, _ = trace_pixels(i.ravel(), j.ravel(), height, width, scene, rng)
+
+    if scene.stats is not None:
+        scene.stats.add_tile_costs(x_start, y_start, scene.stats.pixel_costs.reshape(i.shape))
+
+    return colors.reshape(i.shape + (3,)).astype(np.float32)
+
+
+def trace_pixels(i, j, height, width, scene, rng=np.random):
+    """
+    trace a primary ray through each of the given points of the screen, and shade it
+
+    :param i: (N,) horizontal pixel coordinates, fractional ones sample between the pixels
+    :param j: (N,) vertical pixel coordinates, counted from the bottom
+    :return: (N,3) colors and (N,) indices of the shapes the primary rays hit (NO_SHAPE for none)
+    """
+    generations = trace_pixel_generations(i, j, height, width, scene, rng)
+    with timed(scene.stats, 'shading'):
+        colors, _ = resolve_generations(generations, scene)
+
+    indices = np.full(len(i), NO_SHAPE)
+    indices[generations[0].hit] = generations[0].indices
+    return colors, indices
+
+
+def trace_pixel_generations(i, j, height, width, scene, rng=np.random):
+    """
+    trace a primary ray through each of the given points of the screen (see `trace_pixels`), and the rays they spawn
+
+    :return: the generations of the rays, see `trace_generations`
+    """
+    with timed(scene.stats, 'primary'):
+        origins, directions, distances, indices, excluded = trace_primary_rays(i, j, height, width, scene)
+
+    with timed(scene.stats, 'shading'):
+        return trace_generations(origins, directions, distances, indices, scene, scene.set_params.max_recursions, excluded, rng)
+
+
+def trace_primary_rays(i, j, height, width, scene):
+    """
+    find the closest hits of the primary rays through the given points of the screen (see `trace_pixels`)
+
+    :return: (N,3) origins, (N,3) directions, (N,) distances and (N,) indices of the hits (see `find_closest_intersections`),
+             and the (N,0) shapes the rays ignore
+    """
+    camera = scene.camera
+    stats = scene.stats
+    towards, up_perp, width_direction = get_viewing_window_vectors(camera)
+    origins, directions = construct_rays_through_pixels(camera, towards, up_perp, width_direction,
+                                                        (i / width - 0.5) * camera.screen_width,
+                                                        (j / height - 0.5) * camera.screen_height)
+    excluded = np.full((len(origins), 0), NO_SHAPE)
+    if stats is not None:
+        stats.count_rays('primary', len(origins))
+        stats.pixel_costs = np.ones(len(origins), dtype=int)
+    if scene.packets is None:
+        distances, indices = find_closest_intersections(origins, directions, scene, excluded)
+    else:
+        distances, indices = scene.packets.closest_hit_pixels(i, j, origins, directions, excluded)
+
+    return origins, directions, distances, indices, excluded
+
+
+def construct_rays_through_pixels(camera, towards, up_perp, width_direction, ws, hs):
+    """
+    batched version of `RayTracer.construct_ray_through_pixel`
+
+    :param ws: (N,) horizontal offsets on the screen
+    :param hs: (N,) vertical offsets on the screen
+    :return: (N,3) origins and (N,3) normalized directions
+    """
+    target_points = camera.position + towards*camera.screen_dist + up_perp*hs[:, None] + width_direction*ws[:, None]
+    directions = normalize_rows(target_points - camera.position)
+    origins = np.broadcast_to(camera.position, directions.shape)
+
+    return origins, directions
+
+
+def find_closest_intersections(origins, directions, scene, excluded):
+    """
+    batched version of `RayTracer.find_closest_intersection`
+
+    :param origins: (N,3) ray origins
+    :param directions: (N,3) normalized ray directions
+    :param excluded: (N,K) indices of shapes to ignore per ray, padded with NO_SHAPE
+    :return: (N,) distances to the closest intersections (np.inf for none) and (N,) indices of the hit shapes (NO_SHAPE for none)
+    """
+    return scene.closest_hit(origins, directions, excluded)
+
+
+@dataclass
+class Generation:
+    """
+    one generation of the wavefront: the geometry and the visibility of its hits,
+    everything their shading needs besides the materials and the lights' colors and intensities.
+    N rays, M of which hit a shape, L lights and S rays spawned for the next generation
+    """
+    hit:           np.ndarray  # (N,) which rays hit a shape, with recursions left
+    indices:       np.ndarray  # (M,) the hit shapes
+    points:        np.ndarray  # (M,3) the hit points
+    directions:    np.ndarray  # (M,3) the directions of the rays which hit
+    normals:       np.ndarray  # (M,3) the shapes' normals at the hit points
+    reached:       np.ndarray  # (L,M) whether each light reaches the hit's side of its shape
+    perc_rays_hit: np.ndarray  # (L,M) the fraction of each light's shadow rays which reach the hit, 0 where it isn't reached
+    light_weights: np.ndarray  # (L,M) the weight of each light in the hit's color (see `lights.select_lights`)
+    throughputs:   np.ndarray  # (M,) the hits' weights in the primary rays' colors
+    parents:       np.ndarray = None  # (S,) the hits the spawned rays come from
+    kinds:         np.ndarray = None  # (S,) TRANSMISSION or REFLECTION
+
+
+def trace_generations(origins, directions, distances, indices, scene, recursions_left, excluded, rng=np.random, cached_perc_rays_hit=None):
+    """
+    trace the rays a generation at a time: the transparency and reflection rays spawned by a generation's hits
+    form the next generation. the spawned rays carry their throughput (their weight in the color of the ray they
+    come from), those below `options.min_throughput` are not traced.
+    the generations record the geometry and visibility of their hits, `resolve_generations` shades them.
+    together they're the batched version of `RayTracer.get_color`, traced as a wavefront instead of recursively
+
+    :param distances: (N,) distances to the rays' closest intersections
+    :param indices: (N,) indices of the intersected shapes (NO_SHAPE for none)
+    :param recursions_left: the reflections the rays may still bounce
+    :param excluded: (N,K) indices of shapes which are ignored by all the given rays, padded with NO_SHAPE
+    :param cached_perc_rays_hit: (L,N) soft shadows of the given rays' hits known beforehand, NaN for the ones to trace (see `trace_generation`)
+    :return: a list of `Generation`s, the first one of the given rays
+    """
+    rays = (origins, directions, distances, indices, excluded, np.full(len(origins), recursions_left), np.ones(len(origins)), np.arange(len(origins)))
+    generations = []
+    while True:
+        generation, rays = trace_generation(*rays, scene, rng, cached_perc_rays_hit)
+        cached_perc_rays_hit = None
+        generations.append(generation)
+        if len(rays[0]) == 0:
+            return generations
+
+
+def resolve_generations(generations, scene):
+    """
+    shade the generations' hits, and combine their colors bottom up, each hit's color clamped like in the recursive version (unless `options.hdr`)
+
+    :return: (N,3) colors and (N,) whether each ray of the first generation hit the background
+    """
+    dtype = np.float32 if scene.options.float32 else np.float64
+    # the colors of the generation below the current one, empty below the last
+    colors, hit_background = np.empty((0, 3), dtype=dtype), np.empty(0, dtype=bool)
+    for generation in reversed(generations):
+        direct_colors, back_coefs_background, back_coefs_hit, reflect_rgb = (terms.astype(dtype, copy=False) for terms in shade_generation(generation, scene))
+        back_colors = np.zeros_like(direct_colors)
+        back_hit_background = np.ones(len(direct_colors), dtype=bool)
+        reflected_colors = np.zeros_like(direct_colors)
+
+        parents, transmitted = generation.parents, generation.kinds == TRANSMISSION
+        back_colors[parents[transmitted]] = colors[transmitted]
+        back_hit_background[parents[transmitted]] = hit_background[transmitted]
+        reflected_colors[parents[~transmitted]] = colors[~transmitted]
+
+        # a back color which hit a shape is lit by each light, see `shade_generation`
+        back_coefs = np.where(back_hit_background[:, None], back_coefs_background, back_coefs_hit)
+        color_out = direct_colors + back_coefs * back_colors + reflect_rgb * reflected_colors
+        if not scene.options.hdr:
+            color_out[color_out > 1] = 1
+
+        colors = np.empty((len(generation.hit), 3), dtype=dtype)
+        colors[:] = scene.set_params.background_rgb
+        colors[generation.hit] = color_out
+        hit_background = ~generation.hit
+
+    return colors, hit_background
+
+
+def trace_generation(origins, directions, distances, indices, excluded, recursions_left, throughputs, pixels, scene, rng=np.random, cached_perc_rays_hit=None):
+    """
+    find the visibility of one generation's hits, and trace the next generation
+
+    :param recursions_left: (N,) the reflections each ray may still bounce
+    :param throughputs: (N,) the rays' weights in the primary rays' colors
+    :param pixels: (N,) the indices of the primary rays the rays come from
+    :param cached_perc_rays_hit: (L,N) the fraction of each light's shadow rays which reach each ray's hit, e.g. reprojected from
+                                 the previous frame (see `reprojection`), their shadow rays aren't traced. NaN for the ones to trace
+    :return: the `Generation`, and the spawned rays in the arguments' order
+    """
+    set_params = scene.set_params
+    hit = (indices != NO_SHAPE) & (recursions_left > 0)
+    origins, directions, distances, indices = origins[hit], directions[hit], distances[hit], indices[hit]
+    excluded, recursions_left, throughputs, pixels = excluded[hit], recursions_left[hit], throughputs[hit], pixels[hit]
+    if cached_perc_rays_hit is not None:
+        cached_perc_rays_hit = cached_perc_rays_hit[:, hit]
+    stats = scene.stats
+    if stats is not None:
+        stats.count_depths(set_params.max_recursions - recursions_left)
+    points = origins + distances[:, None] * directions
+    excluded_with_current_object = np.concatenate([excluded, indices[:, None]], axis=1)
+    surface_normals = scene.get_normals(indices, points)
+
+    light_weights, shadow_roots = select_lights(scene, points, surface_normals, scene.shape_materials[indices], rng)
+    reached = np.zeros((scene.num_lights, len(points)), dtype=bool)
+    perc_rays_hit = np.zeros((scene.num_lights, len(points)))
+    for light in range(scene.num_lights):
+        selected = np.flatnonzero(light_weights[light] > 0)
+        light_position = scene.light_positions[light]
+        light_directions = points[selected] - light_position
+        light_distances = np.linalg.norm(light_directions, axis=1)
+        light_directions = light_directions / light_distances[:, None]
+        light_origins = np.broadcast_to(light_position, light_directions.shape)
+
+        # skip if the light hit the other side of the shape, occlusion by other shapes is handled by the soft shadows
+        reached[light, selected] = ~(scene.get_distances(indices[selected], light_origins, light_directions) < light_distances - atol)
+        lit = reached[light, selected]
+        if not np.any(lit):
+            continue
+
+        # soft shadows, the hits sharing a number of shadow rays are traced together
+        lit_hits, light_directions = selected[lit], light_directions[lit]
+        if cached_perc_rays_hit is not None:
+            cached = ~np.isnan(cached_perc_rays_hit[light, lit_hits])
+            perc_rays_hit[light, lit_hits[cached]] = cached_perc_rays_hit[light, lit_hits[cached]]
+            lit_hits, light_directions = lit_hits[~cached], light_directions[~cached]
+        roots = shadow_roots[light, lit_hits]
+        for root in np.unique(roots):
+            group = roots == root
+            with timed(stats, 'shadow'):
+                perc_rays_hit[light, lit_hits[group]] = get_soft_shadow_perc_rays_hit_batch(light, light_position, light_directions[group], root,
+                                                                                            scene.light_radius[light], points[lit_hits[group]], scene,
+                                                                                            excluded[lit_hits[group]], rng, scene.options.shadow_sampling)
+        if stats is not None:
+            np.add.at(stats.pixel_costs, pixels[lit_hits], roots ** 2)
+
+    generation = Generation(hit, indices, points, directions, surface_normals, reached, perc_rays_hit, light_weights, throughputs)
+    generation.parents, generation.kinds, spawned_throughputs = get_spawned_rays(generation, scene)
+
+    transmitted = generation.parents[generation.kinds == TRANSMISSION]
+    reflective = generation.parents[generation.kinds == REFLECTION]
+    spawned_origins = np.concatenate([origins[transmitted], points[reflective]])
+    spawned_directions = np.concatenate([directions[transmitted],
+                                         normalize_rows(get_reflected_vectors(directions[reflective], surface_normals[reflective]))])
+    spawned_recursions_left = np.concatenate([recursions_left[transmitted], recursions_left[reflective] - 1])
+    spawned_pixels = pixels[generation.parents]
+    # the transparency ray keeps ignoring the current shape, the reflected ray ignores it only for its first hit
+    spawned_excluded = compact_excluded(np.concatenate([excluded_with_current_object[transmitted],
+                                                        np.pad(excluded[reflective], ((0, 0), (0, 1)), constant_values=NO_SHAPE)]))
+
+    # rays out of recursions hit the background, there is no need to trace them
+    spawned_distances = np.full(len(generation.parents), np.inf)
+    spawned_indices = np.full(len(generation.parents), NO_SHAPE)
+    for kind, phase in ((TRANSMISSION, 'transmission'), (REFLECTION, 'reflection')):
+        traced = np.flatnonzero((spawned_recursions_left > 0) & (generation.kinds == kind))
+        if stats is not None:
+            stats.count_rays(phase, len(traced))
+            np.add.at(stats.pixel_costs, spawned_pixels[traced], 1)
+        with timed(stats, phase):
+            spawned_distances[traced], spawned_indices[traced] = find_closest_intersections(spawned_origins[traced], spawned_directions[traced], scene,
+                                                                                            excluded_with_current_object[generation.parents[traced]])
+
+    rays = (spawned_origins, spawned_directions, spawned_distances, spawned_indices, spawned_excluded, spawned_recursions_left, spawned_throughputs, spawned_pixels)
+    return generation, rays
+
+
+def get_spawned_rays(generation, scene):
+    """
+    the transparency is traced only where it's lit, the reflection only where it's visible,
+    and neither where their throughput is below `options.min_throughput`
+
+    :return: (S,) parents, kinds and throughputs of the rays a generation's hits spawn
+    """
+    material_indices = scene.shape_materials[generation.indices]
+    transp = scene.material_transp[material_indices]
+    reflect_rgb = scene.material_reflect[material_indices]
+    min_throughput = scene.options.min_throughput
+
+    transmitted_throughputs = generation.throughputs * transp
+    transmitted = (transp > 0) & np.any(generation.reached, axis=0) & (transmitted_throughputs >= min_throughput)
+    reflected_throughputs = generation.throughputs * np.max(reflect_rgb, axis=1)
+    reflective = np.any(reflect_rgb != 0, axis=1) & (reflected_throughputs >= min_throughput)
+
+    parents = np.concatenate([np.flatnonzero(transmitted), np.flatnonzero(reflective)])
+    kinds = np.repeat([TRANSMISSION, REFLECTION], [np.sum(transmitted), np.sum(reflective)])
+    throughputs = np.concatenate([transmitted_throughputs[transmitted], reflected_throughputs[reflective]])
+    return parents, kinds, throughputs
+
+
+def shade_generation(generation, scene):
+    """
+    the shading of a generation's hits by the materials and the lights, their back and reflected colors aside
+
+    :return: (M,3) arrays of the hits' direct colors, the factors of their back colors if those hit the background / a shape,
+             and their reflectance
+    """
+    material_indices = scene.shape_materials[generation.indices]
+    if scene.backend == 'numba':
+        import kernels
+        return kernels.shade(generation.points, generation.directions, generation.normals, material_indices, generation.reached,
+                             generation.perc_rays_hit, generation.light_weights, scene.material_diffuse, scene.material_specular,
+                             scene.material_phong, scene.material_transp, scene.light_positions, scene.light_rgb,
+                             scene.light_specular_intens, scene.light_shadow_intens) + (scene.material_reflect[material_indices],)
+
+    # the positions stay in float64, the directions and the colors are computed in the render options' precision
+    dtype = np.float32 if scene.options.float32 else np.float64
+    diffuse_rgb  = scene.material_diffuse[material_indices].astype(dtype, copy=False)
+    specular_rgb = scene.material_specular[material_indices].astype(dtype, copy=False)
+    reflect_rgb  = scene.material_reflect[material_indices].astype(dtype, copy=False)
+    phong  = scene.material_phong[material_indices].astype(dtype, copy=False)
+    transp = scene.material_transp[material_indices].astype(dtype, copy=False)
+    directions = generation.directions.astype(dtype, copy=False)
+    perc_rays_hit = generation.perc_rays_hit.astype(dtype, copy=False)
+    light_weights = generation.light_weights.astype(dtype, copy=False)
+
+    direct_colors = np.zeros((len(generation.points), 3), dtype=dtype)
+    back_coefs_background = np.zeros((len(generation.points), 3), dtype=dtype)
+    back_coefs_hit = np.zeros((len(generation.points), 3), dtype=dtype)
+    for light in range(scene.num_lights):
+        reached = generation.reached[light]
+        if not np.any(reached):
+            continue
+        light_rgb = scene.light_rgb[light].astype(dtype)
+        light_directions = normalize_rows(generation.points[reached] - scene.light_positions[light]).astype(dtype, copy=False)
+        surface_normals = generation.normals[reached].astype(dtype, copy=False)
+
+        # diffuse coloring
+        diffuse_color = diffuse_rgb[reached] * np.abs(np.einsum('ij,ij->i', surface_normals, -light_directions))[:, None]
+
+        # specular coloring
+        reflect_directions = get_reflected_vectors(light_directions, surface_normals)
+        specular_color = specular_rgb[reached] * np.power(np.abs(np.einsum('ij,ij->i', reflect_directions, -directions[reached])), phong[reached])[:, None] * dtype(scene.light_specular_intens[light])
+
+        # soft shadows
+        shadow_intens = dtype(scene.light_shadow_intens[light])
+        light_intensity = ((1-shadow_intens)*1 + shadow_intens*perc_rays_hit[light, reached])[:, None]
+        light_intensity = light_intensity * light_weights[light, reached, None]
+
+        # transparency, the back color is known only once the next generation is resolved
+        cur_transp = transp[reached, None]
+        direct_colors[reached] += light_rgb * (diffuse_color + specular_color) * (1 - cur_transp) * light_intensity
+        back_coefs_background[reached] += cur_transp * light_intensity
+        back_coefs_hit[reached] += cur_transp * light_rgb * light_intensity
+
+    return direct_colors, back_coefs_background, back_coefs_hit, reflect_rgb
+
+
+def compact_excluded(excluded):
+    """
+    move each row's NO_SHAPE padding to its end, and drop the columns which are padding only
+
+    :param excluded: (N,K) indices of shapes, padded with NO_SHAPE
+    :return: (N,K') the same indices per row, K' <= K
+    """
+    excluded = -np.sort(-excluded, axis=1)
+    return excluded[:, :np.max(np.sum(excluded != NO_SHAPE, axis=1), initial=0)]
+
+
+def get_soft_shadow_perc_rays_hit_batch(light, light_position, light_directions, num_shadow_rays, radius, intersection_points, scene, excluded, rng=np.random, sampling='jitter'):
+    """
+    batched version of `RayTracer.get_soft_shadow_perc_rays_hit` for a single light and many points,
+    the N x N shadow rays of a chunk of points are traced as one batch.
+    with the render options' `shadow_early_out`, the points whose corner probes agree (see `shadows.probe_shadows`) skip their N x N rays
+
+    :param light: the index of the light
+    :param light_directions: (N,) normalized directions from the light to the points
+    :param intersection_points: (N,3) the shaded points
+    :return: (N,) the fraction of shadow rays which reach each point
+    """
+    # Find a plane which is perpendicular to each ray
+    axis_one = np.broadcast_to(np.array([0., 0., 1.]), light_directions.shape).copy()
+    axis_one[np.sum(np.abs(axis_one - light_directions), axis=1) < atol] = np.array([1., 0., 0.])
+
+    axis_one = axis_one - np.einsum('ij,ij->i', axis_one, light_directions)[:, None] * light_directions
+    axis_one = normalize_rows(axis_one)
+    axis_two = normalize_rows(np.cross(axis_one, light_directions))
+
+    samples_per_point = num_shadow_rays * num_shadow_rays
+    offsets = get_shadow_sample_offsets(num_shadow_rays, radius, rng, sampling, (len(intersection_points),))
+    if scene.options.shadow_early_out and samples_per_point > len(PROBE_OFFSETS) and radius > 0:
+        perc_rays_hit, traced = probe_shadows(light, light_position, axis_one, axis_two, radius, intersection_points, scene, excluded)
+    else:
+        perc_rays_hit, traced = np.zeros(len(intersection_points)), np.arange(len(intersection_points))
+
+    chunk_size = max(1, MAX_SHADOW_RAYS_PER_BATCH // samples_per_point)
+    for start in range(0, len(traced), chunk_size):
+        chunk = traced[start:start + chunk_size]
+        sample_points = light_position + axis_one[chunk, None] * offsets[chunk, :, 0:1] + axis_two[chunk, None] * offsets[chunk, :, 1:2]
+        sample_points = sample_points.reshape(-1, 3)
+
+        shadow_directions = np.repeat(intersection_points[chunk], samples_per_point, axis=0) - sample_points
+        shadow_distances = np.linalg.norm(shadow_directions, axis=1)
+        shadow_directions = shadow_directions / shadow_distances[:, None]
+
+        # count only the rays which nothing blocks before the intersection point
+        if scene.stats is not None:
+            scene.stats.count_rays('shadow', len(sample_points))
+        occluded = find_shadow_occlusions(light, sample_points, shadow_directions, shadow_distances - atol, scene,
+                                          np.repeat(excluded[chunk], samples_per_point, axis=0))
+        perc_rays_hit[chunk] = np.mean(~occluded.reshape(-1, samples_per_point), axis=1)
+
+    return perc_rays_hit
@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import sys
+from time import time
+
+import numpy as np
+from PIL import Image
+
+from parser import parse_arrays, compile_scene
+from scene_file import load_binary_scene, is_binary_scene
+from stats import RenderStats, RAY_KINDS
+from utils import write_img
+
+# the reference scenes, each varies one parameter of the base scene
+BASE_SCENE = dict(num_shapes=20, num_lights=1, root_shadow_rays=2, max_recursions=2, transp=0.0, reflect=0.2)
+REFERENCE_SCENES = {'base':          {},
+                    'many_shapes':   dict(num_shapes=500),
+                    'many_lights':   dict(num_lights=4),
+                    'soft_shadows':  dict(root_shadow_rays=5),
+                    'deep_recursion': dict(max_recursions=8, reflect=0.6),
+                    'transparent':   dict(transp=0.5)}
+
+
+def generate_scene(path, num_shapes, num_lights, root_shadow_rays, max_recursions, transp, reflect, seed=0):
+    """
+    write a random scene of spheres and boxes above a floor plane, seen by a fixed camera
+
+    :param transp: the transparency of half of the shapes' materials
+    :param reflect: the reflectance of the floor and of half of the shapes' materials
+    """
+    rng = np.random.default_rng(seed)
+    lines = ['cam 0 3 -12   0 0 0   0 1 0   1.5 1.5',
+             f'set 0.1 0.1 0.15   {root_shadow_rays} {max_recursions}',
+             f'mtl 0.6 0.6 0.6  0 0 0  {reflect} {reflect} {reflect}  1 0']
+    for material in range(4):
+        diffuse = ' '.join(f'{value:.3f}' for value in rng.uniform(0.1, 0.9, size=3))
+        material_reflect = reflect if material % 2 else 0
+        material_transp = transp if material < 2 else 0
+        lines.append(f'mtl {diffuse}  1 1 1  {material_reflect} {material_reflect} {material_reflect}  {rng.integers(5, 50)} {material_transp}')
+
+    lines.append('pln 0 1 0 -1 1')
+    extent = 2 + np.sqrt(num_shapes) / 2  # keeps the shapes' density roughly constant
+    for shape in range(num_shapes):
+        x, y, z = rng.uniform([-extent, -0.5, -2], [extent, 2 * extent / 3, 2 * extent])
+        size = rng.uniform(0.3, 0.8)
+        material = rng.integers(2, 6)
+        lines.append(f'{"sph" if shape % 2 else "box"} {x:.3f} {y:.3f} {z:.3f} {size:.3f} {material}')
+
+    for light in range(num_lights):
+        x, y, z = rng.uniform([-6, 4, -8], [6, 8, 0])
+        lines.append(f'lgt {x:.3f} {y:.3f} {z:.3f}  {1 / num_lights ** 0.5:.3f} {1 / num_lights ** 0.5:.3f} {1 / num_lights ** 0.5:.3f}  0.5 0.8 1')
+
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+
+
+def run_benchmark(scene_path, width, height, engine='batch', accel='bvh', tile_size=64, workers=1, seed=0, repeats=1):
+    """
+    render a scene file and time its phases, the render time is the fastest of `repeats` renders
+
+    :return: (the [height, width, 3] image, a dict of the timings and the ray counts and rates by kind)
+    """
+    from parallel import render_tiles
+
+    start = time()
+    parsed = load_binary_scene(scene_path) if is_binary_scene(scene_path) else parse_arrays(scene_path)
+    parse_time = time() - start
+
+    start = time()
+    scene = compile_scene(*parsed, width, height)
+    if accel == 'bvh':
+        from bvh import BVH
+        scene.accel = BVH(scene)
+    elif accel == 'grid':
+        from grid import Grid
+        scene.accel = Grid(scene)
+    setup_time = time() - start
+
+    render_time = np.inf
+    for _ in range(repeats):
+        scene.stats = RenderStats()
+        start = time()
+        img = render_tiles(height, width, scene, engine, tile_size, workers, seed)
+        render_time = min(render_time, time() - start)
+
+    rays = scene.stats.report()['rays']
+    result = {'parse_time': parse_time,
+              'setup_time': setup_time,
+              'render_time': render_time,
+              'rays': rays,
+              'rays_per_second': {kind: rays[kind] / render_time for kind in RAY_KINDS},
+              'total_rays_per_second': sum(rays.values()) / render_time}
+
+    return img, result
+
+
+def get_psnr(img, reference):
+    """
+    :param img: an image with values in [0, 255]
+    :param reference: an image of the same shape
+    :return: the peak signal to noise ratio of the image relative to the reference in dB, np.inf if they are the same
+    """
+    mse = np.mean((np.asarray(img, dtype=float) - np.asarray(reference, dtype=float)) ** 2)
+    return np.inf if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def compare_results(results, baseline, max_regression):
+    """
+    :param results: the 'scenes' of a benchmark run
+    :param baseline: the 'scenes' of a stored run
+    :param max_regression: the fraction of the baseline's total throughput a scene may lose
+    :return: a list of messages, one per scene which regressed
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]['total_rays_per_second']
+        actual = result['total_rays_per_second']
+        if actual < expected * (1 - max_regression):
+            regressions.append(f'{name}: {actual:.0f} rays/s, {1 - actual / expected:.1%} below the baseline {expected:.0f} rays/s')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='time the rendering of the reference scenes')
+    parser.add_argument('output', help='The path of the JSON results', type=str)
+    parser.add_argument('--scenes', help='The reference scenes to run, all by default', nargs='+', choices=list(REFERENCE_SCENES), default=list(REFERENCE_SCENES))
+    parser.add_argument('--scene-dir', help='Where the generated scene files are written', type=str, default='benchmark_scenes')
+    parser.add_argument('--width', type=int, default=128)
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--repeats', help='The times each scene is rendered, the fastest render is kept', type=int, default=3)
+    parser.add_argument('--engine', choices=['scalar', 'batch'], default='batch')
+    parser.add_argument('--accel', choices=['none', 'bvh', 'grid'], default='bvh')
+    parser.add_argument('--tile-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', help='The seed of the scenes and of the soft shadows', type=int, default=0)
+    parser.add_argument('--baseline', help='A stored JSON results file to compare the throughput against', type=str, default=None)
+    parser.add_argument('--max-regression', help='The fraction of the baseline throughput a scene may lose', type=float, default=0.1)
+    parser.add_argument('--golden-dir', help='A directory of golden renders to compare the images against', type=str, default=None)
+    parser.add_argument('--update-golden', help='Write the renders to the golden directory instead of comparing', action='store_true')
+    parser.add_argument('--min-psnr', help='The PSNR in dB below which a render differs from its golden render', type=float, default=40.)
+    args = parser.parse_args()
+
+    os.makedirs(args.scene_dir, exist_ok=True)
+    if args.golden_dir is not None:
+        os.makedirs(args.golden_dir, exist_ok=True)
+
+    failures = []
+    results = {}
+    for name in args.scenes:
+        scene_path = os.path.join(args.scene_dir, f'{name}.txt')
+        generate_scene(scene_path, **{**BASE_SCENE, **REFERENCE_SCENES[name]}, seed=args.seed)
+        img, results[name] = run_benchmark(scene_path, args.width, args.height, args.engine, args.accel, args.tile_size, args.workers, args.seed, args.repeats)
+        print(f'{name}: render {results[name]["render_time"]:.2f}s, {results[name]["total_rays_per_second"]:.0f} rays/s')
+
+        if args.golden_dir is not None:
+            golden_path = os.path.join(args.golden_dir, f'{name}.png')
+            if args.update_golden:
+                write_img(img, golden_path)
+            elif os.path.exists(golden_path):
+                psnr = get_psnr((img * 255).astype(np.uint8), Image.open(golden_path))
+                results[name]['psnr'] = psnr
+                if psnr < args.min_psnr:
+                    failures.append(f'{name}: the render differs from {golden_path}, PSNR {psnr:.1f} dB')
+
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'golden_dir', 'update_golden')}
+    with open(args.output, 'w') as fp:
+        json.dump({'config': config, 'scenes': results}, fp, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            failures += compare_results(results, json.load(fp)['scenes'], args.max_regression)
+
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+from time import time
+
+import numpy as np
+
+from scene import PLANE
+
+MIN_DIRECTION = 1e-30  # replaces zero direction coordinates, so the slabs of parallel axes get infinite bounds
+
+
+def get_inverse_directions(directions):
+    safe_directions = np.copysign(np.maximum(np.abs(directions), MIN_DIRECTION), directions)
+    return 1 / safe_directions
+
+
+def intersect_aabbs(origins, inverse_directions, box_min, box_max):
+    """
+    slab test of rays against axis aligned bounding boxes, row by row
+
+    :return: (N,) entry and (N,) exit distances, the ray hits the box iff exit >= max(entry, 0)
+    """
+    t_0 = (box_min - origins) * inverse_directions
+    t_1 = (box_max - origins) * inverse_directions
+    return np.minimum(t_0, t_1).max(axis=1), np.maximum(t_0, t_1).min(axis=1)
+
+
+class Accelerator:
+    """
+    the closest hit and occlusion queries shared by the acceleration structures, which hold the bounded shapes.
+    subclasses implement `_traverse`, which gathers the (ray, shape) candidates
+    """
+
+    COUNTERS = ('rays_traced',)  # the traversal statistics, summed over the workers' copies by `parallel.render_tiles`
+
+    def closest_hit(self, origins, directions, excluded):
+        """
+        same contract as `batch.find_closest_intersections`
+
+        :param origins: (N,3) ray origins
+        :param directions: (N,3) normalized ray directions
+        :param excluded: (N,K) indices of shapes to ignore per ray, padded with NO_SHAPE
+        :return: (N,) distances to the closest intersections (np.inf for none) and (N,) indices of the hit shapes (NO_SHAPE for none)
+        """
+        self.rays_traced += len(origins)
+        best_distances, best_indices = self.scene.brute_force_closest_hit(origins, directions, excluded, shape_types=(PLANE,))
+
+        def visit_candidates(pair_rays, shape_ids, distances):
+            # keep the closest primitive per ray, the lower shape index wins ties like in the brute force search
+            order = np.lexsort((shape_ids, distances, pair_rays))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = pair_rays[order[1:]] != pair_rays[order[:-1]]
+            selected = order[first]
+            rays, distances, shape_ids = pair_rays[selected], distances[selected], shape_ids[selected]
+            closer = (distances < best_distances[rays]) | ((distances == best_distances[rays]) & (shape_ids < best_indices[rays]))
+            best_distances[rays[closer]] = distances[closer]
+            best_indices[rays[closer]] = shape_ids[closer]
+
+        # the best distance so far bounds the nodes/cells worth visiting
+        self._traverse(origins, directions, excluded, best_distances, visit_candidates)
+
+        return best_distances, best_indices
+
+    def any_hit(self, origins, directions, max_distances, excluded, blockers=None):
+        """
+        same contract as `scene.Scene.any_hit`, a ray stops traversing at its first blocker
+
+        :param max_distances: (N,) the length of the segment tested per ray
+        :param blockers: optional (N,) int array, set to a shape blocking each blocked ray
+        :return: (N,) whether any shape blocks each ray before its max distance
+        """
+        self.rays_traced += len(origins)
+        occluded = self.scene.brute_force_any_hit(origins, directions, max_distances, excluded, shape_types=(PLANE,), blockers=blockers)
+
+        limits = np.where(occluded, -np.inf, max_distances)
+
+        def visit_candidates(pair_rays, shape_ids, distances):
+            blocking = distances < limits[pair_rays]
+            blocked = pair_rays[blocking]
+            occluded[blocked] = True
+            if blockers is not None:
+                blockers[blocked] = shape_ids[blocking]
+            limits[blocked] = -np.inf  # culls all the remaining nodes/cells of the ray
+
+        self._traverse(origins, directions, excluded, limits, visit_candidates)
+
+        return occluded
+
+    def _traverse(self, origins, directions, excluded, limits, visit_candidates):
+        """
+        :param limits: (N,) distance per ray beyond which the structure isn't searched, may be updated by `visit_candidates`
+        :param visit_candidates: called with (ray, shape, distance) triplets of the shapes the rays may hit
+        """
+        raise NotImplementedError
+
+
+class BVH(Accelerator):
+    """
+    bounding volume hierarchy over the bounded shapes of a compiled scene (spheres and boxes)
+    unbounded shapes (planes) are kept aside and tested against every ray
+
+    the tree is stored as flat arrays, and traversed breadth first by a batch of rays at once,
+    each step tests all the (ray, node) pairs which are still alive
+    """
+
+    COUNTERS = ('nodes_visited', 'rays_traced')
+
+    def __init__(self, scene, leaf_size=4):
+        start = time()
+        self.scene = scene
+        self.leaf_size = leaf_size
+        self.nodes_visited = 0
+        self.rays_traced = 0
+
+        self._build(*scene.get_bounds())
+        self.build_time = time() - start
+
+    def _build(self, shape_indices, bounds):
+        centroids = bounds.mean(axis=1)
+        order = np.arange(len(shape_indices))
+
+        node_min, node_max, node_left, node_right, node_start, node_count = [], [], [], [], [], []
+        stack = [(0, len(order), None, None)]  # (start, end, parent, is_right_child)
+        while stack:
+            start, end, parent, is_right = stack.pop()
+            node = len(node_min)
+            if parent is not None:
+                (node_right if is_right else node_left)[parent] = node
+
+            prims = order[start:end]
+            node_min.append(bounds[prims, 0].min(axis=0) if len(prims) else np.zeros(3))
+            node_max.append(bounds[prims, 1].max(axis=0) if len(prims) else np.zeros(3))
+            node_left.append(-1)
+            node_right.append(-1)
+
+            extent = np.ptp(centroids[prims], axis=0) if len(prims) else np.zeros(3)
+            if len(prims) <= self.leaf_size or np.all(extent == 0):
+                node_start.append(start)
+                node_count.append(len(prims))
+                continue
+
+            # split at the median of the longest axis
+            axis = np.argmax(extent)
+            mid = len(prims) // 2
+            order[start:end] = prims[np.argpartition(centroids[prims, axis], mid)]
+            node_start.append(start)
+            node_count.append(0)
+            stack.append((start + mid, end, node, True))
+            stack.append((start, start + mid, node, False))
+
+        self.node_min = np.array(node_min).reshape(-1, 3)
+        self.node_max = np.array(node_max).reshape(-1, 3)
+        self.node_left = np.array(node_left, dtype=int)
+        self.node_right = np.array(node_right, dtype=int)
+        self.node_start = np.array(node_start, dtype=int)
+        self.node_count = np.array(node_count, dtype=int)
+
+        # primitives are stored in leaf order, so each leaf is a contiguous range
+        self.prim_shape = shape_indices[order]
+
+    @property
+    def num_nodes(self):
+        return len(self.node_min)
+
+    def report(self):
+        """
+        :return: a dict of the build and traversal statistics
+        """
+        return {'build_time': self.build_time,
+                'nodes': self.num_nodes,
+                'leaves': int(np.sum(self.node_left == -1)),
+                'bounded_shapes': len(self.prim_shape),
+                'unbounded_shapes': len(self.scene.plane_shapes),
+                'rays_traced': self.rays_traced,
+                'avg_nodes_visited_per_ray': self.nodes_visited / max(self.rays_traced, 1)}
+
+    def _traverse(self, origins, directions, excluded, limits, visit_candidates):
+        """
+        visit all the (ray, node) pairs where the ray enters the node before its limit
+
+        :param limits: (N,) distance per ray beyond which nodes are skipped, may be updated by `visit_candidates`
+        :param visit_candidates: called with the (ray, shape, distance) triplets of the primitives in the visited leaves
+        """
+        if len(self.prim_shape) == 0:
+            return
+
+        inverse_directions = get_inverse_directions(directions)
+        ray_ids = np.arange(len(origins))
+        node_ids = np.zeros(len(origins), dtype=int)
+        while len(ray_ids):
+            self.nodes_visited += len(ray_ids)
+            t_enter, t_exit = intersect_aabbs(origins[ray_ids], inverse_directions[ray_ids], self.node_min[node_ids], self.node_max[node_ids])
+            alive = (t_exit >= np.maximum(t_enter, 0)) & (t_enter <= limits[ray_ids])
+            ray_ids, node_ids = ray_ids[alive], node_ids[alive]
+
+            leaf = self.node_left[node_ids] == -1
+            if np.any(leaf):
+                visit_candidates(*self._intersect_leaves(origins, directions, excluded, ray_ids[leaf], node_ids[leaf]))
+
+            inner_rays, inner_nodes = ray_ids[~leaf], node_ids[~leaf]
+            ray_ids = np.concatenate([inner_rays, inner_rays])
+            node_ids = np.concatenate([self.node_left[inner_nodes], self.node_right[inner_nodes]])
+
+    def _intersect_leaves(self, origins, directions, excluded, ray_ids, node_ids):
+        """
+        :return: (pair_rays, shape_ids, distances) of all the (ray, primitive) pairs in the given (ray, leaf) pairs
+        """
+        counts = self.node_count[node_ids]
+        pair_rays = np.repeat(ray_ids, counts)
+        prims = np.repeat(self.node_start[node_ids] - np.cumsum(counts) + counts, counts) + np.arange(len(pair_rays))
+
+        shape_ids = self.prim_shape[prims]
+        distances = self.scene.get_distances(shape_ids, origins[pair_rays], directions[pair_rays])
+        distances[np.any(excluded[pair_rays] == shape_ids[:, None], axis=1)] = np.inf
+
+        return pair_rays, shape_ids, distances
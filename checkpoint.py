@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from parallel import split_tiles
+
+FRAMEBUFFER_FILE = 'framebuffer.npy'
+TILES_FILE = 'tiles.npy'
+SETTINGS_FILE = 'settings.json'
+
+
+def get_file_hash(path):
+    """
+    :return: the sha256 hex digest of the file's contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def open_checkpoint(directory, height, width, tile_size, seed, settings):
+    """
+    open the memory-mapped framebuffer and tile bitmap of a checkpointed render, creating them if the directory has none
+
+    the framebuffer lives on disk, so the image isn't held in the process' memory, and a render which was interrupted
+    continues from its finished tiles when it's resumed with the same settings
+
+    :param seed: the seed of the soft shadows, None to use the checkpoint's seed, or a random one for a new checkpoint
+    :param settings: a dict of everything else the image depends on (e.g. the scene file's hash and the engine), must be JSON serializable
+    :return: the [height, width, 3] float32 framebuffer, the (tiles,) bool bitmap of the finished tiles, and the seed
+    :raises ValueError: if the checkpoint was made by a render with other settings
+    """
+    settings = {**settings, 'height': height, 'width': width, 'tile_size': tile_size}
+    settings_path = os.path.join(directory, SETTINGS_FILE)
+    framebuffer_path = os.path.join(directory, FRAMEBUFFER_FILE)
+    tiles_path = os.path.join(directory, TILES_FILE)
+
+    if os.path.exists(settings_path):
+        with open(settings_path) as fp:
+            stored_settings = json.load(fp)
+        stored_seed = stored_settings.pop('seed')
+        if stored_settings != settings or seed not in (None, stored_seed):
+            raise ValueError(f'the checkpoint in {directory} belongs to another render: {stored_settings}, seed {stored_seed}')
+        return np.load(framebuffer_path, mmap_mode='r+'), np.load(tiles_path, mmap_mode='r+'), stored_seed
+
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    os.makedirs(directory, exist_ok=True)
+    img = np.lib.format.open_memmap(framebuffer_path, mode='w+', dtype=np.float32, shape=(height, width, 3))
+    done = np.lib.format.open_memmap(tiles_path, mode='w+', dtype=bool, shape=(len(split_tiles(height, width, tile_size)),))
+    # the settings are written last, a directory without them is a checkpoint which was never started
+    with open(settings_path, 'w') as fp:
+        json.dump({**settings, 'seed': seed}, fp)
+
+    return img, done, seed
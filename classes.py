@@ -5,6 +5,83 @@ import numpy as np
 from utils import norm2
 
 TANGENT_TOLERANCE = 0.01
+PARALLEL_TOLERANCE = 0.01
+
+
+def intersect_spheres(origins, directions, centers, radii):
+    """
+    batched version of `Sphere.find_intersection`, see there for the notation
+
+    all the arguments broadcast against each other, e.g. (N,1,3) rays and (S,3) spheres give (N,S) distances
+
+    :param origins: (...,3) ray origins
+    :param directions: (...,3) normalized ray directions
+    :param centers: (...,3) sphere centers
+    :param radii: (...) sphere radii
+    :return: (...) distances along the rays, np.inf where there is no intersection in front of the ray
+    """
+    oc = centers - origins
+    ob_size = np.einsum('...i,...i->...', oc, directions)
+    oc_size = np.linalg.norm(oc, axis=-1)
+    cb_size = np.sqrt(np.maximum(oc_size ** 2 - ob_size ** 2, 0))  # rounding can make it negative for rays through the center
+    with np.errstate(invalid='ignore'):
+        tangent = np.abs(cb_size - radii) <= TANGENT_TOLERANCE
+        t = np.where(tangent, ob_size, ob_size - np.sqrt(radii ** 2 - cb_size ** 2))
+        miss = (ob_size <= 0) | (~tangent & (cb_size > radii)) | (t < 0)
+    t[miss] = np.inf
+    return t
+
+
+def intersect_planes(origins, directions, normals, offsets):
+    """
+    batched version of `Plane.find_intersection`, see there for the notation
+
+    all the arguments broadcast against each other, like in `intersect_spheres`
+
+    :param origins: (...,3) ray origins
+    :param directions: (...,3) normalized ray directions
+    :param normals: (...,3) normalized plane normals
+    :param offsets: (...) plane offsets
+    :return: (...) distances along the rays, np.inf where there is no intersection in front of the ray
+    """
+    n_dot_d = np.sum(normals * directions, axis=-1)
+    n_dot_o = np.sum(normals * origins, axis=-1)
+    parallel = np.abs(n_dot_d) < PARALLEL_TOLERANCE
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (offsets - n_dot_o) / n_dot_d
+    t[parallel | (t < 0)] = np.inf
+    return t
+
+
+def intersect_boxes(origins, directions, box_min, box_max):
+    """
+    batched version of `Box.find_intersection` (slabs method)
+
+    all the arguments broadcast against each other, like in `intersect_spheres`
+
+    :param origins: (...,3) ray origins
+    :param directions: (...,3) normalized ray directions
+    :param box_min: (...,3) minimal box corners
+    :param box_max: (...,3) maximal box corners
+    :return: (...) distances along the rays, np.inf where there is no intersection in front of the ray
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_direction = 1 / directions
+        t_0 = (box_min - origins) * inv_direction
+        t_1 = (box_max - origins) * inv_direction
+    t_min = np.minimum(t_0, t_1)
+    t_max = np.maximum(t_0, t_1)
+
+    has_intersection = np.isfinite(t_min)
+    inside_slab = (box_min < origins) & (origins < box_max)
+    parallel_miss = np.any(~has_intersection & ~inside_slab, axis=-1)
+
+    t_enter = np.where(has_intersection, t_min, -np.inf).max(axis=-1)
+    t_exit  = np.where(has_intersection, t_max, np.inf).min(axis=-1)
+    miss = parallel_miss | ~np.any(has_intersection, axis=-1) | (t_exit < t_enter) | (t_enter < 0)
+    t_enter[miss] = np.inf
+    return t_enter
+
 
 @dataclass
 class Ray:
@@ -48,6 +125,21 @@ class Set:
     max_recursions:   int
 
 
+@dataclass
+class RenderOptions:
+    """
+    how a scene is rendered, set from the command line rather than from the scene file's `Set`. a render reads them from `scene.options`
+    """
+    shadow_sampling:      str = 'jitter'  # see `sampling.SAMPLING_METHODS`
+    min_throughput:       float = 0.0     # the batch engine doesn't trace the secondary rays weighing less in their pixel
+    light_threshold:      float = 0.0     # see `lights.select_lights`
+    light_samples:        int = 0
+    adaptive_shadow_rays: bool = False
+    shadow_early_out:     bool = False    # see `shadows.probe_shadows`
+    hdr:                  bool = False    # keep the colors above 1, for tone mapping
+    float32:              bool = False    # shade in float32 rather than float64
+
+
 @dataclass
 class Material:
     diffuse_rgb:  np.ndarray
@@ -109,7 +201,7 @@ class Sphere(Shape):
 
         oc = c - ray.origin
         oc_size = norm2(oc)
-        cb_size = np.sqrt(oc_size ** 2 - ob_size ** 2)
+        cb_size = np.sqrt(max(oc_size ** 2 - ob_size ** 2, 0))
         if np.abs(cb_size - r) <= TANGENT_TOLERANCE:
             return ray.get_point(ob_size)
 
@@ -155,7 +247,7 @@ class Plane(Shape):
         :return: the intersecting point, or False for no intersection
         """
         n_dot_d = np.dot(self.normal, ray.direction)
-        if np.abs(n_dot_d) < 0.01:
+        if np.abs(n_dot_d) < PARALLEL_TOLERANCE:
             return False # ray is parallel to the plane
 
         n_dot_o = np.dot(self.normal, ray.origin)
@@ -185,9 +277,10 @@ class Box(Shape):
         :param ray: a Ray instance
         :return: the intersecting point, or False for no intersection
         """
-        inv_direction = 1 / ray.direction
-        t_0 = np.multiply(self._box_min - ray.origin, inv_direction)
-        t_1 = np.multiply(self._box_max - ray.origin, inv_direction)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_direction = 1 / ray.direction
+            t_0 = np.multiply(self._box_min - ray.origin, inv_direction)
+            t_1 = np.multiply(self._box_max - ray.origin, inv_direction)
         t_min = np.minimum(t_0, t_1) # handle rays coming from all directions
         t_max = np.maximum(t_0, t_1)
 
@@ -196,7 +289,7 @@ class Box(Shape):
             return False
 
         if np.any(~has_intersection):
-            parallel_axes = np.argwhere(~has_intersection)[0]
+            parallel_axes = np.argwhere(~has_intersection)[:, 0]
             for axis in parallel_axes:
                 if not (self._box_min[axis] < ray.origin[axis] < self._box_max[axis]): # the ray direction is not a factor since the box is axis aligned
                     return False
@@ -205,6 +298,8 @@ class Box(Shape):
         t_exit  = t_max[has_intersection].min() # the first t outside one of the slabs, is the min of maxs
         if t_exit < t_enter:
             return False # no intersection
+        if t_enter < 0:
+            return False # box is behind the ray
 
         return ray.get_point(t_enter)
 
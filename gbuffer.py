@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import pickle
+from dataclasses import asdict
+
+import numpy as np
+
+from batch import trace_pixel_generations, resolve_generations, get_spawned_rays
+from parallel import split_tiles, get_tile_rng
+
+
+class GBufferCache:
+    """
+    the G-buffers of rendered frames, pickled to a directory and keyed by the frame's geometry (see `get_geometry_key`).
+    the least recently used entries are evicted once the directory holds more than `max_bytes`
+    """
+
+    def __init__(self, directory, max_bytes=2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, f'{key}.gbuffer')
+
+    def get(self, key):
+        """
+        :return: the cached G-buffer, or None
+        """
+        path = self._get_path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # the mtime tracks the last use
+        with open(path, 'rb') as fp:
+            return pickle.load(fp)
+
+    def put(self, key, gbuffer):
+        with open(self._get_path(key), 'wb') as fp:
+            pickle.dump(gbuffer, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self._evict(keep=self._get_path(key))
+
+    def _evict(self, keep):
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.gbuffer')]
+        paths.sort(key=os.path.getmtime)
+        total_bytes = sum(os.path.getsize(path) for path in paths)
+        for path in paths:
+            if total_bytes <= self.max_bytes:
+                break
+            if path != keep:
+                total_bytes -= os.path.getsize(path)
+                os.remove(path)
+
+
+def get_geometry_key(scene, height, width, settings, with_camera=True):
+    """
+    hash everything the rays and the shadows of a frame depend on: the camera, the shapes, the lights' positions and radii,
+    the shadow rays and the recursions, the image's size, the render options and the render settings. the materials, the background and
+    the lights' colors and intensities are left out, a frame differing only in them is reshaded from the G-buffer
+    (unless the lights are selected by their contributions, which depend on them)
+
+    :param settings: a JSON serializable dict of the render settings, e.g. the tile size and the seed
+    :param with_camera: False leaves the camera out, for the frames of a moving camera
+    :return: a hex digest
+    """
+    camera = scene.camera
+    digest = hashlib.sha256()
+    if with_camera:
+        for values in (camera.position, camera.look_at, camera.up, [camera.screen_dist, camera.screen_width, camera.screen_height]):
+            digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+    for values in ([scene.set_params.root_shadow_rays, scene.set_params.max_recursions],
+                   scene.shape_types, scene.shape_materials, scene.sphere_centers, scene.sphere_radii,
+                   scene.plane_normals, scene.plane_offsets, scene.box_mins, scene.box_maxs, scene.light_positions, scene.light_radius):
+        digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+    options = scene.options
+    if options.light_threshold > 0 or options.light_samples > 0 or options.adaptive_shadow_rays:
+        # the lights a hit is shaded by are chosen by their contributions (see `lights.select_lights`)
+        for values in (scene.material_diffuse, scene.material_specular, scene.material_transp, scene.light_rgb, scene.light_specular_intens):
+            digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+    digest.update(json.dumps({'height': height, 'width': width, **asdict(options), **settings}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def render_with_gbuffer(height, width, scene, cache, tile_size=64, seed=None):
+    """
+    render like `parallel.render_tiles` with the batch engine, keeping the G-buffer of every tile: the generations
+    of its rays (see `batch.trace_generations`). a frame whose G-buffer is cached is reshaded from it, without tracing rays
+
+    :param cache: a `GBufferCache`
+    :param seed: the seed of the soft shadows' randomness, None for a random seed (which reshades the last frame rendered with a random seed)
+    :return: a [height, width, 3] float32 image, and whether it was reshaded from the cache
+    """
+    key = get_geometry_key(scene, height, width, {'tile_size': tile_size, 'seed': seed})
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    img = np.zeros([height, width, 3], dtype=np.float32)  # converted to uint8 before saving
+    tiles = split_tiles(height, width, tile_size)
+    gbuffer = cache.get(key)
+    if gbuffer is not None:
+        for (x_start, x_end, y_start, y_end), generations in zip(tiles, gbuffer):
+            colors = reshade_generations(generations, scene)
+            if colors is None:
+                break
+            img[height - y_end:height - y_start, x_start:x_end] = colors.reshape(y_end - y_start, x_end - x_start, 3)
+        else:
+            return img, True
+
+    gbuffer = []
+    for tile_index, (x_start, x_end, y_start, y_end) in enumerate(tiles):
+        j, i = np.mgrid[y_end - 1:y_start - 1:-1, x_start:x_end]
+        generations = trace_pixel_generations(i.ravel(), j.ravel(), height, width, scene, get_tile_rng(seed, tile_index))
+        colors, _ = resolve_generations(generations, scene)
+        img[height - y_end:height - y_start, x_start:x_end] = colors.reshape(i.shape + (3,))
+        if scene.stats is not None:
+            scene.stats.add_tile_costs(x_start, y_start, scene.stats.pixel_costs.reshape(i.shape))
+        gbuffer.append(generations)
+
+    cache.put(key, gbuffer)
+    return img, False
+
+
+def reshade_generations(generations, scene):
+    """
+    :return: (N,3) colors of the generations' primary rays with the scene's materials and lights,
+             or None if those spawn other transparency or reflection rays than the cached ones
+    """
+    throughputs = generations[0].throughputs
+    for generation, next_generation in zip(generations, generations[1:] + [None]):
+        generation.throughputs = throughputs
+        parents, kinds, spawned_throughputs = get_spawned_rays(generation, scene)
+        if not (np.array_equal(parents, generation.parents) and np.array_equal(kinds, generation.kinds)):
+            return None
+        if next_generation is not None:
+            throughputs = spawned_throughputs[next_generation.hit]
+
+    return resolve_generations(generations, scene)[0]
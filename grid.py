@@ -0,0 +1,144 @@
+from time import time
+
+import numpy as np
+
+from bvh import Accelerator, get_inverse_directions, intersect_aabbs
+
+DENSITY = 4          # the cells per bounded shape the automatic resolution aims for
+MAX_RESOLUTION = 128  # cells per axis
+MIN_EXTENT = 1e-3    # of the grid's axes, relative to its longest axis, so flat scenes get thin cells rather than none
+
+
+def get_grid_resolution(extent, num_shapes, density=DENSITY, max_resolution=MAX_RESOLUTION):
+    """
+    about cubic cells, `density` cells per shape: each axis gets extent * cbrt(density * shapes / volume) cells
+
+    :param extent: (3,) the grid's size along each axis
+    :return: (3,) the cells per axis
+    """
+    cells_per_unit = np.cbrt(density * num_shapes / np.prod(extent))
+    return np.clip(np.round(extent * cells_per_unit), 1, max_resolution).astype(int)
+
+
+class Grid(Accelerator):
+    """
+    uniform grid over the bounded shapes of a compiled scene (spheres and boxes), each cell lists the shapes whose bounding box overlaps it.
+    unbounded shapes (planes) are kept aside and tested against every ray
+
+    the rays walk the cells they pierce in order (3D-DDA), all the rays which are still alive take a step at once,
+    and a ray stops once it leaves the grid or its closest hit is before the cell it would step into.
+    the build only bins every shape into the cells of its bounding box, cheap enough to rebuild the grid per frame
+    """
+
+    COUNTERS = ('cells_visited', 'rays_traced')
+
+    def __init__(self, scene, resolution=None, density=DENSITY):
+        """
+        :param resolution: (3,) cells per axis, chosen from the shapes' count and bounds by default (see `get_grid_resolution`)
+        """
+        start = time()
+        self.scene = scene
+        self.cells_visited = 0
+        self.rays_traced = 0
+
+        self._build(*scene.get_bounds(), resolution, density)
+        self.build_time = time() - start
+
+    def _build(self, shape_indices, bounds, resolution, density):
+        if len(shape_indices) == 0:
+            bounds = np.zeros((1, 2, 3))
+        self.grid_min = bounds[:, 0].min(axis=0)
+        extent = bounds[:, 1].max(axis=0) - self.grid_min
+        extent = np.maximum(extent, max(extent.max(), 1.) * MIN_EXTENT)
+
+        if resolution is None:
+            resolution = get_grid_resolution(extent, len(shape_indices), density)
+        self.resolution = np.asarray(resolution, dtype=int)
+        self.cell_size = extent / self.resolution
+        self.grid_max = self.grid_min + extent
+
+        # the cells of each shape's bounding box, as one (cell, shape) reference per pair
+        first = np.clip(np.floor((bounds[:, 0] - self.grid_min) / self.cell_size).astype(int), 0, self.resolution - 1)
+        spans = np.clip(np.floor((bounds[:, 1] - self.grid_min) / self.cell_size).astype(int), 0, self.resolution - 1) - first + 1
+        counts = np.prod(spans, axis=1) if len(shape_indices) else np.zeros(0, dtype=int)
+        ref_shapes = np.repeat(np.arange(len(counts)), counts)
+        offsets = np.arange(len(ref_shapes)) - np.repeat(np.cumsum(counts) - counts, counts)
+        ref_spans = spans[ref_shapes]
+        ref_cells = first[ref_shapes] + np.stack([offsets % ref_spans[:, 0],
+                                                  offsets // ref_spans[:, 0] % ref_spans[:, 1],
+                                                  offsets // (ref_spans[:, 0] * ref_spans[:, 1])], axis=1)
+        ref_cells = np.ravel_multi_index(ref_cells.T, self.resolution)
+
+        # the references are stored grouped by cell, so each cell is a contiguous range
+        order = np.argsort(ref_cells, kind='stable')
+        self.cell_shapes = shape_indices[ref_shapes[order]]
+        self.cell_starts = np.concatenate([[0], np.cumsum(np.bincount(ref_cells, minlength=np.prod(self.resolution)))])
+
+    @property
+    def num_cells(self):
+        return int(np.prod(self.resolution))
+
+    def report(self):
+        """
+        :return: a dict of the build and traversal statistics
+        """
+        return {'build_time': self.build_time,
+                'resolution': self.resolution.tolist(),
+                'cells': self.num_cells,
+                'empty_cells': int(np.sum(np.diff(self.cell_starts) == 0)),
+                'references': len(self.cell_shapes),
+                'unbounded_shapes': len(self.scene.plane_shapes),
+                'rays_traced': self.rays_traced,
+                'avg_cells_visited_per_ray': self.cells_visited / max(self.rays_traced, 1)}
+
+    def _traverse(self, origins, directions, excluded, limits, visit_candidates):
+        """
+        visit the cells each ray pierces, from where it enters the grid, until it leaves the grid or its next cell starts beyond its limit
+
+        :param limits: (N,) distance per ray beyond which cells are skipped, may be updated by `visit_candidates`
+        :param visit_candidates: called with the (ray, shape, distance) triplets of the shapes in the visited cells
+        """
+        if len(self.cell_shapes) == 0:
+            return
+
+        inverse_directions = get_inverse_directions(directions)
+        t_enter, t_exit = intersect_aabbs(origins, inverse_directions, self.grid_min, self.grid_max)
+        t_enter = np.maximum(t_enter, 0)
+        ray_ids = np.flatnonzero((t_exit >= t_enter) & (t_enter <= limits))
+
+        inverse_directions = inverse_directions[ray_ids]
+        entry_points = origins[ray_ids] + t_enter[ray_ids, None] * directions[ray_ids]
+        cells = np.clip(np.floor((entry_points - self.grid_min) / self.cell_size).astype(int), 0, self.resolution - 1)
+        steps = np.where(inverse_directions > 0, 1, -1)
+        # the distances to the next cell boundary along each axis, and between two boundaries
+        t_next = (self.grid_min + (cells + (steps > 0)) * self.cell_size - origins[ray_ids]) * inverse_directions
+        t_deltas = self.cell_size * np.abs(inverse_directions)
+
+        while len(ray_ids):
+            self.cells_visited += len(ray_ids)
+            visit_candidates(*self._intersect_cells(origins, directions, excluded, ray_ids, np.ravel_multi_index(cells.T, self.resolution)))
+
+            # step across the nearest boundary
+            rows = np.arange(len(ray_ids))
+            axes = np.argmin(t_next, axis=1)
+            t_cell_exit = t_next[rows, axes]
+            cells[rows, axes] += steps[rows, axes]
+            t_next[rows, axes] += t_deltas[rows, axes]
+
+            alive = (t_cell_exit <= limits[ray_ids]) & np.all((cells >= 0) & (cells < self.resolution), axis=1)
+            ray_ids, cells, steps, t_next, t_deltas = ray_ids[alive], cells[alive], steps[alive], t_next[alive], t_deltas[alive]
+
+    def _intersect_cells(self, origins, directions, excluded, ray_ids, cell_ids):
+        """
+        :return: (pair_rays, shape_ids, distances) of all the (ray, shape) pairs in the given (ray, cell) pairs
+        """
+        starts = self.cell_starts[cell_ids]
+        counts = self.cell_starts[cell_ids + 1] - starts
+        pair_rays = np.repeat(ray_ids, counts)
+        refs = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(len(pair_rays))
+
+        shape_ids = self.cell_shapes[refs]
+        distances = self.scene.get_distances(shape_ids, origins[pair_rays], directions[pair_rays])
+        distances[np.any(excluded[pair_rays] == shape_ids[:, None], axis=1)] = np.inf
+
+        return pair_rays, shape_ids, distances
@@ -0,0 +1,200 @@
+import math
+import warnings
+
+import numpy as np
+
+from classes import TANGENT_TOLERANCE, PARALLEL_TOLERANCE
+from scene import SPHERE, PLANE
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ['numpy', 'numba']
+
+
+def jit(function):
+    """
+    compile a kernel with numba when it's installed, caching the machine code on disk next to this file so only the first run
+    pays for the compilation. without numba the kernels stay plain python, far slower than the numpy backend
+    """
+    if numba is None:
+        return function
+    return numba.njit(cache=True, error_model='numpy')(function)
+
+
+def get_backend(name):
+    """
+    :return: the backend to render with, numpy in place of numba when it isn't installed
+    """
+    if name == 'numba' and numba is None:
+        warnings.warn('numba is not installed, falling back to the numpy backend')
+        return 'numpy'
+    return name
+
+
+@jit
+def intersect_sphere(origin, direction, center, radius):
+    oc_size_2 = 0.
+    ob_size = 0.
+    for axis in range(3):
+        oc = center[axis] - origin[axis]
+        oc_size_2 += oc * oc
+        ob_size += oc * direction[axis]
+    if ob_size <= 0:
+        return np.inf
+    cb_size = math.sqrt(max(oc_size_2 - ob_size * ob_size, 0.))
+    if abs(cb_size - radius) <= TANGENT_TOLERANCE:
+        return ob_size
+    if cb_size > radius:
+        return np.inf
+    t = ob_size - math.sqrt(radius * radius - cb_size * cb_size)
+    return t if t >= 0 else np.inf
+
+
+@jit
+def intersect_plane(origin, direction, normal, offset):
+    n_dot_d = normal[0] * direction[0] + normal[1] * direction[1] + normal[2] * direction[2]
+    if abs(n_dot_d) < PARALLEL_TOLERANCE:
+        return np.inf
+    t = (offset - (normal[0] * origin[0] + normal[1] * origin[1] + normal[2] * origin[2])) / n_dot_d
+    return t if t >= 0 else np.inf
+
+
+@jit
+def intersect_box(origin, direction, box_min, box_max):
+    # slabs method, an axis the ray is parallel to only has to contain its origin
+    t_enter, t_exit = -np.inf, np.inf
+    for axis in range(3):
+        if direction[axis] == 0:
+            if not box_min[axis] < origin[axis] < box_max[axis]:
+                return np.inf
+            continue
+        t_0 = (box_min[axis] - origin[axis]) / direction[axis]
+        t_1 = (box_max[axis] - origin[axis]) / direction[axis]
+        t_enter = max(t_enter, min(t_0, t_1))
+        t_exit = min(t_exit, max(t_0, t_1))
+    if t_exit < t_enter or t_enter < 0:
+        return np.inf
+    return t_enter
+
+
+@jit
+def intersect_shape(shape, origin, direction, shape_types, shape_locals,
+                    sphere_centers, sphere_radii, plane_normals, plane_offsets, box_mins, box_maxs):
+    local = shape_locals[shape]
+    if shape_types[shape] == SPHERE:
+        return intersect_sphere(origin, direction, sphere_centers[local], sphere_radii[local])
+    if shape_types[shape] == PLANE:
+        return intersect_plane(origin, direction, plane_normals[local], plane_offsets[local])
+    return intersect_box(origin, direction, box_mins[local], box_maxs[local])
+
+
+@jit
+def get_distances(indices, origins, directions, shape_types, shape_locals,
+                  sphere_centers, sphere_radii, plane_normals, plane_offsets, box_mins, box_maxs):
+    """
+    `scene.Scene.get_distances`
+    """
+    distances = np.empty(len(indices))
+    for ray in range(len(indices)):
+        distances[ray] = intersect_shape(indices[ray], origins[ray], directions[ray], shape_types, shape_locals,
+                                         sphere_centers, sphere_radii, plane_normals, plane_offsets, box_mins, box_maxs)
+    return distances
+
+
+@jit
+def _is_excluded(excluded, ray, shape):
+    for k in range(excluded.shape[1]):
+        if excluded[ray, k] == shape:
+            return True
+    return False
+
+
+@jit
+def closest_hit(shape_ids, origins, directions, excluded, shape_types, shape_locals,
+                sphere_centers, sphere_radii, plane_normals, plane_offsets, box_mins, box_maxs):
+    """
+    `scene.Scene.brute_force_closest_hit` against the shapes `shape_ids`, in increasing order so the lowest index wins ties
+    """
+    best_distances = np.full(len(origins), np.inf)
+    best_indices = np.full(len(origins), -1)
+    for ray in range(len(origins)):
+        for shape in shape_ids:
+            if _is_excluded(excluded, ray, shape):
+                continue
+            distance = intersect_shape(shape, origins[ray], directions[ray], shape_types, shape_locals,
+                                       sphere_centers, sphere_radii, plane_normals, plane_offsets, box_mins, box_maxs)
+            if distance < best_distances[ray]:
+                best_distances[ray] = distance
+                best_indices[ray] = shape
+    return best_distances, best_indices
+
+
+@jit
+def any_hit(shape_ids, origins, directions, max_distances, excluded, shape_types, shape_locals,
+            sphere_centers, sphere_radii, plane_normals, plane_offsets, box_mins, box_maxs):
+    """
+    `scene.Scene.brute_force_any_hit` against the shapes `shape_ids`, a ray stops at its first blocker
+
+    :return: (N,) the first blocker of each ray, -1 for none
+    """
+    blockers = np.full(len(origins), -1)
+    for ray in range(len(origins)):
+        for shape in shape_ids:
+            if _is_excluded(excluded, ray, shape):
+                continue
+            if intersect_shape(shape, origins[ray], directions[ray], shape_types, shape_locals,
+                               sphere_centers, sphere_radii, plane_normals, plane_offsets, box_mins, box_maxs) < max_distances[ray]:
+                blockers[ray] = shape
+                break
+    return blockers
+
+
+@jit
+def shade(points, directions, normals, material_indices, reached, perc_rays_hit, light_weights,
+          material_diffuse, material_specular, material_phong, material_transp,
+          light_positions, light_rgb, light_specular_intens, light_shadow_intens):
+    """
+    `batch.shade_generation` without the reflectance
+
+    :return: (M,3) arrays of the hits' direct colors, and the factors of their back colors if those hit the background / a shape
+    """
+    direct_colors = np.zeros((len(points), 3))
+    back_coefs_background = np.zeros((len(points), 3))
+    back_coefs_hit = np.zeros((len(points), 3))
+    light_direction = np.empty(3)
+    for hit in range(len(points)):
+        material = material_indices[hit]
+        transp = material_transp[material]
+        normal = normals[hit]
+        for light in range(len(light_positions)):
+            if not reached[light, hit]:
+                continue
+            light_distance = 0.
+            for axis in range(3):
+                light_direction[axis] = points[hit, axis] - light_positions[light, axis]
+                light_distance += light_direction[axis] * light_direction[axis]
+            light_direction /= math.sqrt(light_distance)
+
+            # diffuse coloring
+            n_dot_l = normal[0] * light_direction[0] + normal[1] * light_direction[1] + normal[2] * light_direction[2]
+            diffuse = abs(n_dot_l)
+
+            # specular coloring, with the light's direction reflected on the surface
+            r_dot_v = 0.
+            for axis in range(3):
+                r_dot_v -= (light_direction[axis] - 2 * n_dot_l * normal[axis]) * directions[hit, axis]
+            specular = abs(r_dot_v) ** material_phong[material] * light_specular_intens[light]
+
+            # soft shadows
+            light_intensity = ((1 - light_shadow_intens[light]) + light_shadow_intens[light] * perc_rays_hit[light, hit]) * light_weights[light, hit]
+
+            for channel in range(3):
+                color = material_diffuse[material, channel] * diffuse + material_specular[material, channel] * specular
+                direct_colors[hit, channel] += light_rgb[light, channel] * color * (1 - transp) * light_intensity
+                back_coefs_background[hit, channel] += transp * light_intensity
+                back_coefs_hit[hit, channel] += transp * light_rgb[light, channel] * light_intensity
+
+    return direct_colors, back_coefs_background, back_coefs_hit
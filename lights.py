@@ -0,0 +1,60 @@
+import numpy as np
+
+from utils import normalize_rows
+
+
+def get_light_bounds(scene, light, points, normals, material_indices):
+    """
+    a bound of the light's contribution to the colors of hits, from the light's color and specular intensity and the hits' materials
+    and orientation towards it. the lights don't fall off with distance, so the distance only enters through the orientation
+
+    :param material_indices: (M,) the materials of the hits
+    :return: (M,) the largest channel of the color the light adds to each hit, with neither shadow nor back color dimming it
+    """
+    light_directions = normalize_rows(points - scene.light_positions[light])
+    cos_angles = np.abs(np.einsum('ij,ij->i', normals, -light_directions))[:, None]
+    transp = scene.material_transp[material_indices, None]
+    bounds = scene.light_rgb[light] * ((scene.material_diffuse[material_indices] * cos_angles
+                                        + scene.material_specular[material_indices] * scene.light_specular_intens[light]) * (1 - transp) + transp)
+    return bounds.max(axis=1)
+
+
+def select_lights(scene, points, normals, material_indices, rng=np.random):
+    """
+    choose the lights each hit is shaded by, with the render options' light selection options:
+    lights whose bound (see `get_light_bounds`) is below `light_threshold` are skipped, `light_samples` > 0 draws that many lights per hit
+    in proportion to their bounds, each weighted by the inverse of its probability, and `adaptive_shadow_rays` gives each light
+    a root of shadow rays which shrinks with the square root of its bound relative to the hit's brightest light
+
+    :param points: (M,3) the hits
+    :param normals: (M,3) the shapes' normals at the hits
+    :return: (L,M) the weight of each light in each hit's color, 0 for the skipped lights, and (L,M) the roots of their shadow rays
+    """
+    options = scene.options
+    weights = np.ones((scene.num_lights, len(points)))
+    roots = np.full((scene.num_lights, len(points)), scene.set_params.root_shadow_rays)
+    if options.light_threshold <= 0 and options.light_samples <= 0 and not options.adaptive_shadow_rays:
+        return weights, roots
+
+    bounds = np.array([get_light_bounds(scene, light, points, normals, material_indices) for light in range(scene.num_lights)]).reshape(scene.num_lights, len(points))
+    if options.light_threshold > 0:
+        bounds[bounds < options.light_threshold] = 0
+        weights[bounds == 0] = 0
+
+    if 0 < options.light_samples < scene.num_lights:
+        # sample the lights with replacement, a light drawn c times out of k with probability p weighs c / (k * p)
+        totals = bounds.sum(axis=0)
+        cumulative = np.cumsum(bounds, axis=0)
+        draws = rng.random((options.light_samples, len(points))) * totals
+        drawn = np.minimum(np.sum(cumulative[None] <= draws[:, None], axis=1), scene.num_lights - 1)
+        counts = np.zeros_like(weights)
+        np.add.at(counts, (drawn, np.broadcast_to(np.arange(len(points)), drawn.shape)), 1)
+        probabilities = np.divide(bounds, totals, out=np.zeros_like(bounds), where=totals > 0)
+        weights = np.divide(counts, options.light_samples * probabilities, out=np.zeros_like(counts), where=probabilities > 0)
+
+    if options.adaptive_shadow_rays:
+        brightest = bounds.max(axis=0)
+        relative = np.divide(bounds, brightest, out=np.zeros_like(bounds), where=brightest > 0)
+        roots = np.maximum(np.ceil(scene.set_params.root_shadow_rays * np.sqrt(relative)), 1).astype(int)
+
+    return weights, roots
@@ -0,0 +1,137 @@
+import struct
+import zlib
+
+import numpy as np
+
+from utils import write_img
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_COMPRESSION = 6  # zlib's level, the default of most encoders
+
+
+class StreamWriter:
+    """
+    writes an image band by band as it's rendered (see `parallel.render_tile_rows`), without holding the whole image.
+    `bottom_up` tells whether the format stores the image from its bottom row up, and so needs its bands from the bottom
+    """
+
+    bottom_up = False
+
+    def __init__(self, path, height, width):
+        self.height = height
+        self.width = width
+        self.rows_written = 0
+        self.file = open(path, 'wb')
+        self._write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_rows(self, rows):
+        """
+        :param rows: a [rows, width, 3] float band of the image, top row first, the bands following each other down
+                     the image (up the image if `bottom_up`)
+        """
+        assert rows.shape[1:] == (self.width, 3) and self.rows_written + len(rows) <= self.height
+        self._write_rows(rows)
+        self.rows_written += len(rows)
+
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            if self.rows_written == self.height:
+                self._write_footer()
+        finally:
+            self.file.close()
+
+    def _write_header(self):
+        pass
+
+    def _write_rows(self, rows):
+        raise NotImplementedError
+
+    def _write_footer(self):
+        pass
+
+
+class PNGWriter(StreamWriter):
+    """
+    an 8 bit RGB PNG, whose rows are compressed into its image data as they come. the colors are clipped to [0, 1]
+    """
+
+    def _write_header(self):
+        self.file.write(PNG_SIGNATURE)
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0))
+        self.compressor = zlib.compressobj(PNG_COMPRESSION)
+
+    def _write_rows(self, rows):
+        pixels = (np.clip(rows, 0, 1) * 255).astype(np.uint8)
+        # every row starts with its filter type, 0 for none
+        scanlines = np.concatenate([np.zeros((len(rows), 1), dtype=np.uint8), pixels.reshape(len(rows), -1)], axis=1)
+        data = self.compressor.compress(scanlines.tobytes())
+        if data:
+            self._write_chunk(b'IDAT', data)
+
+    def _write_footer(self):
+        self._write_chunk(b'IDAT', self.compressor.flush())
+        self._write_chunk(b'IEND', b'')
+
+    def _write_chunk(self, kind, data):
+        self.file.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+
+
+class PFMWriter(StreamWriter):
+    """
+    a float32 RGB PFM, unclamped colors for tone mapping (see `classes.RenderOptions.hdr`). PFM stores the image from its bottom row up
+    """
+
+    bottom_up = True
+
+    def _write_header(self):
+        # a negative scale marks little endian floats
+        self.file.write(f'PF\n{self.width} {self.height}\n-1.0\n'.encode())
+
+    def _write_rows(self, rows):
+        self.file.write(np.ascontiguousarray(rows[::-1], dtype='<f4').tobytes())
+
+
+STREAM_WRITERS = {'.png': PNGWriter,
+                  '.pfm': PFMWriter}
+
+
+def get_stream_writer(path):
+    """
+    :return: the `StreamWriter` class of the path's extension
+    """
+    extension = path[path.rfind('.'):].lower()
+    if extension not in STREAM_WRITERS:
+        raise ValueError(f'cannot stream {path}, the streamed formats are {", ".join(STREAM_WRITERS)}')
+    return STREAM_WRITERS[extension]
+
+
+def save_image(img, path):
+    """
+    save a [height, width, 3] image, as a PFM with its unclamped colors if the path's extension is .pfm, clipped to 8 bits otherwise
+    """
+    if path.lower().endswith('.pfm'):
+        with PFMWriter(path, *img.shape[:2]) as writer:
+            # a single band, flipped by the writer
+            writer.write_rows(img)
+    else:
+        write_img(img, path)
+
+
+def read_pfm(path):
+    """
+    :return: the [height, width, 3] float32 image of a PFM, top row first
+    """
+    with open(path, 'rb') as file:
+        assert file.readline().strip() == b'PF'
+        width, height = map(int, file.readline().split())
+        scale = float(file.readline())
+        img = np.frombuffer(file.read(), dtype='<f4' if scale < 0 else '>f4').reshape(height, width, 3)
+    return img[::-1].astype(np.float32)
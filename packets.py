@@ -0,0 +1,212 @@
+import numpy as np
+
+from bvh import Accelerator, BVH, get_inverse_directions, intersect_aabbs
+
+PACKET_SIZE = 16              # primary rays per packet, a square of pixels
+SHADOW_PACKET_SIZE = 4        # shadow rays per packet, the rays of a hit towards a light's grid are consecutive
+MIN_AXIAL_DIRECTION = 0.1     # of a packet's rays along its mean direction, wider packets aren't bounded by a frustum
+FRUSTUM_PADDING = 1e-6        # added to the frustum's planes, so rounding never culls a shape a ray grazes
+LEAVES_PER_ROUND = 4          # BVH leaves per packet whose rays are tested before the farther leaves are culled by the hits found
+
+
+def get_packet_frustums(origins, directions, limits, starts):
+    """
+    bound the rays of each packet by the half-spaces n.x + offset >= 0 of a frustum:
+    in a frame along the packet's mean direction, every ray moves sideways by a slope per unit of depth, so the ray points
+    are bounded by the lowest/highest slopes added to the lowest/highest sideways positions at the nearest origin's depth.
+    the frustum is also closed by that depth, and by the farthest limit the rays are searched to
+
+    :param limits: (N,) distance per ray beyond which shapes are skipped
+    :param starts: (P,) the first ray of each packet, the packets are consecutive runs of rays
+    :return: (P,6,3) normals and (P,6) offsets of the frustums' planes, and (P,) whether a packet's rays are bounded by its frustum
+    """
+    axes = np.add.reduceat(directions, starts, axis=0)
+    axes /= np.maximum(np.linalg.norm(axes, axis=1), 1e-30)[:, None]
+    helpers = np.where(np.abs(axes[:, 0:1]) < 0.9, [1., 0., 0.], [0., 1., 0.])
+    sides_one = np.cross(axes, helpers)
+    sides_one /= np.linalg.norm(sides_one, axis=1)[:, None]
+    sides_two = np.cross(axes, sides_one)
+
+    counts = np.diff(np.append(starts, len(origins)))
+    ray_axes, ray_sides_one, ray_sides_two = (np.repeat(vectors, counts, axis=0) for vectors in (axes, sides_one, sides_two))
+    axial_directions = np.einsum('ij,ij->i', directions, ray_axes)
+    bounded = np.minimum.reduceat(axial_directions, starts) > MIN_AXIAL_DIRECTION
+    axial_directions = np.maximum(axial_directions, MIN_AXIAL_DIRECTION)
+
+    axial_origins = np.einsum('ij,ij->i', origins, ray_axes)
+    near = np.minimum.reduceat(axial_origins, starts)
+    with np.errstate(invalid='ignore'):
+        far = np.maximum.reduceat(np.where(limits > 0, axial_origins + limits * axial_directions, -np.inf), starts)
+
+    normals, offsets = [], []
+    for ray_sides, sides in ((ray_sides_one, sides_one), (ray_sides_two, sides_two)):
+        slopes = np.einsum('ij,ij->i', directions, ray_sides) / axial_directions
+        # the sideways position of each ray at the nearest origin's depth
+        positions = np.einsum('ij,ij->i', origins, ray_sides) - slopes * (axial_origins - np.repeat(near, counts))
+        low_slopes, high_slopes = np.minimum.reduceat(slopes, starts), np.maximum.reduceat(slopes, starts)
+        normals += [sides - low_slopes[:, None] * axes, high_slopes[:, None] * axes - sides]
+        offsets += [low_slopes * near - np.minimum.reduceat(positions, starts), np.maximum.reduceat(positions, starts) - high_slopes * near]
+    normals += [axes, -axes]
+    offsets += [-near, far]
+
+    return np.stack(normals, axis=1), np.stack(offsets, axis=1) + FRUSTUM_PADDING, bounded
+
+
+def boxes_in_frustums(box_min, box_max, normals, offsets):
+    """
+    conservative test of axis aligned boxes against frustums, a box is outside if it's entirely behind one of the planes.
+    the arguments are broadcast against each other
+
+    :param normals: (...,6,3) and offsets (...,6) the frustums' planes, see `get_packet_frustums`
+    :return: (...) whether each box may overlap its frustum
+    """
+    centers, halves = (box_min + box_max) / 2, (box_max - box_min) / 2
+    with np.errstate(invalid='ignore'):
+        distances = np.einsum('...kj,...j->...k', normals, centers) + np.einsum('...kj,...j->...k', np.abs(normals), halves) + offsets
+    return np.all(distances >= 0, axis=-1)
+
+
+class PacketTracer(Accelerator):
+    """
+    traces coherent rays (the primary rays of a tile, the shadow rays of a hit) in packets of consecutive rays.
+    each packet is bounded by a frustum (see `get_packet_frustums`) which walks a BVH on behalf of all its rays,
+    the nodes outside of it are rejected for the whole packet, and only the rays of the packets reaching a leaf are tested against it,
+    first against its bounding box, then against its primitives. unbounded shapes (planes) are tested against every ray,
+    and the rays of packets too wide for a frustum traverse the BVH one by one
+
+    the BVH is the scene's accelerator if it's one, or a BVH of the tracer's own. a render process keeps a tracer on `scene.packets`,
+    the primary and shadow rays are traced through it, the other rays aren't coherent enough
+    """
+
+    COUNTERS = ('packets_traced', 'packet_candidates', 'wide_rays', 'rays_traced')
+
+    def __init__(self, scene, packet_size=PACKET_SIZE, shadow_packet_size=SHADOW_PACKET_SIZE):
+        """
+        :param packet_size: rays per packet of the closest hit queries (the primary rays)
+        :param shadow_packet_size: rays per packet of the occlusion queries (the shadow rays), which are less coherent
+        """
+        self.scene = scene
+        self.packet_size = packet_size
+        self.shadow_packet_size = shadow_packet_size
+        self._traced_packet_size = packet_size
+        self.bvh = scene.accel if isinstance(scene.accel, BVH) else BVH(scene)
+        self.packets_traced = 0
+        self.packet_candidates = 0
+        self.wide_rays = 0
+        self.rays_traced = 0
+
+    def report(self):
+        """
+        :return: a dict of the traversal statistics
+        """
+        bounded_shapes = len(self.bvh.prim_shape)
+        return {'packet_size': self.packet_size,
+                'shadow_packet_size': self.shadow_packet_size,
+                'bounded_shapes': bounded_shapes,
+                'unbounded_shapes': len(self.scene.plane_shapes),
+                'rays_traced': self.rays_traced,
+                'packets_traced': self.packets_traced,
+                'avg_candidates_per_packet': self.packet_candidates / max(self.packets_traced, 1),
+                'culled_shapes_rate': 1 - self.packet_candidates / max(self.packets_traced * bounded_shapes, 1),
+                'wide_rays': self.wide_rays}
+
+    def closest_hit_pixels(self, i, j, origins, directions, excluded):
+        """
+        `closest_hit` of the rays through the pixels (i, j), packed in squares of pixels
+        """
+        side = max(int(np.sqrt(self.packet_size)), 1)
+        order = np.lexsort((i, j, i // side, j // side))
+        distances, indices = np.empty(len(origins)), np.empty(len(origins), dtype=int)
+        distances[order], indices[order] = self.closest_hit(origins[order], directions[order], excluded[order])
+        return distances, indices
+
+    def closest_hit(self, origins, directions, excluded):
+        self._traced_packet_size = self.packet_size
+        return super().closest_hit(origins, directions, excluded)
+
+    def any_hit(self, origins, directions, max_distances, excluded, blockers=None):
+        self._traced_packet_size = self.shadow_packet_size
+        return super().any_hit(origins, directions, max_distances, excluded, blockers)
+
+    def _traverse(self, origins, directions, excluded, limits, visit_candidates):
+        """
+        cull the BVH against each packet's frustum, then visit the leaves in the frustum with the packet's rays
+
+        :param limits: (N,) distance per ray beyond which shapes are skipped, bounds the frustums' depth
+        :param visit_candidates: called with the (ray, shape, distance) triplets of the primitives in the visited leaves
+        """
+        if len(self.bvh.prim_shape) == 0 or len(origins) == 0:
+            return
+
+        starts = np.arange(0, len(origins), self._traced_packet_size)
+        ends = np.append(starts[1:], len(origins))
+        normals, offsets, bounded = get_packet_frustums(origins, directions, limits, starts)
+
+        wide = np.flatnonzero(~np.repeat(bounded, ends - starts))
+        if len(wide):
+            # the BVH searches a copy of the limits, which `visit_candidates` doesn't shrink, only costing extra tests
+            self.wide_rays += len(wide)
+            self.bvh._traverse(origins[wide], directions[wide], excluded[wide], limits[wide],
+                               lambda pair_rays, shape_ids, distances: visit_candidates(wide[pair_rays], shape_ids, distances))
+
+        packets = np.flatnonzero(bounded)
+        self.packets_traced += len(packets)
+        leaf_packets, leaf_ids = self._cull_nodes(normals[packets], offsets[packets])
+
+        # the near plane's normal is the packet's direction
+        axes = normals[packets][leaf_packets, 4]
+        depths = np.einsum('ij,ij->i', axes, self.bvh.node_min[leaf_ids] + self.bvh.node_max[leaf_ids]) / 2 \
+            - np.einsum('ij,ij->i', np.abs(axes), self.bvh.node_max[leaf_ids] - self.bvh.node_min[leaf_ids]) / 2
+        self._traverse_leaves(origins, directions, excluded, limits, visit_candidates, starts[packets][leaf_packets], ends[packets][leaf_packets],
+                              leaf_ids, depths)
+
+    def _cull_nodes(self, normals, offsets):
+        """
+        walk the BVH with whole packets instead of rays
+
+        :param normals: (P,6,3) and offsets (P,6) the packets' frustums
+        :return: (packet, leaf) pairs of the leaves which may be in each packet's frustum
+        """
+        bvh = self.bvh
+        packet_ids = np.arange(len(normals))
+        node_ids = np.zeros(len(normals), dtype=int)
+        leaf_packets, leaf_ids = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+        while len(packet_ids):
+            inside = boxes_in_frustums(bvh.node_min[node_ids], bvh.node_max[node_ids], normals[packet_ids], offsets[packet_ids])
+            packet_ids, node_ids = packet_ids[inside], node_ids[inside]
+
+            leaf = bvh.node_left[node_ids] == -1
+            leaf_packets.append(packet_ids[leaf])
+            leaf_ids.append(node_ids[leaf])
+
+            inner_packets, inner_nodes = packet_ids[~leaf], node_ids[~leaf]
+            packet_ids = np.concatenate([inner_packets, inner_packets])
+            node_ids = np.concatenate([bvh.node_left[inner_nodes], bvh.node_right[inner_nodes]])
+
+        return np.concatenate(leaf_packets), np.concatenate(leaf_ids)
+
+    def _traverse_leaves(self, origins, directions, excluded, limits, visit_candidates, starts, ends, leaf_ids, depths):
+        """
+        test the rays of each packet against the bounding boxes of the leaves in its frustum, then against the primitives of the leaves they enter.
+        the leaves are visited front to back in rounds of `LEAVES_PER_ROUND` per packet, so the hits found so far cull the farther leaves
+
+        :param starts: (C,) and ends (C,) the range of rays of each leaf's packet
+        :param depths: (C,) where each leaf starts along its packet's direction
+        """
+        bvh = self.bvh
+        self.packet_candidates += int(np.sum(bvh.node_count[leaf_ids]))
+        order = np.lexsort((depths, starts))
+        first = np.flatnonzero(np.append(True, starts[order][1:] != starts[order][:-1]))
+        rounds = (np.arange(len(order)) - np.repeat(first, np.diff(np.append(first, len(order))))) // LEAVES_PER_ROUND
+        # the pairs grouped by round, so each round is a contiguous range
+        order = order[np.argsort(rounds, kind='stable')]
+        round_starts = np.cumsum(np.bincount(rounds)) - np.bincount(rounds)
+
+        for selected in np.split(order, round_starts[1:]):
+            counts = ends[selected] - starts[selected]
+            ray_ids = np.repeat(starts[selected] - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))
+            node_ids = np.repeat(leaf_ids[selected], counts)
+
+            t_enter, t_exit = intersect_aabbs(origins[ray_ids], get_inverse_directions(directions[ray_ids]), bvh.node_min[node_ids], bvh.node_max[node_ids])
+            alive = (t_exit >= np.maximum(t_enter, 0)) & (t_enter <= limits[ray_ids])
+            visit_candidates(*bvh._intersect_leaves(origins, directions, excluded, ray_ids[alive], node_ids[alive]))
@@ -0,0 +1,162 @@
+from multiprocessing import Pool
+
+import numpy as np
+
+from RayTracer import render_tile
+from batch import render_tile_batch
+from stats import RenderStats
+
+TILE_RENDERERS = {'scalar': render_tile,
+                  'batch':  render_tile_batch}
+
+_worker_scene = None  # set once per worker process by `_init_worker`
+
+
+def split_tiles(height, width, tile_size):
+    """
+    :return: a list of (x_start, x_end, y_start, y_end) tiles covering the image, in a fixed order
+    """
+    return [(x_start, min(x_start + tile_size, width), y_start, min(y_start + tile_size, height))
+            for y_start in range(0, height, tile_size)
+            for x_start in range(0, width, tile_size)]
+
+
+def get_tile_rng(seed, tile_index):
+    """
+    the soft shadows' randomness of a tile depends only on the seed and the tile,
+    so the image is the same no matter which worker renders it, or how many workers there are
+    """
+    return np.random.default_rng([seed, tile_index])
+
+
+def render_tiles(height, width, scene, engine='scalar', tile_size=64, workers=1, seed=None, img=None, done=None):
+    """
+    render the image tile by tile, in a pool of `workers` processes
+
+    the compiled scene (with its acceleration structure) is sent to every worker once, when it starts. the tiles wait on the pool's shared task queue,
+    and each worker takes the next tile as soon as it finishes its previous one, so a few expensive
+    (reflective/transparent) tiles don't hold the other workers back
+
+    :param seed: the seed of the soft shadows' randomness, None for a random seed
+    :param img: the [height, width, 3] float32 array to render into (e.g. a memory-mapped framebuffer), a new one by default
+    :param done: (tiles,) bool array of the tiles already rendered into `img`, which are skipped. updated as the tiles finish
+    :return: a [height, width, 3] float32 image
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    if img is None:
+        img = np.zeros([height, width, 3], dtype=np.float32)  # converted to uint8 before saving
+    tiles = [(tile_index, tile) for tile_index, tile in enumerate(split_tiles(height, width, tile_size)) if done is None or not done[tile_index]]
+    worker_args = (height, width, scene, engine, seed)
+
+    for tile_index, tile, colors in _map_tiles(scene, tiles, worker_args, workers):
+        _write_tile(img, done, height, tile_index, tile, colors)
+    return img
+
+
+def render_tile_rows(height, width, scene, engine='scalar', tile_size=64, workers=1, seed=None, bottom_up=False):
+    """
+    render the image like `render_tiles`, one row of tiles at a time, for a streaming encoder (see `output`).
+    only the rows of tiles being rendered are kept in memory, however large the image is
+
+    :param seed: the seed of the soft shadows' randomness, None for a random seed. the image is the same as `render_tiles`'
+    :param bottom_up: yield the rows of tiles from the bottom of the image rather than from the top
+    :return: a generator of [rows, width, 3] float32 bands of the image (top row first), from the top of the image down,
+             or from the bottom of the image up if `bottom_up`
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    tiles = list(enumerate(split_tiles(height, width, tile_size)))
+    if not bottom_up:
+        # the tiles are split from the bottom row up, keeping their order within a row
+        tiles.sort(key=lambda indexed_tile: -indexed_tile[1][2])
+    worker_args = (height, width, scene, engine, seed)
+
+    band, band_y_start = None, None
+    for _, (x_start, x_end, y_start, y_end), colors in _map_tiles(scene, tiles, worker_args, workers, ordered=True):
+        if y_start != band_y_start:
+            if band is not None:
+                yield band
+            band, band_y_start = np.zeros([y_end - y_start, width, 3], dtype=np.float32), y_start
+        band[:, x_start:x_end] = colors
+    if band is not None:
+        yield band
+
+
+def _map_tiles(scene, tiles, worker_args, workers, ordered=False):
+    """
+    render the (tile_index, tile) pairs, merging the tiles' statistics into the scene's
+
+    :param ordered: yield the tiles in the order of `tiles`, rather than as soon as they're rendered
+    :return: a generator of (tile_index, tile, colors)
+    """
+    if workers <= 1:
+        _init_worker(*worker_args)
+        for tile_index, tile, colors, _, tile_stats in map(_render_tile_task, tiles):
+            _merge_stats(scene.stats, tile_stats)
+            yield tile_index, tile, colors
+        return
+
+    with Pool(workers, initializer=_init_worker, initargs=worker_args) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for tile_index, tile, colors, accel_counters, tile_stats in imap(_render_tile_task, tiles, chunksize=1):
+            _add_accel_counters(scene, accel_counters)
+            _merge_stats(scene.stats, tile_stats)
+            yield tile_index, tile, colors
+
+
+def _write_tile(img, done, height, tile_index, tile, colors):
+    x_start, x_end, y_start, y_end = tile
+    img[height - y_end:height - y_start, x_start:x_end] = colors
+    if done is None:
+        return
+
+    # a memory-mapped tile is on disk before it's marked as done, so an interrupted render never skips a lost tile
+    if isinstance(img, np.memmap):
+        img.flush()
+    done[tile_index] = True
+    if isinstance(done, np.memmap):
+        done.flush()
+
+
+def _get_accelerators(scene):
+    return [accel for accel in (scene.accel, scene.packets) if accel is not None]
+
+
+def _get_accel_counters(scene):
+    return [tuple(getattr(accel, counter) for counter in accel.COUNTERS) for accel in _get_accelerators(scene)]
+
+
+def _add_accel_counters(scene, accel_counters):
+    # the workers traverse copies of the acceleration structures, collect their statistics in the originals
+    for accel, counters in zip(_get_accelerators(scene), accel_counters):
+        for counter, value in zip(accel.COUNTERS, counters):
+            setattr(accel, counter, getattr(accel, counter) + value)
+
+
+def _merge_stats(stats, tile_stats):
+    if stats is not None:
+        stats.merge(tile_stats)
+
+
+def _init_worker(height, width, scene, engine, seed):
+    global _worker_scene
+    _worker_scene = (height, width, scene, engine, seed)
+
+
+def _render_tile_task(indexed_tile):
+    tile_index, tile = indexed_tile
+    height, width, scene, engine, seed = _worker_scene
+    counters_before = _get_accel_counters(scene)
+    # each tile is counted on its own, the caller merges the tiles' statistics
+    stats = scene.stats
+    if stats is not None:
+        scene.stats = RenderStats()
+    colors = TILE_RENDERERS[engine](*tile, height, width, scene, get_tile_rng(seed, tile_index))
+    tile_stats, scene.stats = scene.stats, stats
+    accel_counters = [tuple(after - before for after, before in zip(accel_after, accel_before))
+                      for accel_after, accel_before in zip(_get_accel_counters(scene), counters_before)]
+
+    return tile_index, tile, colors, accel_counters, tile_stats
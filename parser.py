@@ -1,6 +1,14 @@
+from array import array
+
 import numpy as np
 
 from classes import Camera, Set, Material, Light, Sphere, Plane, Box
+from scene import Scene, SPHERE, PLANE, BOX
+from utils import norm2
+
+SHAPE_CODES = {'sph': SPHERE, 'pln': PLANE, 'box': BOX}
+SHAPE_VALUES = 5  # every shape line has 4 geometry values and a material index
+LINES_PER_CHUNK = 2 ** 16  # the shape lines `parse_arrays` buffers before parsing them at once
 
 
 def parse(scene_path, width, height):
@@ -17,22 +25,11 @@ def parse(scene_path, width, height):
             values = [float(v) for v in line[3:].split()]
             print(code, values)
             if code == 'cam':
-                camera = Camera(position=np.array(values[0:3]),
-                                look_at=np.array(values[3:6]),
-                                up=np.array(values[6:9]),
-                                screen_dist=values[9],
-                                screen_width=values[10],
-                                screen_height=values[10]/width*height)
+                camera = make_camera(values, width, height)
             elif code == 'set':
-                set_params = Set(background_rgb=np.array(values[0:3]),
-                                 root_shadow_rays=int(values[3]),
-                                 max_recursions=int(values[4]))
+                set_params = make_set(values)
             elif code == 'mtl':
-                materials.append(Material(diffuse_rgb=np.array(values[0:3]),
-                                          specular_rgb=np.array(values[3:6]),
-                                          reflect_rgb=np.array(values[6:9]),
-                                          phong=values[9],
-                                          transp=values[10]))
+                materials.append(make_material(values))
             elif code == 'sph':
                 shapes.append(Sphere(center=np.array(values[0:3]),
                                      radius=values[3],
@@ -46,10 +43,110 @@ def parse(scene_path, width, height):
                                   length=values[3],
                                   material=int(values[4])))
             elif code == 'lgt':
-                lights.append(Light(position=np.array(values[0:3]),
-                                    rgb=np.array(values[3:6]),
-                                    specular_intens=values[6],
-                                    shadow_intens=values[7],
-                                    radius=values[8]))
+                lights.append(make_light(values))
 
     return camera, set_params, materials, lights, shapes
+
+
+def make_camera(values, width, height):
+    return Camera(position=np.array(values[0:3]),
+                  look_at=np.array(values[3:6]),
+                  up=np.array(values[6:9]),
+                  screen_dist=values[9],
+                  screen_width=values[10],
+                  screen_height=values[10]/width*height)
+
+
+def make_set(values):
+    return Set(background_rgb=np.array(values[0:3]),
+               root_shadow_rays=int(values[3]),
+               max_recursions=int(values[4]))
+
+
+def make_material(values):
+    return Material(diffuse_rgb=np.array(values[0:3]),
+                    specular_rgb=np.array(values[3:6]),
+                    reflect_rgb=np.array(values[6:9]),
+                    phong=values[9],
+                    transp=values[10])
+
+
+def make_light(values):
+    return Light(position=np.array(values[0:3]),
+                 rgb=np.array(values[3:6]),
+                 specular_intens=values[6],
+                 shadow_intens=values[7],
+                 radius=values[8])
+
+
+def parse_arrays(scene_path):
+    """
+    stream the scene file without holding its lines, the shape lines are parsed a chunk at a time straight into arrays
+
+    :return: the values of the cam line, of the set line, of each mtl line and of each lgt line,
+             and a dict of the shapes' arrays (see `get_shape_arrays`)
+    """
+    camera_values, set_values = None, None
+    material_values, light_values = [], []
+    shape_types = array('b')
+    shape_chunks, pending_lines = [], []
+    with open(scene_path, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+
+            code = line[:3]
+            if code in SHAPE_CODES:
+                shape_types.append(SHAPE_CODES[code])
+                pending_lines.append(line[3:])
+                if len(pending_lines) == LINES_PER_CHUNK:
+                    shape_chunks.append(_parse_shape_lines(pending_lines))
+                    pending_lines = []
+                continue
+
+            values = [float(v) for v in line[3:].split()]
+            if code == 'cam':
+                camera_values = values
+            elif code == 'set':
+                set_values = values
+            elif code == 'mtl':
+                material_values.append(values)
+            elif code == 'lgt':
+                light_values.append(values)
+
+    shape_chunks.append(_parse_shape_lines(pending_lines))
+    shape_arrays = get_shape_arrays(np.frombuffer(shape_types, dtype=np.int8), np.concatenate(shape_chunks))
+    return camera_values, set_values, material_values, light_values, shape_arrays
+
+
+def _parse_shape_lines(lines):
+    values = np.array(' '.join(lines).split(), dtype=float)
+    if len(values) != len(lines) * SHAPE_VALUES:
+        raise ValueError(f'expected {SHAPE_VALUES} values per shape line, got {len(values)} values in {len(lines)} lines')
+    return values.reshape(-1, SHAPE_VALUES)
+
+
+def get_shape_arrays(shape_types, shape_values):
+    """
+    :param shape_types: (S,) SPHERE, PLANE or BOX per shape line
+    :param shape_values: (S,5) the shape lines' values
+    :return: a dict of the arguments of `Scene.from_arrays` describing the shapes
+    """
+    spheres, planes, boxes = (shape_values[shape_types == shape_type] for shape_type in (SPHERE, PLANE, BOX))
+    # the normals are normalized and the offsets kept, like `classes.Plane` does
+    plane_normals = planes[:, 0:3] / norm2(planes[:, 0:3], axis=1, keepdims=True)
+    return {'shape_types': shape_types.astype(int),
+            'shape_materials': shape_values[:, 4].astype(int) - 1,
+            'sphere_centers': spheres[:, 0:3], 'sphere_radii': spheres[:, 3],
+            'plane_normals': plane_normals, 'plane_offsets': planes[:, 3],
+            'box_mins': boxes[:, 0:3] - boxes[:, 3:4] / 2, 'box_maxs': boxes[:, 0:3] + boxes[:, 3:4] / 2}
+
+
+def compile_scene(camera_values, set_values, material_values, light_values, shape_arrays, width, height):
+    """
+    :return: the `Scene` of the values returned by `parse_arrays`
+    """
+    return Scene.from_arrays(make_camera(camera_values, width, height), make_set(set_values),
+                             [make_material(values) for values in material_values], [make_light(values) for values in light_values],
+                             **shape_arrays)
@@ -0,0 +1,88 @@
+from time import time
+
+import numpy as np
+
+from parallel import TILE_RENDERERS, split_tiles
+from output import save_image
+
+
+def render_progressive(height, width, scene, engine='batch', tile_size=32, seed=None, coarse_step=8, max_passes=8, tolerance=0.01,
+                       time_budget=None, preview_path=None, preview_interval=5.):
+    """
+    render the image progressively, so a useful picture is available early
+
+    a coarse pass first renders one pixel per coarse_step x coarse_step block. then every pass renders each tile once more,
+    with new soft shadow samples, and the tile's pixels become the mean of its passes.
+    a tile stops being refined once the standard error of all its pixels' means is within `tolerance`
+    (the soft shadows are the only noise, a tile without soft shadows converges after 2 passes)
+
+    :param seed: the seed of the soft shadows' randomness, None for a random seed
+    :param max_passes: the most passes a tile is rendered in
+    :param tolerance: the standard error, in color units, below which a tile is converged
+    :param time_budget: seconds after which no more tiles are rendered, the unrendered tiles keep their coarse pixels
+    :param preview_path: where the intermediate images are written (see `output.save_image`), every `preview_interval` seconds
+    :return: a [height, width, 3] float32 image
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    start = time()
+    render_tile = TILE_RENDERERS[engine]
+
+    coarse_height, coarse_width = -(-height // coarse_step), -(-width // coarse_step)
+    coarse = render_tile(0, coarse_width, 0, coarse_height, coarse_height, coarse_width, scene, np.random.default_rng([seed, 0, 0]))
+    # the coarse pixels span the whole screen, each pixel takes the coarse pixel its center falls in
+    rows = ((np.arange(height) + 0.5) * coarse_height / height).astype(int)
+    columns = ((np.arange(width) + 0.5) * coarse_width / width).astype(int)
+    img = coarse[rows][:, columns]
+    if scene.stats is not None:
+        scene.stats.tile_costs.pop()  # the coarse pixels aren't the image's pixels
+    last_preview = time()
+    if preview_path is not None:
+        save_image(img, preview_path)
+
+    sums = np.zeros([height, width, 3])
+    squares = np.zeros([height, width, 3])
+    tiles = split_tiles(height, width, tile_size)
+    passes = np.zeros(len(tiles), dtype=int)
+    active = list(range(len(tiles)))
+    for pass_index in range(1, max_passes + 1):
+        for tile_index in active:
+            if time_budget is not None and time() - start > time_budget:
+                return img
+
+            x_start, x_end, y_start, y_end = tiles[tile_index]
+            colors = render_tile(x_start, x_end, y_start, y_end, height, width, scene, np.random.default_rng([seed, tile_index, pass_index]))
+            pixels = np.s_[height - y_end:height - y_start, x_start:x_end]
+            sums[pixels] += colors
+            squares[pixels] += colors ** 2
+            passes[tile_index] += 1
+            img[pixels] = sums[pixels] / passes[tile_index]
+
+            if preview_path is not None and time() - last_preview > preview_interval:
+                save_image(img, preview_path)
+                last_preview = time()
+
+        noisy = []
+        for tile_index in active:
+            x_start, x_end, y_start, y_end = tiles[tile_index]
+            pixels = np.s_[height - y_end:height - y_start, x_start:x_end]
+            if get_standard_error(sums[pixels], squares[pixels], passes[tile_index]) > tolerance:
+                noisy.append(tile_index)
+        active = noisy
+        print(f'pass {pass_index}: {len(active)} of {len(tiles)} tiles are still refined, {time() - start:.2f} seconds')
+        if not active:
+            break
+
+    return img
+
+
+def get_standard_error(sums, squares, count):
+    """
+    :param sums: the sums of `count` samples of some values
+    :param squares: the sums of the samples' squares
+    :return: the largest standard error of the values' means, np.inf before 2 samples
+    """
+    if count < 2:
+        return np.inf
+    variances = np.maximum(squares / count - (sums / count) ** 2, 0) * count / (count - 1)
+    return np.sqrt(np.max(variances) / count)
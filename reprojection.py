@@ -0,0 +1,176 @@
+import numpy as np
+
+from batch import trace_primary_rays, trace_generations, resolve_generations
+from gbuffer import get_geometry_key
+from parallel import split_tiles, get_tile_rng
+from scene import NO_SHAPE
+from stats import timed
+from utils import get_viewing_window_vectors
+
+REPROJECTION_TOLERANCE = 1.  # the distance between a hit and its reprojected one, in pixel footprints, up to which they're the same hit
+MAX_AGE = 8                  # frames a pixel's soft shadows are reused for before they're traced again
+
+
+def project_points(points, camera, height, width):
+    """
+    the inverse of `batch.construct_rays_through_pixels`: the pixels whose primary rays pass nearest to the points
+
+    :param points: (N,3) world space points
+    :return: (N,) indices of the pixels in a [height, width] image (top row first), -1 for the points out of the camera's view
+    """
+    towards, up_perp, width_direction = get_viewing_window_vectors(camera)
+    vectors = points - camera.position
+    depths = vectors @ towards
+    with np.errstate(divide='ignore', invalid='ignore'):
+        i = np.round((vectors @ width_direction * camera.screen_dist / depths / camera.screen_width + 0.5) * width)
+        j = np.round((vectors @ up_perp * camera.screen_dist / depths / camera.screen_height + 0.5) * height)
+    visible = (depths > 0) & (i >= 0) & (i < width) & (j >= 0) & (j < height)
+    return np.where(visible, (height - 1 - np.where(visible, j, 0)) * width + np.where(visible, i, 0), -1).astype(int)
+
+
+class ReprojectedFrame:
+    """
+    the primary hits of a rendered frame per pixel, and the view independent part of their shading worth keeping: their soft shadows.
+    the diffuse and specular terms are cheap to shade again, and the reflection and transparency rays depend on the view
+    """
+
+    def __init__(self, camera, height, width, num_lights):
+        self.camera = camera
+        self.height = height
+        self.width = width
+        self.points = np.full((height * width, 3), np.nan)
+        self.indices = np.full(height * width, NO_SHAPE)
+        self.perc_rays_hit = np.full((num_lights, height * width), np.nan)  # NaN where a light's shadow rays weren't traced
+        self.ages = np.zeros(height * width, dtype=int)
+        self._uniform_shadows = None
+
+    def lookup(self, camera, points, indices, max_age=MAX_AGE, tolerance=REPROJECTION_TOLERANCE):
+        """
+        reproject hits of a new frame into this frame, a hit is found again if the pixel it falls in saw the same shape
+        within `tolerance` pixel footprints of it, and its soft shadows were traced less than `max_age` frames ago.
+        the hit reuses the shadows which are uniform around the pixel (see `get_uniform_shadows`)
+
+        :param camera: the new frame's camera
+        :param points: (N,3) the new frame's hits, and indices (N,) their shapes (NO_SHAPE for none)
+        :return: (L,N) the cached soft shadows of the hits, NaN for the ones to trace, and (N,) the pixels of the hits found again, -1 for none
+        """
+        pixels = project_points(np.where(indices[:, None] == NO_SHAPE, camera.position, points), self.camera, self.height, self.width)
+        found = (pixels >= 0) & (indices != NO_SHAPE)
+        found[found] = (self.indices[pixels[found]] == indices[found]) & (self.ages[pixels[found]] < max_age)
+
+        # a pixel's footprint grows with the distance, on the new camera's screen
+        footprints = np.linalg.norm(points[found] - camera.position, axis=1) * camera.screen_width / (camera.screen_dist * self.width)
+        found[found] = np.linalg.norm(self.points[pixels[found]] - points[found], axis=1) <= tolerance * footprints
+        pixels = np.where(found, pixels, -1)
+
+        cached_perc_rays_hit = np.full((len(self.perc_rays_hit), len(points)), np.nan)
+        cached_perc_rays_hit[:, found] = np.where(self.get_uniform_shadows()[:, pixels[found]], self.perc_rays_hit[:, pixels[found]], np.nan)
+        return cached_perc_rays_hit, pixels
+
+    def get_uniform_shadows(self):
+        """
+        whether each pixel's soft shadow of each light equals its 8 neighbours' which see the same shape, out of the edges
+        of the shadows. a hit moving a fraction of a pixel keeps such a shadow, the others are traced again
+
+        :return: (L, height * width) bool array
+        """
+        if self._uniform_shadows is None:
+            perc_rays_hit = self.perc_rays_hit.reshape(-1, self.height, self.width)
+            indices = self.indices.reshape(self.height, self.width)
+            padded_perc_rays_hit = np.pad(perc_rays_hit, ((0, 0), (1, 1), (1, 1)), mode='edge')
+            padded_indices = np.pad(indices, 1, mode='edge')
+            uniform = np.ones(perc_rays_hit.shape, dtype=bool)
+            for row, column in ((0, 0), (0, 1), (0, 2), (1, 0), (1, 2), (2, 0), (2, 1), (2, 2)):
+                rows, columns = slice(row, row + self.height), slice(column, column + self.width)
+                uniform &= (padded_indices[rows, columns] != indices) | (padded_perc_rays_hit[:, rows, columns] == perc_rays_hit)
+            self._uniform_shadows = uniform.reshape(len(uniform), -1)
+        return self._uniform_shadows
+
+    def store(self, pixels, generation, previous, previous_pixels):
+        """
+        :param pixels: (N,) the pixels of a tile's primary rays, and generation their first `batch.Generation`
+        :param previous: the `ReprojectedFrame` the hits were looked up in, or None
+        :param previous_pixels: (N,) the pixels of `previous` the rays' hits were found again in, -1 for none
+        """
+        hit_pixels = pixels[generation.hit]
+        self.points[hit_pixels] = generation.points
+        self.indices[hit_pixels] = generation.indices
+        self.perc_rays_hit[:, hit_pixels] = np.where(generation.reached & (generation.light_weights > 0), generation.perc_rays_hit, np.nan)
+        self.ages[pixels] = 0
+        if previous is None:
+            return
+
+        # reused soft shadows stay at the point they were traced at, so they don't drift along with the camera
+        reused = previous_pixels >= 0
+        self.points[pixels[reused]] = previous.points[previous_pixels[reused]]
+        self.ages[pixels[reused]] = previous.ages[previous_pixels[reused]] + 1
+
+
+class ReprojectionCache:
+    """
+    the last frame rendered by `render_reprojected`, for the next frame of a moving camera to reuse the soft shadows of the hits
+    both frames see. a frame of another scene (see `gbuffer.get_geometry_key`) or another size is traced in full
+    """
+
+    def __init__(self, max_age=MAX_AGE, tolerance=REPROJECTION_TOLERANCE):
+        self.max_age = max_age
+        self.tolerance = tolerance
+        self.key = None
+        self.frame = None
+        self.primary_hits = 0
+        self.reprojected_hits = 0
+
+    def report(self):
+        """
+        :return: a dict of the reuse statistics
+        """
+        return {'primary_hits': self.primary_hits,
+                'reprojected_hits': self.reprojected_hits,
+                'reprojection_rate': self.reprojected_hits / max(self.primary_hits, 1)}
+
+
+def render_reprojected(height, width, scene, cache, tile_size=64, seed=None):
+    """
+    render like `parallel.render_tiles` with the batch engine, in a single process. the primary rays are traced in full, the hits
+    the previous frame in the cache saw too reuse its soft shadows (see `ReprojectedFrame.lookup`), the other hits and the rays
+    they spawn are traced as usual. the frame then replaces the previous one in the cache
+
+    :param cache: a `ReprojectionCache`
+    :param seed: the seed of the soft shadows' randomness, None for a random seed
+    :return: a [height, width, 3] float32 image
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    key = get_geometry_key(scene, height, width, {}, with_camera=False)
+    previous = cache.frame if cache.key == key else None
+    frame = ReprojectedFrame(scene.camera, height, width, scene.num_lights)
+
+    img = np.zeros([height, width, 3], dtype=np.float32)  # converted to uint8 before saving
+    for tile_index, (x_start, x_end, y_start, y_end) in enumerate(split_tiles(height, width, tile_size)):
+        j, i = np.mgrid[y_end - 1:y_start - 1:-1, x_start:x_end]
+        i, j = i.ravel(), j.ravel()
+        with timed(scene.stats, 'primary'):
+            origins, directions, distances, indices, excluded = trace_primary_rays(i, j, height, width, scene)
+
+        hit = indices != NO_SHAPE
+        points = np.where(hit[:, None], origins + np.where(hit, distances, 0)[:, None] * directions, np.nan)
+        if previous is None:
+            cached_perc_rays_hit, previous_pixels = None, np.full(len(i), -1)
+        else:
+            cached_perc_rays_hit, previous_pixels = previous.lookup(scene.camera, points, indices, cache.max_age, cache.tolerance)
+
+        with timed(scene.stats, 'shading'):
+            generations = trace_generations(origins, directions, distances, indices, scene, scene.set_params.max_recursions, excluded,
+                                            get_tile_rng(seed, tile_index), cached_perc_rays_hit)
+            colors, _ = resolve_generations(generations, scene)
+        img[height - y_end:height - y_start, x_start:x_end] = colors.reshape(y_end - y_start, x_end - x_start, 3)
+        if scene.stats is not None:
+            scene.stats.add_tile_costs(x_start, y_start, scene.stats.pixel_costs.reshape(y_end - y_start, x_end - x_start))
+
+        frame.store((height - 1 - j) * width + i, generations[0], previous, previous_pixels)
+        cache.primary_hits += int(np.sum(generations[0].hit))
+        cache.reprojected_hits += int(np.sum(previous_pixels >= 0))
+
+    cache.key, cache.frame = key, frame
+    return img
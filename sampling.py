@@ -0,0 +1,52 @@
+import numpy as np
+
+SAMPLING_METHODS = ['jitter', 'sobol']
+
+
+def get_shadow_sample_offsets(num_shadow_rays, radius, rng, sampling='jitter', size=()):
+    """
+    sample N x N points on the light's square, in its (axis_one, axis_two) coordinates
+
+    jitter: a random point in each cell of an N x N grid (the original method, same draws order)
+    sobol:  the first N x N points of the 2D Sobol sequence, randomized by a digital shift (xor) per sample set.
+            the points are stratified along every grid shape rather than only the N x N one,
+            so they cover the square more evenly than the jittered grid and converge with fewer rays
+
+    :param rng: the source of randomness, a np.random.Generator or the np.random module
+    :param size: a tuple, the leading shape of the output, one set of samples per entry
+    :return: size + (N*N, 2) array of offsets from the light's center
+    """
+    if sampling == 'jitter':
+        # Define a rectangle & divide the rectangle into a grid of N x N cells
+        rand_width = radius / num_shadow_rays
+        cell_centers = np.linspace(-radius/2+rand_width/2, radius/2-rand_width/2, num_shadow_rays)
+        cells = np.stack(np.meshgrid(cell_centers, cell_centers, indexing='ij'), axis=-1)
+        #  we select a random point in each cell (by uniformly sampling x value and y value)
+        perturbations = rng.uniform(size=size + (num_shadow_rays, num_shadow_rays, 2)) * rand_width - rand_width / 2
+        return (cells + perturbations).reshape(size + (num_shadow_rays * num_shadow_rays, 2))
+
+    if sampling == 'sobol':
+        points = get_sobol_points(num_shadow_rays * num_shadow_rays)
+        shifts = (rng.uniform(size=size + (1, 2)) * 2 ** 32).astype(np.uint64)
+        return ((points ^ shifts) / 2 ** 32 - 0.5) * radius
+
+    raise ValueError(f'unknown sampling method {sampling}, expected one of {SAMPLING_METHODS}')
+
+
+def get_sobol_points(count):
+    """
+    the first `count` points of the 2D Sobol sequence, a (0,2)-sequence in base 2:
+    any 2^m consecutive points are stratified in every 2^a x 2^b grid with a + b = m
+
+    :return: (count, 2) uint64 array of 32 bit fixed point coordinates
+    """
+    indices = np.arange(count, dtype=np.uint64)
+    points = np.zeros((count, 2), dtype=np.uint64)
+    direction = np.uint64(1 << 31)
+    for bit in range(32):
+        has_bit = (indices >> np.uint64(bit)) & np.uint64(1) == 1
+        points[has_bit, 0] ^= np.uint64(1 << (31 - bit))  # van der Corput, the bits reversed
+        points[has_bit, 1] ^= direction
+        direction ^= direction >> np.uint64(1)
+
+    return points
@@ -0,0 +1,274 @@
+import numpy as np
+
+from classes import Sphere, Plane, Box, RenderOptions, TANGENT_TOLERANCE, intersect_spheres, intersect_planes, intersect_boxes
+
+NO_SHAPE = -1
+
+SPHERE = 0
+PLANE  = 1
+BOX    = 2
+SHAPE_TYPES = {Sphere: SPHERE, Plane: PLANE, Box: BOX}
+SHAPE_NAMES = {SPHERE: 'sphere', PLANE: 'plane', BOX: 'box'}
+
+MAX_PAIRS_PER_BATCH = 2 ** 18  # bounds the memory of the (ray, shape) distance matrices
+
+
+class Scene:
+    """
+    the scene compiled to structure-of-arrays storage, consumed by the render hot paths
+
+    every shape has a global index (its position in the scene file), a type and a local index into its type's arrays:
+    sphere_centers/sphere_radii, plane_normals/plane_offsets, box_mins/box_maxs.
+    {sphere,plane,box}_shapes map the other way, from local to global indices.
+    the materials and the lights are stored as arrays of their fields.
+    the dataclasses in `classes` remain the authoring API, `shapes`, `materials` and `lights` keep them for reference
+    (`shapes` is None for a scene compiled `from_arrays`).
+
+    `accel` is an optional acceleration structure (e.g. `bvh.BVH`) answering `closest_hit` and `any_hit` instead of brute force
+    `stats` is an optional `stats.RenderStats` the renderers count their work in
+    `shadow_cache` is an optional `shadows.OccluderCache` the shadow rays are tested against first
+    `packets` is an optional `packets.PacketTracer` the primary and shadow rays are traced through
+    `backend` is 'numpy', or 'numba' for the compiled loops of `kernels` (see `kernels.get_backend`)
+    `options` are the `classes.RenderOptions` the engines render with
+    """
+
+    def __init__(self, camera, set_params, materials, lights, shapes):
+        self.camera = camera
+        self.set_params = set_params
+        self.materials = materials
+        self.lights = lights
+        self.shapes = shapes
+        self.accel = None
+        self.stats = None
+        self.shadow_cache = None
+        self.packets = None
+        self.backend = 'numpy'
+        self.options = RenderOptions()
+
+        shape_types = np.array([SHAPE_TYPES[type(shape)] for shape in shapes], dtype=int)
+        spheres = [shape for shape in shapes if type(shape) is Sphere]
+        planes = [shape for shape in shapes if type(shape) is Plane]
+        boxes = [shape for shape in shapes if type(shape) is Box]
+        self._set_shapes(shape_types, np.array([shape.material - 1 for shape in shapes], dtype=int),
+                         np.array([sphere.center for sphere in spheres], dtype=float).reshape(-1, 3),
+                         np.array([sphere.radius for sphere in spheres], dtype=float),
+                         np.array([plane.normal for plane in planes], dtype=float).reshape(-1, 3),
+                         np.array([plane.offset for plane in planes], dtype=float),
+                         np.array([box._box_min for box in boxes], dtype=float).reshape(-1, 3),
+                         np.array([box._box_max for box in boxes], dtype=float).reshape(-1, 3))
+
+        self.material_diffuse = np.array([material.diffuse_rgb for material in materials], dtype=float).reshape(-1, 3)
+        self.material_specular = np.array([material.specular_rgb for material in materials], dtype=float).reshape(-1, 3)
+        self.material_reflect = np.array([material.reflect_rgb for material in materials], dtype=float).reshape(-1, 3)
+        self.material_phong = np.array([material.phong for material in materials], dtype=float)
+        self.material_transp = np.array([material.transp for material in materials], dtype=float)
+
+        self.light_positions = np.array([light.position for light in lights], dtype=float).reshape(-1, 3)
+        self.light_rgb = np.array([light.rgb for light in lights], dtype=float).reshape(-1, 3)
+        self.light_specular_intens = np.array([light.specular_intens for light in lights], dtype=float)
+        self.light_shadow_intens = np.array([light.shadow_intens for light in lights], dtype=float)
+        self.light_radius = np.array([light.radius for light in lights], dtype=float)
+
+    @classmethod
+    def from_arrays(cls, camera, set_params, materials, lights, shape_types, shape_materials,
+                    sphere_centers, sphere_radii, plane_normals, plane_offsets, box_mins, box_maxs):
+        """
+        compile a scene whose shapes are given as arrays rather than dataclasses, the arrays are used as they are (e.g. memory-mapped)
+
+        :param shape_types: (S,) SPHERE, PLANE or BOX per shape, in the scene's order
+        :param shape_materials: (S,) the shapes' 0-based material indices
+        """
+        scene = cls(camera, set_params, materials, lights, [])
+        scene.shapes = None
+        scene._set_shapes(shape_types, shape_materials, sphere_centers, sphere_radii, plane_normals, plane_offsets, box_mins, box_maxs)
+        return scene
+
+    def _set_shapes(self, shape_types, shape_materials, sphere_centers, sphere_radii, plane_normals, plane_offsets, box_mins, box_maxs):
+        self.shape_types = shape_types
+        self.shape_materials = shape_materials
+        self.shape_locals = np.zeros(len(shape_types), dtype=int)
+        for shape_type in SHAPE_TYPES.values():
+            of_type = shape_types == shape_type
+            self.shape_locals[of_type] = np.arange(np.sum(of_type))
+
+        self.sphere_shapes = np.flatnonzero(shape_types == SPHERE)
+        self.sphere_centers = sphere_centers
+        self.sphere_radii = sphere_radii
+
+        self.plane_shapes = np.flatnonzero(shape_types == PLANE)
+        self.plane_normals = plane_normals
+        self.plane_offsets = plane_offsets
+
+        self.box_shapes = np.flatnonzero(shape_types == BOX)
+        self.box_mins = box_mins
+        self.box_maxs = box_maxs
+
+    @property
+    def num_shapes(self):
+        return len(self.shape_types)
+
+    @property
+    def num_lights(self):
+        return len(self.light_positions)
+
+    def get_bounds(self):
+        """
+        :return: (global indices, (B,2,3) min/max corners) of the bounded shapes' axis aligned bounding boxes
+        """
+        sphere_extent = self.sphere_radii[:, None] + TANGENT_TOLERANCE
+        sphere_bounds = np.stack([self.sphere_centers - sphere_extent, self.sphere_centers + sphere_extent], axis=1)
+        box_bounds = np.stack([self.box_mins - TANGENT_TOLERANCE, self.box_maxs + TANGENT_TOLERANCE], axis=1)
+        return np.concatenate([self.sphere_shapes, self.box_shapes]), np.concatenate([sphere_bounds, box_bounds])
+
+    def closest_hit(self, origins, directions, excluded):
+        """
+        :param origins: (N,3) ray origins
+        :param directions: (N,3) normalized ray directions
+        :param excluded: (N,K) indices of shapes to ignore per ray, padded with NO_SHAPE
+        :return: (N,) distances to the closest intersections (np.inf for none) and (N,) indices of the hit shapes (NO_SHAPE for none)
+        """
+        if self.accel is not None:
+            return self.accel.closest_hit(origins, directions, excluded)
+        return self.brute_force_closest_hit(origins, directions, excluded)
+
+    def any_hit(self, origins, directions, max_distances, excluded, blockers=None):
+        """
+        :param max_distances: (N,) the length of the segment tested per ray
+        :param blockers: optional (N,) int array, set to a shape blocking each blocked ray (the first found, not the closest)
+        :return: (N,) whether any shape blocks each ray before its max distance
+        """
+        if self.accel is not None:
+            return self.accel.any_hit(origins, directions, max_distances, excluded, blockers)
+        return self.brute_force_any_hit(origins, directions, max_distances, excluded, blockers=blockers)
+
+    def brute_force_closest_hit(self, origins, directions, excluded, shape_types=(SPHERE, PLANE, BOX)):
+        """
+        `closest_hit` testing every shape of the given types, all the shapes of a type at once
+        """
+        if self.backend == 'numba':
+            import kernels
+            return kernels.closest_hit(self._get_kernel_shapes(origins, shape_types), origins, directions, excluded, *self._get_kernel_arrays())
+
+        best_distances = np.full(len(origins), np.inf)
+        best_indices = np.full(len(origins), NO_SHAPE)
+        for shape_type in shape_types:
+            for rays, shape_ids, distances in self._iterate_distances(shape_type, origins, directions, excluded):
+                # argmin picks the first of equal distances, the lowest index wins ties like the scalar search
+                closest = np.argmin(distances, axis=1)
+                distances = distances[np.arange(len(closest)), closest]
+                shape_ids = shape_ids[closest]
+                closer = (distances < best_distances[rays]) | ((distances == best_distances[rays]) & (shape_ids < best_indices[rays]))
+                best_distances[rays[closer]] = distances[closer]
+                best_indices[rays[closer]] = shape_ids[closer]
+
+        return best_distances, best_indices
+
+    def brute_force_any_hit(self, origins, directions, max_distances, excluded, shape_types=(SPHERE, PLANE, BOX), blockers=None):
+        """
+        `any_hit` testing every shape of the given types, rays which were blocked are not tested again
+        """
+        if self.backend == 'numba':
+            import kernels
+            found = kernels.any_hit(self._get_kernel_shapes(origins, shape_types), origins, directions, max_distances, excluded, *self._get_kernel_arrays())
+            occluded = found != NO_SHAPE
+            if blockers is not None:
+                blockers[occluded] = found[occluded]
+            return occluded
+
+        occluded = np.zeros(len(origins), dtype=bool)
+        for shape_type in shape_types:
+            alive = np.flatnonzero(~occluded)
+            for rays, shape_ids, distances in self._iterate_distances(shape_type, origins[alive], directions[alive], excluded[alive]):
+                blocking = distances < max_distances[alive[rays], None]
+                blocked = np.any(blocking, axis=1)
+                occluded[alive[rays]] |= blocked
+                if blockers is not None:
+                    blockers[alive[rays[blocked]]] = shape_ids[np.argmax(blocking[blocked], axis=1)]
+
+        return occluded
+
+    def _get_kernel_shapes(self, origins, shape_types):
+        shape_ids = np.sort(np.concatenate([self._get_type_shapes(shape_type) for shape_type in shape_types]))
+        if self.stats is not None:
+            for shape_type in shape_types:
+                self.stats.count_tests(SHAPE_NAMES[shape_type], len(origins) * len(self._get_type_shapes(shape_type)))
+        return shape_ids
+
+    def _get_kernel_arrays(self):
+        return (self.shape_types, self.shape_locals, self.sphere_centers, self.sphere_radii,
+                self.plane_normals, self.plane_offsets, self.box_mins, self.box_maxs)
+
+    def _iterate_distances(self, shape_type, origins, directions, excluded):
+        """
+        yield (ray indices, shape indices, distance matrix) for chunks of rays against all the shapes of a type
+        """
+        shape_ids = self._get_type_shapes(shape_type)
+        if len(shape_ids) == 0 or len(origins) == 0:
+            return
+
+        chunk_size = max(1, MAX_PAIRS_PER_BATCH // len(shape_ids))
+        for start in range(0, len(origins), chunk_size):
+            rays = np.arange(start, min(start + chunk_size, len(origins)))
+            distances = self._get_type_distances(shape_type, origins[rays, None], directions[rays, None], slice(None))
+            distances[np.any(excluded[rays, :, None] == shape_ids, axis=1)] = np.inf
+            yield rays, shape_ids, distances
+
+    def _get_type_shapes(self, shape_type):
+        return {SPHERE: self.sphere_shapes, PLANE: self.plane_shapes, BOX: self.box_shapes}[shape_type]
+
+    def _get_type_distances(self, shape_type, origins, directions, local_indices):
+        if shape_type == SPHERE:
+            distances = intersect_spheres(origins, directions, self.sphere_centers[local_indices], self.sphere_radii[local_indices])
+        elif shape_type == PLANE:
+            distances = intersect_planes(origins, directions, self.plane_normals[local_indices], self.plane_offsets[local_indices])
+        else:
+            distances = intersect_boxes(origins, directions, self.box_mins[local_indices], self.box_maxs[local_indices])
+
+        if self.stats is not None:
+            self.stats.count_tests(SHAPE_NAMES[shape_type], distances.size)
+        return distances
+
+    def get_distances(self, indices, origins, directions):
+        """
+        :param indices: (N,) the shape to intersect, per ray
+        :return: (N,) the distances along the rays to their shapes, np.inf for none
+        """
+        if self.backend == 'numba':
+            import kernels
+            if self.stats is not None:
+                for shape_type, count in zip(*np.unique(self.shape_types[indices], return_counts=True)):
+                    self.stats.count_tests(SHAPE_NAMES[shape_type], count)
+            return kernels.get_distances(indices, origins, directions, *self._get_kernel_arrays())
+
+        distances = np.full(len(indices), np.inf)
+        shape_types = self.shape_types[indices]
+        for shape_type in np.unique(shape_types):
+            mask = shape_types == shape_type
+            distances[mask] = self._get_type_distances(shape_type, origins[mask], directions[mask], self.shape_locals[indices[mask]])
+
+        return distances
+
+    def get_normals(self, indices, points):
+        """
+        :param indices: (N,) the shape to evaluate the normal of, per point
+        :param points: (N,3) points
+        :return: (N,3) the normals of the shapes at the points, like `Shape.normal_at_point`
+        """
+        normals = np.zeros_like(points)
+        shape_types = self.shape_types[indices]
+        local_indices = self.shape_locals[indices]
+
+        spheres = shape_types == SPHERE
+        sphere_normals = points[spheres] - self.sphere_centers[local_indices[spheres]]
+        normals[spheres] = sphere_normals / np.linalg.norm(sphere_normals, axis=1, keepdims=True)
+
+        planes = shape_types == PLANE
+        normals[planes] = self.plane_normals[local_indices[planes]]
+
+        # we're axis aligned, the normal is the face the point is on
+        boxes = shape_types == BOX
+        box_max_mask = np.abs(points[boxes] - self.box_maxs[local_indices[boxes]]) < TANGENT_TOLERANCE
+        box_min_mask = np.abs(points[boxes] - self.box_mins[local_indices[boxes]]) < TANGENT_TOLERANCE
+        normals[boxes] = np.where(np.any(box_max_mask, axis=1, keepdims=True), box_max_mask, -box_min_mask.astype(float))
+
+        return normals
@@ -0,0 +1,85 @@
+import argparse
+import json
+
+import numpy as np
+
+from parser import parse_arrays, compile_scene
+
+MAGIC = b'RTSCENE1'
+ALIGNMENT = 64  # of the arrays' offsets in the file, so they can be viewed in place
+
+
+def save_binary_scene(path, camera_values, set_values, material_values, light_values, shape_arrays):
+    """
+    write the values returned by `parser.parse_arrays` in the binary scene format:
+    the magic, the header's length (uint64), a JSON header of the non-shape values and of the arrays' layout,
+    then the shapes' arrays, each at an aligned offset
+    """
+    layout = {}
+    offset = 0
+    for name, values in shape_arrays.items():
+        values = np.ascontiguousarray(values)
+        layout[name] = {'dtype': values.dtype.str, 'shape': values.shape, 'offset': offset}
+        offset += -(-values.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header = json.dumps({'camera': camera_values, 'set': set_values, 'materials': material_values, 'lights': light_values,
+                         'arrays': layout}).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+    with open(path, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(np.uint64(len(header)).tobytes())
+        fp.write(header)
+        for name, values in shape_arrays.items():
+            fp.seek(data_start + layout[name]['offset'])
+            fp.write(np.ascontiguousarray(values).tobytes())
+        fp.truncate(data_start + offset)
+
+
+def load_binary_scene(path):
+    """
+    map a binary scene file, its shapes' arrays are read-only views of the mapped file
+
+    :return: the same values as `parser.parse_arrays`
+    """
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    header_length = int(buffer[len(MAGIC):len(MAGIC) + 8].view(np.uint64)[0])
+    header = json.loads(bytes(buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_length]))
+    data_start = -(-(len(MAGIC) + 8 + header_length) // ALIGNMENT) * ALIGNMENT
+
+    shape_arrays = {}
+    for name, layout in header['arrays'].items():
+        dtype = np.dtype(layout['dtype'])
+        start = data_start + layout['offset']
+        count = int(np.prod(layout['shape']))
+        shape_arrays[name] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(layout['shape'])
+
+    return header['camera'], header['set'], header['materials'], header['lights'], shape_arrays
+
+
+def is_binary_scene(path):
+    with open(path, 'rb') as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def load_scene(path, width, height):
+    """
+    :param path: a text scene file, or a binary one made by `convert`
+    :return: the compiled `scene.Scene`
+    """
+    values = load_binary_scene(path) if is_binary_scene(path) else parse_arrays(path)
+    return compile_scene(*values, width, height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='convert a text scene file to the binary scene format')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help='Convert a text scene file to a binary one')
+    convert_parser.add_argument('scene',  help='The input text scene path',   type=str)
+    convert_parser.add_argument('output', help='The output binary scene path', type=str)
+    args = parser.parse_args()
+
+    save_binary_scene(args.output, *parse_arrays(args.scene))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from multiprocessing import Pool
+from time import time
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from parallel import render_tiles
+from scene_file import load_scene
+from utils import write_img
+
+MAX_SCENE_FILES = 1024  # the uploaded scene files kept on disk, the least recently used ones no job needs are deleted
+LATENCY_WINDOW = 1000   # the latest jobs the latency statistics are computed over
+
+_worker_scenes = None      # the LRU cache of compiled scenes of a worker process, set by `_init_worker`
+_worker_cache_size = None
+
+
+class RenderServer:
+    """
+    render jobs in a pool of warm worker processes. every worker keeps an LRU cache of the compiled scenes
+    (with their acceleration structure), keyed by the scene file's content hash, the image's size and the acceleration structure,
+    so a job of a cached scene only pays for tracing its rays
+    """
+
+    def __init__(self, workers=1, scene_cache_size=16):
+        self.workers = workers
+        self.scene_directory = tempfile.mkdtemp(prefix='render_server_')
+        self.scene_files = OrderedDict()  # digest -> path, in least recently used order
+        self.scene_jobs = {}  # digest -> the jobs queued or running on the scene, its file isn't deleted until they're done
+        self.pool = Pool(workers, initializer=_init_worker, initargs=(scene_cache_size,))
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.jobs_done = 0
+        self.scene_cache_hits = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def render(self, scene_contents, width, height, engine='batch', accel='bvh', tile_size=64, seed=0):
+        """
+        :param scene_contents: the bytes of a text or binary scene file
+        :return: a [height, width, 3] float32 image, and a dict of the job's timings in seconds:
+                 its time waiting in the queue, setting up the scene (only a lookup on a scene cache hit), rendering and overall
+        """
+        start = time()
+        digest, scene_path = self._store_scene(scene_contents)
+        with self.lock:
+            self.in_flight += 1
+        try:
+            img, timings, cache_hit = self.pool.apply(_render_job, ((scene_path, width, height, engine, accel, tile_size, seed, start),))
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self._release_scene(digest)
+
+        timings['latency'] = time() - start
+        with self.lock:
+            self.jobs_done += 1
+            self.scene_cache_hits += cache_hit
+            self.latencies.append(timings['latency'])
+        return img, timings
+
+    def _store_scene(self, scene_contents):
+        """
+        store the scene file of a job, which keeps it from being deleted until the job is done
+
+        :return: the scene's content hash, and the path of the scene file named by it, written unless an earlier job uploaded it
+        """
+        digest = hashlib.sha256(scene_contents).hexdigest()
+        with self.lock:
+            self.scene_jobs[digest] = self.scene_jobs.get(digest, 0) + 1
+            if digest in self.scene_files:
+                self.scene_files.move_to_end(digest)
+                return digest, self.scene_files[digest]
+
+            path = os.path.join(self.scene_directory, digest)
+            with open(path + '.tmp', 'wb') as fp:
+                fp.write(scene_contents)
+            os.replace(path + '.tmp', path)
+            self.scene_files[digest] = path
+            self._evict_scenes()
+            return digest, path
+
+    def _release_scene(self, digest):
+        """
+        mark a job of the scene as done, its file may then be deleted
+        """
+        with self.lock:
+            self.scene_jobs[digest] -= 1
+            if self.scene_jobs[digest] == 0:
+                del self.scene_jobs[digest]
+            self._evict_scenes()
+
+    def _evict_scenes(self):
+        """
+        delete the least recently used scene files beyond `MAX_SCENE_FILES` which no job needs, called with the lock held
+        """
+        evicted = [digest for digest in self.scene_files if digest not in self.scene_jobs][:max(len(self.scene_files) - MAX_SCENE_FILES, 0)]
+        for digest in evicted:
+            os.remove(self.scene_files.pop(digest))
+
+    def get_status(self):
+        """
+        :return: a dict of the number of workers, the jobs waiting for a worker (queue_depth) and running,
+                 the jobs done, their scene cache hits and their latency statistics in seconds
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            in_flight = self.in_flight
+            status = {'workers': self.workers,
+                      'queue_depth': max(in_flight - self.workers, 0),
+                      'running': min(in_flight, self.workers),
+                      'jobs_done': self.jobs_done,
+                      'scene_cache_hits': self.scene_cache_hits}
+
+        if len(latencies) > 0:
+            status['latency'] = {'mean': float(latencies.mean()),
+                                 'p50': float(np.percentile(latencies, 50)),
+                                 'p95': float(np.percentile(latencies, 95)),
+                                 'max': float(latencies.max())}
+        return status
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.scene_directory, ignore_errors=True)
+
+
+def _init_worker(scene_cache_size):
+    global _worker_scenes, _worker_cache_size
+    _worker_scenes = OrderedDict()
+    _worker_cache_size = scene_cache_size
+
+
+def _render_job(job):
+    scene_path, width, height, engine, accel, tile_size, seed, submit_time = job
+    start = time()
+    key = (os.path.basename(scene_path), width, height, accel)
+    cache_hit = key in _worker_scenes
+    if cache_hit:
+        _worker_scenes.move_to_end(key)
+        scene = _worker_scenes[key]
+    else:
+        scene = load_scene(scene_path, width, height)
+        if accel == 'bvh':
+            from bvh import BVH
+            scene.accel = BVH(scene)
+        elif accel == 'grid':
+            from grid import Grid
+            scene.accel = Grid(scene)
+        _worker_scenes[key] = scene
+        if len(_worker_scenes) > _worker_cache_size:
+            _worker_scenes.popitem(last=False)
+
+    render_start = time()
+    img = render_tiles(height, width, scene, engine, tile_size, seed=seed)
+    timings = {'queue': start - submit_time, 'setup': render_start - start, 'render': time() - render_start}
+    return img, timings, cache_hit
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /render?width=W&height=H[&engine=batch&accel=bvh&tile_size=64&seed=0&format=png] with the scene file as the body
+    responds with the PNG (format=png) or the raw [height, width, 3] float32 buffer (format=raw), the job's timings are in
+    the X-Render-Timings header. GET /status responds with the JSON of `RenderServer.get_status`
+    """
+
+    server_version = 'RenderServer'
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/status':
+            self.send_error(404)
+            return
+        self._respond(json.dumps(self.server.render_server.get_status()).encode(), 'application/json')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/render':
+            self.send_error(404)
+            return
+
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            width, height = int(query['width']), int(query['height'])
+            engine = query.get('engine', 'batch')
+            accel = query.get('accel', 'bvh')
+            tile_size = int(query.get('tile_size', 64))
+            seed = int(query.get('seed', 0))
+            output_format = query.get('format', 'png')
+            if engine not in ('scalar', 'batch') or accel not in ('none', 'bvh', 'grid') or output_format not in ('png', 'raw'):
+                raise ValueError(f'unknown engine, accel or format in {query}')
+        except (KeyError, ValueError) as e:
+            self.send_error(400, str(e))
+            return
+
+        scene_contents = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            img, timings = self.server.render_server.render(scene_contents, width, height, engine, accel, tile_size, seed)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        headers = {'X-Render-Timings': json.dumps(timings), 'X-Width': str(width), 'X-Height': str(height)}
+        if output_format == 'raw':
+            self._respond(img.astype(np.float32).tobytes(), 'application/octet-stream', headers)
+        else:
+            buffer = io.BytesIO()
+            write_img(img, buffer, format='PNG')
+            self._respond(buffer.getvalue(), 'image/png', headers)
+
+    def _respond(self, body, content_type, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # the latencies are reported by /status
+
+
+def make_server(host='127.0.0.1', port=8000, workers=1, scene_cache_size=16):
+    """
+    :return: a `ThreadingHTTPServer` of a `RenderServer`, call its serve_forever(), then its render_server.close()
+    """
+    http_server = ThreadingHTTPServer((host, port), RenderRequestHandler)
+    http_server.render_server = RenderServer(workers, scene_cache_size)
+    return http_server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='serve render jobs over HTTP from a pool of warm worker processes, '
+                                                 'e.g. curl --data-binary @scene.txt "localhost:8000/render?width=64&height=64" -o out.png')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', help='The number of processes rendering jobs in parallel', type=int, default=1)
+    parser.add_argument('--scene-cache', help='The compiled scenes each worker keeps', type=int, default=16)
+    args = parser.parse_args()
+
+    http_server = make_server(args.host, args.port, args.workers, args.scene_cache)
+    print(f'serving render jobs on {args.host}:{http_server.server_address[1]} with {args.workers} workers')
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        http_server.render_server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import numpy as np
+
+from scene import NO_SHAPE
+from utils import atol
+
+OCCLUDER_CACHE_SIZE = 4  # the latest distinct blockers an `OccluderCache` keeps per light
+PROBE_OFFSETS = np.array([[-0.5, -0.5], [-0.5, 0.5], [0.5, -0.5], [0.5, 0.5]])  # the corners of the light's square, in radii
+
+
+class OccluderCache:
+    """
+    per light, the shapes which blocked its latest shadow rays. the shadow rays of neighbouring hits are mostly blocked by the same shapes,
+    so they're tested against those first, and the rays they block skip the search of the whole scene.
+    the cache is refreshed from the blockers the searches of the other rays find anyway, so it never adds a search.
+    a render process keeps one on `scene.shadow_cache` (off by default), it only decides the order of the tests, not their outcome
+    """
+
+    def __init__(self, num_lights, size=OCCLUDER_CACHE_SIZE):
+        self.size = size
+        self.occluders = [np.zeros(0, dtype=int) for _ in range(num_lights)]
+
+    def test(self, light, origins, directions, max_distances, scene, excluded):
+        """
+        :return: (N,) whether one of the light's cached occluders blocks each ray before its max distance
+        """
+        occluded = np.zeros(len(origins), dtype=bool)
+        for shape in self.occluders[light]:
+            tested = np.flatnonzero(~occluded & ~np.any(excluded == shape, axis=1))
+            distances = scene.get_distances(np.full(len(tested), shape), origins[tested], directions[tested])
+            occluded[tested] = distances < max_distances[tested]
+        return occluded
+
+    def update(self, light, blockers):
+        """
+        :param blockers: shapes which blocked the light's latest rays, the most common first
+        """
+        shapes, counts = np.unique(blockers, return_counts=True)
+        recent = np.concatenate([shapes[np.argsort(-counts, kind='stable')], self.occluders[light]])
+        _, first = np.unique(recent, return_index=True)
+        self.occluders[light] = recent[np.sort(first)][:self.size]
+
+
+def find_shadow_occlusions(light, origins, directions, max_distances, scene, excluded):
+    """
+    `scene.Scene.any_hit` of a light's shadow rays, through the scene's `OccluderCache` and `PacketTracer` if it has them
+
+    :param light: the index of the light the rays come from
+    :return: (N,) whether any shape blocks each ray before its max distance
+    """
+    any_hit = scene.any_hit if scene.packets is None else scene.packets.any_hit
+    cache = scene.shadow_cache
+    if cache is None:
+        return any_hit(origins, directions, max_distances, excluded)
+
+    # the rays blocked by the cached occluders skip the search, the blockers the search finds refresh the cache for the next batch
+    occluded = cache.test(light, origins, directions, max_distances, scene, excluded)
+    missed = np.flatnonzero(~occluded)
+    blockers = np.full(len(missed), NO_SHAPE)
+    occluded[missed] = any_hit(origins[missed], directions[missed], max_distances[missed], excluded[missed], blockers)
+    cache.update(light, blockers[blockers != NO_SHAPE])
+    if scene.stats is not None:
+        scene.stats.count_shadows('cache_blocked', np.sum(occluded))
+        scene.stats.count_shadows('cache_hits', len(origins) - len(missed))
+
+    return occluded
+
+
+def probe_shadows(light, light_position, axis_one, axis_two, radius, intersection_points, scene, excluded):
+    """
+    trace the shadow rays from the corners of the light's square. a hit whose corners are all lit or all blocked is taken
+    to be out of the penumbra, so its N x N shadow rays can be skipped
+
+    :param axis_one: (N,3) and axis_two (N,3) the light's square axes per hit
+    :return: (N,) the fraction of the probes which reach each hit, and the indices of the hits whose probes disagree
+    """
+    offsets = PROBE_OFFSETS * radius
+    probes_per_point = len(offsets)
+    sample_points = light_position + axis_one[:, None] * offsets[None, :, 0:1] + axis_two[:, None] * offsets[None, :, 1:2]
+    sample_points = sample_points.reshape(-1, 3)
+
+    shadow_directions = np.repeat(intersection_points, probes_per_point, axis=0) - sample_points
+    shadow_distances = np.linalg.norm(shadow_directions, axis=1)
+    shadow_directions = shadow_directions / shadow_distances[:, None]
+
+    occluded = find_shadow_occlusions(light, sample_points, shadow_directions, shadow_distances - atol, scene,
+                                      np.repeat(excluded, probes_per_point, axis=0))
+    perc_probes_hit = np.mean(~occluded.reshape(-1, probes_per_point), axis=1)
+    unresolved = np.flatnonzero((perc_probes_hit > 0) & (perc_probes_hit < 1))
+    if scene.stats is not None:
+        scene.stats.count_rays('shadow', len(sample_points))
+        scene.stats.count_shadows('probed_points', len(intersection_points))
+        scene.stats.count_shadows('early_outs', len(intersection_points) - len(unresolved))
+
+    return perc_probes_hit, unresolved
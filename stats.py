@@ -0,0 +1,141 @@
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+import numpy as np
+
+RAY_KINDS = ['primary', 'shadow', 'reflection', 'transmission']
+PHASES = ['primary', 'shading', 'shadow', 'reflection', 'transmission']
+SHADOW_COUNTERS = ['cache_blocked', 'cache_hits', 'probed_points', 'early_outs']
+
+
+class RenderStats:
+    """
+    counters of the work done by a render, collected while a `RenderStats` is set on `scene.stats`
+    (the hot paths skip the counting when it's None)
+
+    rays:        the rays traced by kind
+    tests:       the ray-shape intersection tests by shape class
+    depths:      the hits shaded by recursion depth (the reflections bounced so far)
+    phase_times: the seconds spent in each phase, a phase's time excludes the phases nested in it
+    tile_costs:  (x_start, y_start, costs) of the rendered tiles, the rays traced for each pixel (top row first)
+    shadows:     the blocked shadow rays tested against the occluder cache and those it blocked,
+                 the hits whose corner probes were traced and those resolved by them (see `shadows`)
+
+    pixel_costs is the scratch space of the batch engine, the costs of the tile it renders
+    """
+
+    def __init__(self):
+        self.rays = dict.fromkeys(RAY_KINDS, 0)
+        self.tests = {}
+        self.depths = {}
+        self.phase_times = dict.fromkeys(PHASES, 0.)
+        self.tile_costs = []
+        self.shadows = dict.fromkeys(SHADOW_COUNTERS, 0)
+        self.pixel_costs = None
+        self._phases = []
+        self._phase_start = None
+
+    @property
+    def total_rays(self):
+        return sum(self.rays.values())
+
+    def count_rays(self, kind, count):
+        self.rays[kind] += int(count)
+
+    def count_tests(self, shape_class, count):
+        self.tests[shape_class] = self.tests.get(shape_class, 0) + int(count)
+
+    def count_shadows(self, counter, count):
+        self.shadows[counter] += int(count)
+
+    def count_depths(self, depths):
+        """
+        :param depths: (N,) the recursion depths of N shaded hits
+        """
+        for depth, count in enumerate(np.bincount(depths)):
+            if count:
+                self.depths[depth] = self.depths.get(depth, 0) + int(count)
+
+    def add_tile_costs(self, x_start, y_start, costs):
+        self.tile_costs.append((x_start, y_start, costs))
+
+    @contextmanager
+    def time_phase(self, phase):
+        now = perf_counter()
+        if self._phases:
+            self.phase_times[self._phases[-1]] += now - self._phase_start
+        self._phases.append(phase)
+        self._phase_start = now
+        try:
+            yield
+        finally:
+            now = perf_counter()
+            self.phase_times[self._phases.pop()] += now - self._phase_start
+            self._phase_start = now
+
+    def merge(self, other):
+        """
+        add the counters of another render, e.g. of a tile rendered by a worker process
+        """
+        for kind, count in other.rays.items():
+            self.rays[kind] += count
+        for shape_class, count in other.tests.items():
+            self.count_tests(shape_class, count)
+        for depth, count in other.depths.items():
+            self.depths[depth] = self.depths.get(depth, 0) + count
+        for phase, seconds in other.phase_times.items():
+            self.phase_times[phase] += seconds
+        self.tile_costs += other.tile_costs
+        for counter, count in other.shadows.items():
+            self.shadows[counter] += count
+
+    def get_heatmap(self, height, width):
+        """
+        :return: a [height, width] array of the rays traced for each pixel, over all the times it was rendered
+        """
+        heatmap = np.zeros([height, width])
+        for x_start, y_start, costs in self.tile_costs:
+            heatmap[height - y_start - costs.shape[0]:height - y_start, x_start:x_start + costs.shape[1]] += costs
+        return heatmap
+
+    def report(self):
+        """
+        :return: a dict of the counters
+        """
+        return {'rays': dict(self.rays),
+                'total_rays': self.total_rays,
+                'tests': dict(self.tests),
+                'depths': dict(sorted(self.depths.items())),
+                'phase_times': dict(self.phase_times),
+                'shadows': {**self.shadows,
+                            'cache_hit_rate': self.shadows['cache_hits'] / max(self.shadows['cache_blocked'], 1),
+                            'early_out_rate': self.shadows['early_outs'] / max(self.shadows['probed_points'], 1)}}
+
+
+def timed(stats, phase):
+    """
+    :return: a context timing the phase in `stats`, or doing nothing if it's None
+    """
+    return nullcontext() if stats is None else stats.time_phase(phase)
+
+
+def get_heatmap_colors(heatmap):
+    """
+    map the costs to black-red-yellow-white colors, relative to the most expensive pixel
+
+    :return: [height, width, 3] colors in [0, 1]
+    """
+    scaled = heatmap / max(heatmap.max(), 1)
+    return np.clip(3 * scaled[..., None] - np.arange(3), 0, 1)
+
+
+def get_peak_rss_mb():
+    """
+    :return: the peak resident memory of this process and of its finished children (the render workers) in MB, None where it's unknown
+    """
+    try:
+        import resource
+    except ImportError:  # windows
+        return None
+    # ru_maxrss is in KB on linux
+    return max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)) / 1024
@@ -1,5 +1,8 @@
+import sys
+
 import pytest
 from classes import Camera, Set, Material, Light, Sphere, Plane, Box, Ray
+from scene import Scene
 from utils import norm2
 
 import numpy as np
@@ -51,3 +54,577 @@ def test_box_intersection():
     ray = Ray(origin=np.array([1., 0., 0.]), direction=np.array([-1., -1., 0.])) # behind
     point = box.find_intersection(ray)
     assert point == False
+
+
+def make_scene():
+    camera = Camera(position=np.array([0., 2., -8.]), look_at=np.array([0., 0., 0.]), up=np.array([0., 1., 0.]),
+                    screen_dist=1.5, screen_width=2., screen_height=2.)
+    set_params = Set(background_rgb=np.array([0.2, 0.3, 0.4]), root_shadow_rays=2, max_recursions=3)
+    materials = [Material(diffuse_rgb=np.array([0.8, 0.1, 0.1]), specular_rgb=np.array([1., 1., 1.]), reflect_rgb=np.array([0.2, 0.2, 0.2]), phong=30, transp=0),
+                 Material(diffuse_rgb=np.array([0.1, 0.8, 0.1]), specular_rgb=np.array([.5, .5, .5]), reflect_rgb=np.array([0., 0., 0.]), phong=10, transp=0.5),
+                 Material(diffuse_rgb=np.array([0.6, 0.6, 0.6]), specular_rgb=np.array([0., 0., 0.]), reflect_rgb=np.array([0.3, 0.3, 0.3]), phong=1, transp=0)]
+    lights = [Light(position=np.array([0., 5., -3.]), rgb=np.array([1., 1., 1.]), specular_intens=1, shadow_intens=0.8, radius=0),
+              Light(position=np.array([-4., 4., 0.]), rgb=np.array([.5, .5, .8]), specular_intens=0.5, shadow_intens=0.6, radius=0)]
+    shapes = [Plane(material=3, normal=np.array([0., 1., 0.]), offset=-1.),
+              Sphere(material=1, center=np.array([0., 0., 0.]), radius=1.),
+              Sphere(material=2, center=np.array([1.5, 0.2, 1.]), radius=0.8),
+              Box(material=1, center=np.array([-1.8, -0.2, 0.5]), length=1.2)]
+    return camera, set_params, materials, lights, shapes
+
+
+def test_batched_intersections():
+    rng = np.random.default_rng(0)
+    origins = rng.uniform(-4, 4, size=(200, 3))
+    directions = rng.normal(size=(200, 3))
+    directions /= norm2(directions, axis=1, keepdims=True)
+    scene = Scene(*make_scene())
+
+    for index, shape in enumerate(scene.shapes):
+        distances = scene.get_distances(np.full(len(origins), index), origins, directions)
+        for origin, direction, distance in zip(origins, directions, distances):
+            point = shape.find_intersection(Ray(origin=origin, direction=direction.copy()))
+            if point is False or np.dot(point - origin, direction) < 0:
+                assert distance == np.inf
+            else:
+                assert np.allclose(origin + distance * direction, point)
+
+
+def test_batch_engine_matches_scalar():
+    from RayTracer import ray_cast
+    from batch import ray_cast_batch
+
+    scene = Scene(*make_scene())
+    scalar_img = ray_cast(12, 12, scene)
+    batch_img = ray_cast_batch(12, 12, scene, tile_size=5)
+    assert np.allclose(scalar_img, batch_img, atol=1e-5)
+
+
+def test_wavefront_terminates_deep_reflections():
+    from batch import ray_cast_batch
+
+    # two facing mirrors, deeper than the python recursion limit
+    camera, set_params, materials, lights, _ = make_scene()
+    shapes = [Plane(material=3, normal=np.array([0., 0., -1.]), offset=-5.),
+              Plane(material=3, normal=np.array([0., 0., 1.]), offset=-10.)]
+    set_params.max_recursions = 20
+    reference_img = ray_cast_batch(4, 4, Scene(camera, set_params, materials, lights, shapes))
+
+    set_params.max_recursions = 2 * sys.getrecursionlimit()
+    scene = Scene(camera, set_params, materials, lights, shapes)
+    scene.options.min_throughput = 1e-4
+    img = ray_cast_batch(4, 4, scene)
+    assert np.allclose(img, reference_img, atol=1e-3)
+
+
+def test_bvh_matches_brute_force():
+    from bvh import BVH
+
+    rng = np.random.default_rng(1)
+    shapes = [Plane(material=1, normal=np.array([0., 1., 0.]), offset=-6.)]
+    for k in range(60):
+        center = rng.uniform(-5, 5, size=3)
+        shapes.append(Sphere(material=1, center=center, radius=rng.uniform(0.2, 1)) if k % 2 else Box(material=1, center=center, length=rng.uniform(0.2, 1)))
+    origins = rng.uniform(-8, 8, size=(300, 3))
+    directions = rng.normal(size=(300, 3))
+    directions /= norm2(directions, axis=1, keepdims=True)
+    excluded = rng.integers(-1, len(shapes), size=(300, 2))
+
+    scene = Scene(*make_scene()[:4], shapes)
+    bvh = BVH(scene, leaf_size=2)
+    expected_distances, expected_indices = scene.closest_hit(origins, directions, excluded)
+    distances, indices = bvh.closest_hit(origins, directions, excluded)
+    assert np.array_equal(indices, expected_indices)
+    assert np.allclose(distances[indices >= 0], expected_distances[indices >= 0])
+    assert bvh.report()['avg_nodes_visited_per_ray'] < bvh.num_nodes
+
+
+def test_parallel_render_is_deterministic():
+    from parallel import render_tiles
+
+    camera, set_params, materials, lights, shapes = make_scene()
+    lights[0].radius = 1.
+    scene = Scene(camera, set_params, materials, lights, shapes)
+    serial_img = render_tiles(10, 10, scene, engine='batch', tile_size=4, workers=1, seed=7)
+    parallel_img = render_tiles(10, 10, scene, engine='batch', tile_size=4, workers=2, seed=7)
+    assert np.array_equal(serial_img, parallel_img)
+
+
+def test_occlusion_queries():
+    from bvh import BVH
+    from packets import PacketTracer
+    from shadows import OccluderCache, find_shadow_occlusions
+
+    scene = Scene(*make_scene())
+    shapes = scene.shapes
+    rng = np.random.default_rng(2)
+    origins = rng.uniform(-4, 4, size=(200, 3))
+    targets = rng.uniform(-4, 4, size=(200, 3))
+    max_distances = norm2(targets - origins, axis=1)
+    directions = (targets - origins) / max_distances[:, None]
+    excluded = rng.integers(-1, len(shapes), size=(200, 1))
+
+    def occludes(shape, ray, max_distance):
+        point = shape.find_intersection(ray)
+        return point is not False and 0 <= ray.project(point) < max_distance
+
+    expected = np.array([any(index not in e and occludes(shape, Ray(origin=o, direction=d.copy()), m) for index, shape in enumerate(shapes))
+                         for o, d, m, e in zip(origins, directions, max_distances, excluded)])
+    assert 0 < expected.sum() < len(expected)
+
+    # the shadow rays' path through the accelerators, the occluder cache and the packets, in turn
+    blockers = np.full(len(origins), -1)
+    assert np.array_equal(find_shadow_occlusions(0, origins, directions, max_distances, scene, excluded), expected)
+    assert np.array_equal(scene.any_hit(origins, directions, max_distances, excluded, blockers), expected)
+    assert np.all(scene.get_distances(blockers[expected], origins[expected], directions[expected]) < max_distances[expected])
+    scene.accel = BVH(scene, leaf_size=1)
+    assert np.array_equal(find_shadow_occlusions(0, origins, directions, max_distances, scene, excluded), expected)
+    scene.shadow_cache = OccluderCache(scene.num_lights)
+    for _ in range(2):  # empty, then holding the blockers of the first batch
+        assert np.array_equal(find_shadow_occlusions(0, origins, directions, max_distances, scene, excluded), expected)
+    scene.packets = PacketTracer(scene)
+    assert np.array_equal(find_shadow_occlusions(0, origins, directions, max_distances, scene, excluded), expected)
+
+
+def test_shadow_sample_offsets():
+    from sampling import get_shadow_sample_offsets
+
+    rng = np.random.default_rng(3)
+    jitter = get_shadow_sample_offsets(4, 2., rng, 'jitter', (5,))
+    assert jitter.shape == (5, 16, 2)
+    cells = np.floor((jitter + 1.) / 0.5).astype(int)  # every sample falls in its own cell of the 4 x 4 grid
+    assert all(len({tuple(cell) for cell in point_cells}) == 16 for point_cells in cells)
+
+    sobol = get_shadow_sample_offsets(4, 2., rng, 'sobol', (5,))
+    assert sobol.shape == (5, 16, 2) and np.all(np.abs(sobol) <= 1.)
+    for axis in range(2):  # stratified along each axis too, unlike the jittered grid
+        assert all(len(set(np.floor((point_samples[:, axis] + 1.) / 2. * 16).astype(int))) == 16 for point_samples in sobol)
+
+
+def test_compiled_scene_matches_shapes():
+    scene = Scene(*make_scene())
+    rng = np.random.default_rng(4)
+    origins = rng.uniform(-4, 4, size=(200, 3))
+    directions = rng.normal(size=(200, 3))
+    directions /= norm2(directions, axis=1, keepdims=True)
+
+    all_distances = np.array([scene.get_distances(np.full(len(origins), index), origins, directions) for index in range(scene.num_shapes)])
+    distances, indices = scene.closest_hit(origins, directions, np.full((200, 0), -1))
+    assert np.allclose(distances, all_distances.min(axis=0))
+    assert np.array_equal(indices[np.isfinite(distances)], all_distances.argmin(axis=0)[np.isfinite(distances)])
+
+    hit = np.isfinite(distances)
+    points = origins[hit] + distances[hit, None] * directions[hit]
+    expected_normals = [scene.shapes[index].normal_at_point(point) for index, point in zip(indices[hit], points)]
+    assert np.allclose(scene.get_normals(indices[hit], points), expected_normals)
+
+
+def test_benchmark_counts_and_regressions(tmp_path):
+    from benchmark import generate_scene, run_benchmark, compare_results, get_psnr
+
+    scene_path = str(tmp_path / 'scene.txt')
+    generate_scene(scene_path, num_shapes=6, num_lights=2, root_shadow_rays=2, max_recursions=2, transp=0.5, reflect=0.3)
+    img, result = run_benchmark(scene_path, 8, 6, engine='batch', accel='bvh', tile_size=4)
+    assert result['rays']['primary'] == 8 * 6
+    assert result['rays']['shadow'] > 0 and result['rays']['shadow'] % 4 == 0
+    assert get_psnr(img * 255, img * 255) == np.inf
+
+    baseline = {'scene': {'total_rays_per_second': 100.}}
+    assert compare_results({'scene': {'total_rays_per_second': 95.}}, baseline, 0.1) == []
+    assert len(compare_results({'scene': {'total_rays_per_second': 85.}}, baseline, 0.1)) == 1
+
+
+def test_render_stats():
+    from parallel import render_tiles
+    from stats import RenderStats
+
+    for engine in ['scalar', 'batch']:
+        scene = Scene(*make_scene())
+        scene.stats = RenderStats()
+        render_tiles(6, 5, scene, engine, tile_size=4, seed=0)
+        report = scene.stats.report()
+        assert report['rays']['primary'] == 6 * 5
+        assert scene.stats.get_heatmap(6, 5).sum() == report['total_rays']
+        assert sum(report['depths'].values()) >= report['depths'][0] > 0
+        assert set(report['tests']) == {'sphere', 'plane', 'box'}
+        assert all(seconds >= 0 for seconds in report['phase_times'].values())
+
+
+def test_progressive_render():
+    from batch import ray_cast_batch
+    from progressive import render_progressive
+
+    # without soft shadows the tiles converge after 2 passes, to the regular render
+    scene = Scene(*make_scene())
+    img = render_progressive(12, 10, scene, tile_size=4, coarse_step=4, seed=0)
+    assert np.allclose(img, ray_cast_batch(12, 10, scene), atol=1e-6)
+
+    # the coarse pixels cover the screen like the image's, also when the step doesn't divide the image
+    preview = render_progressive(20, 10, scene, tile_size=4, coarse_step=8, seed=0, time_budget=0)
+    coarse = ray_cast_batch(3, 2, scene)
+    assert np.array_equal(preview, np.repeat(np.repeat(coarse, [7, 6, 7], axis=0), 5, axis=1))
+
+
+def test_adaptive_antialiasing():
+    from antialias import render_antialiased, find_edges
+    from batch import ray_cast_batch
+    from stats import RenderStats
+
+    scene = Scene(*make_scene())
+    plain_img = ray_cast_batch(16, 16, scene)
+    assert np.array_equal(render_antialiased(16, 16, scene, max_samples=1, seed=0), plain_img)
+
+    scene.stats = RenderStats()
+    img = render_antialiased(16, 16, scene, tile_size=8, max_samples=5, seed=0)
+    changed = np.any(img != plain_img, axis=-1)
+    assert np.any(changed) and not np.all(changed)
+    assert find_edges(plain_img, np.zeros((16, 16), dtype=int), 0.1)[changed].mean() > 0.5
+    assert 16 * 16 < scene.stats.rays['primary'] < 5 * 16 * 16
+
+
+def test_checkpoint_resume(tmp_path):
+    from checkpoint import open_checkpoint
+    from parallel import render_tiles
+
+    scene = Scene(*make_scene())
+    expected = render_tiles(8, 8, scene, 'batch', tile_size=4, seed=3)
+
+    img, done, seed = open_checkpoint(str(tmp_path), 8, 8, 4, 3, {'scene': 'test'})
+    render_tiles(8, 8, scene, 'batch', tile_size=4, seed=seed, img=img, done=done)
+    assert done.all()
+
+    # a resumed render skips the finished tiles
+    done[1:] = False
+    img[:] = 0
+    del img, done
+    img, done, seed = open_checkpoint(str(tmp_path), 8, 8, 4, None, {'scene': 'test'})
+    assert seed == 3 and done.sum() == 1
+    render_tiles(8, 8, scene, 'batch', tile_size=4, seed=seed, img=img, done=done)
+    assert np.all(img[4:, :4] == 0)
+    assert np.array_equal(img[:4], expected[:4]) and np.array_equal(img[:, 4:], expected[:, 4:])
+
+    with pytest.raises(ValueError):
+        open_checkpoint(str(tmp_path), 8, 8, 4, None, {'scene': 'another'})
+
+
+def test_animation_camera_path(tmp_path):
+    from animation import parse_camera_path, interpolate_cameras, render_animation
+    from PIL import Image
+
+    path = tmp_path / 'path.txt'
+    path.write_text('# frame position look_at\n4 0 2 -4  0 0 0\n0 0 2 -8  0 0 0  0 1 0\n')
+    scene = Scene(*make_scene())
+    cameras = interpolate_cameras(scene.camera, parse_camera_path(str(path)))
+    assert len(cameras) == 5
+    assert np.allclose(cameras[2].position, [0, 2, -6]) and cameras[2].screen_width == scene.camera.screen_width
+
+    render_animation(6, 6, scene, cameras[:2], str(tmp_path / 'frame_%02d.png'), 'batch', seed=0)
+    assert Image.open(tmp_path / 'frame_01.png').size == (6, 6)
+
+    # the frames are numbered like the camera path's
+    path.write_text('3 0 2 -8  0 0 0\n5 0 2 -4  0 0 0\n')
+    keyframes = parse_camera_path(str(path))
+    render_animation(6, 6, scene, interpolate_cameras(scene.camera, keyframes), str(tmp_path / 'path_%02d.png'), seed=0, first_frame=keyframes[0][0])
+    assert sorted(file.name for file in tmp_path.glob('path_*.png')) == ['path_03.png', 'path_04.png', 'path_05.png']
+
+
+def test_gbuffer_reshading(tmp_path):
+    from dataclasses import replace
+    from gbuffer import GBufferCache, render_with_gbuffer
+    from parallel import render_tiles
+    from stats import RenderStats
+
+    cache = GBufferCache(str(tmp_path))
+    camera, set_params, materials, lights, shapes = make_scene()
+    img, reshaded = render_with_gbuffer(8, 8, Scene(camera, set_params, materials, lights, shapes), cache, tile_size=4, seed=0)
+    assert not reshaded
+
+    # other material and light colors are reshaded without tracing any ray
+    materials[0] = replace(materials[0], diffuse_rgb=np.array([0.1, 0.1, 0.9]))
+    lights[1] = replace(lights[1], rgb=np.array([1., 0.5, 0.5]), specular_intens=0.8)
+    scene = Scene(camera, set_params, materials, lights, shapes)
+    scene.stats = RenderStats()
+    img, reshaded = render_with_gbuffer(8, 8, scene, cache, tile_size=4, seed=0)
+    assert reshaded and scene.stats.total_rays == 0
+    scene.stats = None
+    assert np.allclose(img, render_tiles(8, 8, scene, 'batch', tile_size=4, seed=0), atol=1e-6)
+
+    # a material which becomes reflective spawns new rays, it's traced again
+    materials[1] = replace(materials[1], reflect_rgb=np.array([0.5, 0.5, 0.5]))
+    img, reshaded = render_with_gbuffer(8, 8, Scene(camera, set_params, materials, lights, shapes), cache, tile_size=4, seed=0)
+    assert not reshaded
+
+
+def test_streaming_and_binary_scene(tmp_path):
+    from benchmark import generate_scene
+    from parser import parse, parse_arrays, compile_scene
+    from parallel import render_tiles
+    from scene_file import save_binary_scene, load_scene
+
+    scene_path = str(tmp_path / 'scene.txt')
+    generate_scene(scene_path, num_shapes=12, num_lights=2, root_shadow_rays=1, max_recursions=2, transp=0.3, reflect=0.3)
+    with open(scene_path, 'a') as fp:
+        fp.write('pln 0.3 2 -0.1 -1.5 1\n')  # a normal which isn't a unit vector
+    expected = Scene(*parse(scene_path, 8, 6))
+    scene = compile_scene(*parse_arrays(scene_path), 8, 6)
+    for name in ('shape_types', 'shape_materials', 'sphere_centers', 'sphere_radii', 'plane_normals', 'plane_offsets', 'box_mins', 'box_maxs'):
+        assert np.array_equal(getattr(scene, name), getattr(expected, name))
+
+    binary_path = str(tmp_path / 'scene.bin')
+    save_binary_scene(binary_path, *parse_arrays(scene_path))
+    binary_scene = load_scene(binary_path, 8, 6)
+    assert np.array_equal(render_tiles(6, 8, binary_scene, 'batch', tile_size=4, seed=0),
+                          render_tiles(6, 8, expected, 'batch', tile_size=4, seed=0))
+
+
+def test_render_server(tmp_path, monkeypatch):
+    import json
+    import os
+    import threading
+    import server
+    from urllib.request import urlopen
+    from benchmark import generate_scene
+    from parallel import render_tiles
+    from scene_file import load_scene
+    from server import make_server
+
+    scene_path = str(tmp_path / 'scene.txt')
+    generate_scene(scene_path, num_shapes=6, num_lights=1, root_shadow_rays=1, max_recursions=2, transp=0.0, reflect=0.3)
+    with open(scene_path, 'rb') as fp:
+        scene_contents = fp.read()
+
+    http_server = make_server(port=0)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{http_server.server_address[1]}'
+    try:
+        for _ in range(2):
+            with urlopen(f'{url}/render?width=8&height=6&accel=none&tile_size=4&format=raw', data=scene_contents) as response:
+                img = np.frombuffer(response.read(), dtype=np.float32).reshape(6, 8, 3)
+                timings = json.loads(response.headers['X-Render-Timings'])
+        assert np.array_equal(img, render_tiles(6, 8, load_scene(scene_path, 8, 6), 'batch', tile_size=4, seed=0))
+        assert timings['latency'] >= timings['queue'] + timings['setup'] + timings['render']
+
+        with urlopen(f'{url}/status') as response:
+            status = json.loads(response.read())
+        assert status['jobs_done'] == 2 and status['scene_cache_hits'] == 1 and 'p95' in status['latency'] and status['queue_depth'] == 0
+    finally:
+        http_server.shutdown()
+        http_server.render_server.close()
+
+    # past the cap, the scene files of the queued jobs are kept until the jobs are done
+    monkeypatch.setattr(server, 'MAX_SCENE_FILES', 1)
+    render_server = server.RenderServer()
+    try:
+        queued_digest, queued_path = render_server._store_scene(scene_contents)
+        render_server.render(scene_contents + b'\n', 8, 6, accel='none', tile_size=4)
+        assert os.path.exists(queued_path)
+        render_server._release_scene(queued_digest)
+        render_server.render(scene_contents + b'\n\n', 8, 6, accel='none', tile_size=4)
+        assert not os.path.exists(queued_path) and len(render_server.scene_files) == 1
+    finally:
+        render_server.close()
+
+
+def test_grid_matches_brute_force():
+    from grid import Grid
+
+    rng = np.random.default_rng(2)
+    shapes = [Plane(material=1, normal=np.array([0., 1., 0.]), offset=-6.)]
+    for k in range(80):
+        center = rng.uniform(-5, 5, size=3)
+        shapes.append(Sphere(material=1, center=center, radius=rng.uniform(0.2, 1)) if k % 2 else Box(material=1, center=center, length=rng.uniform(0.2, 1)))
+    origins = rng.uniform(-8, 8, size=(300, 3))
+    directions = rng.normal(size=(300, 3))
+    directions[:20, 1:] = 0  # axis aligned rays
+    directions /= norm2(directions, axis=1, keepdims=True)
+    excluded = rng.integers(-1, len(shapes), size=(300, 2))
+    max_distances = rng.uniform(0, 10, size=300)
+
+    scene = Scene(*make_scene()[:4], shapes)
+    grid = Grid(scene)
+    expected_distances, expected_indices = scene.closest_hit(origins, directions, excluded)
+    distances, indices = grid.closest_hit(origins, directions, excluded)
+    assert np.array_equal(indices, expected_indices)
+    assert np.allclose(distances[indices >= 0], expected_distances[indices >= 0])
+    assert np.array_equal(grid.any_hit(origins, directions, max_distances, excluded),
+                          scene.any_hit(origins, directions, max_distances, excluded))
+    assert grid.report()['avg_cells_visited_per_ray'] < grid.num_cells
+
+
+def test_packets_match_brute_force():
+    from packets import PacketTracer
+
+    rng = np.random.default_rng(3)
+    shapes = [Plane(material=1, normal=np.array([0., 1., 0.]), offset=-6.)]
+    for k in range(200):
+        center = rng.uniform(-5, 5, size=3) + [0., 0., 10.]
+        shapes.append(Sphere(material=1, center=center, radius=rng.uniform(0.1, 0.4)) if k % 2 else Box(material=1, center=center, length=rng.uniform(0.1, 0.4)))
+    # coherent rays from a camera, shadow-like rays from an area towards neighbouring points, and incoherent rays
+    camera_directions = np.stack(np.meshgrid(np.linspace(-0.6, 0.6, 32), np.linspace(-0.6, 0.6, 16), [1.]), axis=-1).reshape(-1, 3)
+    area_origins = rng.uniform(-1, 1, size=(256, 3)) * [1., 0., 1.] + [0., 8., 10.]
+    targets = np.repeat(rng.uniform(-5, 5, size=(64, 3)) * [1., 0., 1.] + [0., -6., 10.], 4, axis=0)
+    origins = np.concatenate([np.zeros((len(camera_directions), 3)), area_origins, rng.uniform(-8, 8, size=(64, 3))])
+    directions = np.concatenate([camera_directions, targets - area_origins, rng.normal(size=(64, 3))])
+    directions /= norm2(directions, axis=1, keepdims=True)
+    excluded = rng.integers(-1, len(shapes), size=(len(origins), 2))
+    max_distances = rng.uniform(0, 20, size=len(origins))
+
+    scene = Scene(*make_scene()[:4], shapes)
+    packets = PacketTracer(scene)
+    expected_distances, expected_indices = scene.closest_hit(origins, directions, excluded)
+    distances, indices = packets.closest_hit(origins, directions, excluded)
+    assert np.array_equal(indices, expected_indices)
+    assert np.allclose(distances[indices >= 0], expected_distances[indices >= 0])
+    assert np.array_equal(packets.any_hit(origins, directions, max_distances, excluded),
+                          scene.any_hit(origins, directions, max_distances, excluded))
+    report = packets.report()
+    assert report['wide_rays'] > 0 and report['culled_shapes_rate'] > 0.5
+
+
+def test_reprojection():
+    from dataclasses import replace
+    from parallel import render_tiles
+    from reprojection import ReprojectionCache, render_reprojected
+    from stats import RenderStats
+
+    scene = Scene(*make_scene())
+    height, width = 24, 24
+
+    def render(cache):
+        scene.stats = RenderStats()
+        img = render_reprojected(height, width, scene, cache, tile_size=16, seed=0)
+        return img, scene.stats.report()['rays']['shadow']
+
+    cache = ReprojectionCache()
+    img, shadow_rays = render(cache)
+    assert np.array_equal(img, render_tiles(height, width, scene, 'batch', 16, seed=0))
+
+    # a still camera finds all its hits again, the lights are points so the reused shadows are the ones it would trace
+    still_img, still_shadow_rays = render(cache)
+    assert cache.report()['reprojected_hits'] == np.sum(cache.frame.indices >= 0)
+    assert np.array_equal(still_img, img) and still_shadow_rays < shadow_rays
+
+    scene.camera = replace(scene.camera, position=scene.camera.position + [0.05, 0.02, 0.])
+    moved_img, moved_shadow_rays = render(cache)
+    expected, _ = render(ReprojectionCache())
+    assert moved_shadow_rays < shadow_rays
+    assert np.mean(np.abs(moved_img - expected).max(axis=2) > 0.05) < 0.05
+
+
+def test_light_selection(tmp_path):
+    from benchmark import generate_scene
+    from parallel import render_tiles
+    from scene_file import load_scene
+    from stats import RenderStats
+
+    scene_path = str(tmp_path / 'scene.txt')
+    generate_scene(scene_path, num_shapes=10, num_lights=8, root_shadow_rays=3, max_recursions=2, transp=0.3, reflect=0.3)
+    scene = load_scene(scene_path, 8, 8)
+    scene.light_rgb[::2] *= 0.05  # half of the lights are dim
+
+    def render(seed=0, **options):
+        for name, value in options.items():
+            setattr(scene.options, name, value)
+        scene.stats = RenderStats()
+        img = render_tiles(8, 8, scene, 'batch', tile_size=8, seed=seed)
+        for name in options:
+            setattr(scene.options, name, 0)
+        return img, scene.stats.report()['rays']['shadow']
+
+    expected, shadow_rays = render()
+    # the dim lights add at most their bounds
+    img, culled_shadow_rays = render(light_threshold=0.1)
+    assert culled_shadow_rays < shadow_rays and np.abs(img - expected).max() <= 4 * 0.05 * 1.5
+    img, adaptive_shadow_rays = render(adaptive_shadow_rays=True)
+    assert adaptive_shadow_rays < shadow_rays
+
+    # the weighted light samples average to the full shading
+    img = np.mean([render(seed, light_samples=2)[0] for seed in range(40)], axis=0)
+    assert np.abs(img - expected).mean() < 0.02
+
+
+def test_shadow_cache_and_early_out():
+    from dataclasses import replace
+    from bvh import BVH
+    from parallel import render_tiles
+    from shadows import OccluderCache
+    from stats import RenderStats
+
+    camera, set_params, materials, lights, shapes = make_scene()
+    lights = [replace(light, radius=1.) for light in lights]
+    scene = Scene(camera, replace(set_params, root_shadow_rays=4), materials, lights, shapes)
+    scene.accel = BVH(scene)
+    scene.stats = RenderStats()
+    expected = render_tiles(12, 12, scene, 'batch', tile_size=6, seed=0)
+    shadow_rays = scene.stats.rays['shadow']
+    rays_traced = scene.accel.rays_traced
+
+    # the cache only changes the order of the tests, and the rays it blocks skip the BVH
+    scene.shadow_cache = OccluderCache(scene.num_lights)
+    scene.stats = RenderStats()
+    assert np.array_equal(render_tiles(12, 12, scene, 'batch', tile_size=6, seed=0), expected)
+    assert 0 < scene.stats.shadows['cache_hits'] <= scene.stats.shadows['cache_blocked']
+    assert scene.accel.rays_traced - rays_traced == rays_traced - scene.stats.shadows['cache_hits']
+
+    # the hits out of the penumbra skip their soft shadow rays
+    scene.options.shadow_early_out = True
+    scene.stats = RenderStats()
+    img = render_tiles(12, 12, scene, 'batch', tile_size=6, seed=0)
+    assert scene.stats.rays['shadow'] < shadow_rays and scene.stats.shadows['early_outs'] > 0
+    assert np.abs(img - expected).mean() < 0.01
+    assert np.abs(render_tiles(6, 6, scene, 'scalar', seed=0) - render_tiles(6, 6, scene, 'batch', seed=0)).mean() < 0.05
+
+
+def test_kernels_match_numpy():
+    from parallel import render_tiles
+
+    rng = np.random.default_rng(3)
+    scene = Scene(*make_scene())
+    origins = rng.uniform(-4, 4, size=(40, 3))
+    directions = rng.normal(size=(40, 3))
+    directions[:5, :2] = 0  # axis aligned rays
+    directions /= norm2(directions, axis=1, keepdims=True)
+    excluded = rng.integers(-1, scene.num_shapes, size=(40, 1))
+    max_distances = rng.uniform(0, 6, size=40)
+    indices = rng.integers(0, scene.num_shapes, size=40)
+
+    expected_hits = scene.closest_hit(origins, directions, excluded)
+    expected_occlusions = scene.any_hit(origins, directions, max_distances, excluded)
+    expected_distances = scene.get_distances(indices, origins, directions)
+    expected_img = render_tiles(4, 4, scene, 'batch', seed=0)
+
+    # without numba the kernels run as plain python
+    scene.backend = 'numba'
+    distances, hit_indices = scene.closest_hit(origins, directions, excluded)
+    assert np.array_equal(hit_indices, expected_hits[1]) and np.allclose(distances, expected_hits[0])
+    assert np.array_equal(scene.any_hit(origins, directions, max_distances, excluded), expected_occlusions)
+    assert np.allclose(scene.get_distances(indices, origins, directions), expected_distances)
+    assert np.allclose(render_tiles(4, 4, scene, 'batch', seed=0), expected_img, atol=1e-6)
+
+
+def test_streamed_output(tmp_path):
+    from dataclasses import replace
+    from PIL import Image
+    from output import PNGWriter, PFMWriter, read_pfm
+    from parallel import render_tiles, render_tile_rows
+
+    camera, set_params, materials, lights, shapes = make_scene()
+    lights = [replace(light, rgb=light.rgb * 4) for light in lights]
+    scene = Scene(camera, set_params, materials, lights, shapes)
+    scene.options.hdr = True
+    expected = render_tiles(10, 7, scene, 'batch', tile_size=4, seed=0)
+    assert expected.max() > 1
+
+    # the bands are rendered like the whole image, and streamed in either order
+    for writer_class in (PNGWriter, PFMWriter):
+        path = str(tmp_path / f'out{writer_class.__name__}')
+        with writer_class(path, 10, 7) as writer:
+            for rows in render_tile_rows(10, 7, scene, 'batch', tile_size=4, seed=0, bottom_up=writer_class.bottom_up):
+                writer.write_rows(rows)
+        if writer_class is PFMWriter:
+            assert np.array_equal(read_pfm(path), expected)
+        else:
+            assert np.array_equal(np.asarray(Image.open(path)), (np.clip(expected, 0, 1) * 255).astype(np.uint8))
+
+    # float32 shading is within rounding of float64
+    scene.options.float32 = True
+    assert np.allclose(render_tiles(10, 7, scene, 'batch', tile_size=4, seed=0), expected, atol=1e-4)
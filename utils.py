@@ -9,9 +9,9 @@ norm2 = partial(np.linalg.norm, ord=2)
 atol = 1e-08
 
 
-def write_img(img, img_path):
-    img = (img * 255).astype(np.uint8)
-    Image.fromarray(img).save(img_path)
+def write_img(img, img_path, format=None):
+    img = (np.clip(img, 0, 1) * 255).astype(np.uint8)  # HDR colors (see `classes.RenderOptions.hdr`) are clipped
+    Image.fromarray(img).save(img_path, format=format)
 
 
 def is_close(a, b):
@@ -21,3 +21,22 @@ def get_reflected_vector(d, n):
     # reflect_direction calculation: shading13.pdf - slide 41 "The Highlight Vector"
     r = d - 2 * np.dot(d, n) * n
     return r
+
+
+def get_reflected_vectors(d, n):
+    # batched get_reflected_vector, d and n are (N,3)
+    return d - 2 * np.einsum('ij,ij->i', d, n)[:, None] * n
+
+
+def normalize_rows(v):
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def get_viewing_window_vectors(camera):
+    towards = camera.look_at - camera.position
+    towards = towards / np.linalg.norm(towards)
+    up_perp = camera.up - np.dot(camera.up, towards) / np.dot(towards, towards) * towards
+    up_perp = up_perp / np.linalg.norm(up_perp)
+    width_direction = np.cross(up_perp, towards)
+    width_direction = width_direction / np.linalg.norm(width_direction)
+    return towards, up_perp, width_direction